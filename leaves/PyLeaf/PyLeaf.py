@@ -1,13 +1,25 @@
-from websocket import WebSocketApp
+from websocket import WebSocketApp, ABNF
 import threading
 import json
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 class PyLeaf:
-    API_VERSION = '1.0.0'
+    API_VERSION = '1.1.0'
+    BATCH_VERSION = (1, 1, 0)  # first hub api_version that accepts DEVICE_STATUS_BATCH
 
-    def __init__(self, name, model, uuid, token, socket=None):
+    def __init__(self, name, model, uuid, token, socket=None, encodings=None):
         self.devices = {}
+        # binary encodings to offer the hub in order of preference (pass [] for JSON only)
+        if encodings is None:
+            encodings = ['msgpack']
+        self.encodings = [encoding for encoding in encodings if encoding == 'msgpack' and msgpack is not None]
+        self.encoding = 'json'
+        self.hub_api_version = ()
         self.name = name
         self.uuid = uuid
         self.model = model
@@ -29,6 +41,8 @@ class PyLeaf:
 
         def on_connect(ws):
             self.connect_attempt = 0
+            self.encoding = 'json'
+            self.hub_api_version = ()
             self.connected = True
             self.send_config()
 
@@ -69,24 +83,39 @@ class PyLeaf:
         print("WebSocket Error: {}".format(error))
 
     def send_device_list(self):
+        if self.hub_api_version >= self.BATCH_VERSION:
+            batch = {'type': 'DEVICE_STATUS_BATCH',
+                     'uuid': self.uuid,
+                     'devices': [self.status_dict(device) for device in self.devices.values()]}
+            self.send(batch)
+        else:
+            for device in self.devices.values():
+                self.send_status(device)
         message = {'type': 'DEVICE_LIST',
                    'uuid': self.uuid}
-        for device in self.devices:
-            self.send_status(device)
-        self.socket.send(json.dumps(message))
+        self.send(message)
 
     def send_name(self):
         message = {'uuid': self.uuid,
                    'type': 'NAME',
                    'name': self.name}
-        self.socket.send(json.dumps(message))
+        self.send(message)
+
+    def send(self, message):
+        if self.encoding == 'msgpack':
+            self.socket.send(msgpack.packb(message, use_bin_type=True), opcode=ABNF.OPCODE_BINARY)
+        else:
+            self.socket.send(json.dumps(message))
 
     def parse_message(self, message):
-        message = json.loads(message)
+        if isinstance(message, bytes):
+            message = msgpack.unpackb(message, raw=False)
+        else:
+            message = json.loads(message)
         if not PyLeaf.is_valid_message(message):
             message = {'type': 'INVALID_MESSAGE',
                        'uuid': self.uuid}
-            self.socket.send(json.dumps(message))
+            self.send(message)
 
         type = message["type"]
         if type == 'LIST_DEVICES':
@@ -96,15 +125,15 @@ class PyLeaf:
             device = self.get_device(message['device'])
             if device:
                 if not device.set_option(message['option'], message['value']):
-                    return device.send_invalid_option(message['option'])
-                return device.send_option(message['option'], self.socket)
+                    return device.send_invalid_option(message, self)
+                return device.send_option(message['option'], self)
             else:
                 return self.send_unknown_device(message['device'])
 
         elif type == 'GET_OPTION':
             device = self.get_device(message['device'])
             if device:
-                return device.send_option(message['option'], self.socket)
+                return device.send_option(message['option'], self)
             else:
                 return self.send_unknown_device(message['device'])
 
@@ -112,24 +141,18 @@ class PyLeaf:
             return self.send_status(message['device'])
 
         elif type == 'SET_OUTPUT':
-            device = self.get_device(message['device'])
-            if device:
-                if device.mode == Device.OUT:
-                    value = device.parse_value(message['value'])
-                    if value:
-                        device.value = value
-                        return
-                    else:
-                        device.send_invalid_value(message, self.socket)
-                else:
-                    device.send_invalid_mode(message, self.socket)
-            else:
-                return self.send_unknown_device()
+            return self.set_output(message)
+
+        elif type == 'SET_OUTPUTS':
+            for output in message['outputs']:
+                self.set_output(dict(output, uuid=message['uuid']))
 
         elif type == 'GET_CONFIG':
             return self.send_config()
 
         elif type == 'CONFIG_COMPLETE':
+            self.encoding = message.get('encoding', 'json')
+            self.hub_api_version = PyLeaf.parse_version(message.get('api_version', '0.1.0'))
             return self.process_queue()
 
         elif type == 'SUBSCRIBER_UPDATE':
@@ -143,6 +166,21 @@ class PyLeaf:
                     # find the callback for subscriptions to this uuid and pass the received message to it
                     self.subscriptions[sub_message['uuid']][device](sub_message)
 
+    def set_output(self, message):
+        device = self.get_device(message['device'])
+        if device:
+            if device.mode == Device.OUT:
+                value = device.parse_value(message['value'])
+                if value:
+                    device.value = value
+                    return
+                else:
+                    device.send_invalid_value(message, self)
+            else:
+                device.send_invalid_mode(message, self)
+        else:
+            return self.send_unknown_device(message['device'])
+
     def send_config(self):
         if not self.connected:
             self.message_queue.append((self.send_config, []))
@@ -156,7 +194,9 @@ class PyLeaf:
             'token': self.token,
             'api_version': self.API_VERSION,
         }
-        self.socket.send(json.dumps(leaf))
+        if self.encodings:
+            leaf['encodings'] = self.encodings + ['json']
+        self.socket.send(json.dumps(leaf))  # the handshake is always JSON
 
     def subscribe(self, uuid, device, callback):
         if not self.connected:
@@ -173,7 +213,7 @@ class PyLeaf:
             'sub_uuid': uuid,
             'sub_device': device
         }
-        self.socket.send(json.dumps(message))
+        self.send(message)
 
     def send_status(self, device_name):
         if not self.connected:
@@ -188,16 +228,30 @@ class PyLeaf:
         if not device:
             return self.send_unknown_device(device_name)
 
-        message = {
-            'type': 'DEVICE_STATUS',
-            'uuid': self.uuid,
+        message = self.status_dict(device)
+        message['type'] = 'DEVICE_STATUS'
+        message['uuid'] = self.uuid
+        self.send(message)
+
+    @staticmethod
+    def parse_version(version):
+        try:
+            return tuple(int(part) for part in version.split('.'))
+        except ValueError:
+            return ()
+
+    @staticmethod
+    def status_dict(device):
+        status = {
             'device': device.name,
             'format': device.format,
             'value': device.value,
             'mode': device.mode,
             'options': device.options
         }
-        self.socket.send(json.dumps(message))
+        if device.units:
+            status['units'] = device.units
+        return status
 
     def get_device(self, device):
         """
@@ -229,7 +283,7 @@ class PyLeaf:
         message = {'uuid': self.uuid,
                    'type': 'UNKNOWN_DEVICE',
                    'device': device_name}
-        self.socket.send(json.dumps(message))
+        self.send(message)
 
 
 class Device:
@@ -265,16 +319,16 @@ class Device:
     def add_listener(self, callback):
         self.listeners.add(callback)
 
-    def send_option(self, option, socket):
+    def send_option(self, option, leaf):
         pass
 
     @staticmethod
-    def send_invalid_option(message, socket):
+    def send_invalid_option(message, leaf):
         message = {'uuid': message['uuid'],
                    'type': 'INVALID_OPTION',
                    'device': message['device'],
                    'option': message['option']}
-        socket.send(json.dumps(message))
+        leaf.send(message)
 
     def parse_value(self, value, format=None):
         format = format or self.format
@@ -296,11 +350,11 @@ class Device:
         else:
             return str(value)
 
-    def send_invalid_mode(self, message, socket):
+    def send_invalid_mode(self, message, leaf):
         message = {'uuid': message['uuid'],
                    'type': 'INVALID_MODE',
                    'device': message['device']}
-        socket.send(json.dumps(message))
+        leaf.send(message)
 
     def set_option(self, option, value):
         if option in self.options:
@@ -309,12 +363,12 @@ class Device:
         else:
             return False
 
-    def send_invalid_value(self, message, socket):
+    def send_invalid_value(self, message, leaf):
         message = {'uuid': message['uuid'],
                    'type': 'INVALID_VALUE',
                    'device': message['device'],
                    'value': message['value']}
-        socket.send(json.dumps(message))
+        leaf.send(message)
 
 
 class NoDevice(Device):
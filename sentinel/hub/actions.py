@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from collections import deque
+
+from channels.consumer import AsyncConsumer
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import outbox
+from .cascade import cascade
+from .listener import listener
+from .metrics import metrics
+from .outbox import Outbox
+from .registry import registry
+
+logger = logging.getLogger(__name__)
+
+# the channel `manage.py runworker default` consumes
+ACTION_CHANNEL = "default"
+
+
+def run_actions(condition, actions):
+    """
+    Applies a satisfied condition's actions here, or hands them to the action worker when
+    SENTINEL_ACTION_WORKER is set, one event per target leaf (or the hub's datastores). The events
+    carry the cascade depth and the number of conditions executed so far, and the worker continues
+    the cascade from there. Events for different targets continue it independently, each from the
+    count at which it was sent.
+    """
+    if not settings.SENTINEL_ACTION_WORKER:
+        from .models import Hub
+        with metrics.timed('actions.run'):
+            apply_actions(Hub.resolve(condition.hub_id), actions)
+        return
+    for target_uuid, target_actions in by_target(actions).items():
+        metrics.incr('actions.dispatched')
+        outbox.send(ACTION_CHANNEL, {"type": "action.run", "hub": condition.hub_id,
+                                     "actions": [action.pk for action in target_actions],
+                                     "target": f"{condition.hub_id}-{target_uuid}", "depth": cascade.depth,
+                                     "executed": cascade.executed})
+
+
+def by_target(actions) -> dict:
+    targets = {}
+    for action in actions:
+        targets.setdefault(action.target_uuid, []).append(action)
+    return targets
+
+
+def apply_actions(hub, actions):
+    """
+    Applies actions together: each target leaf gets its outputs in one SET_OUTPUTS message (see
+    Leaf.send_outputs) and the target datastores are written with one bulk update.
+    """
+    from .models import Datastore
+    from .utils import bulk_update, bulk_update_values
+    for target_uuid, target_actions in by_target(actions).items():
+        if target_uuid != 'datastore':
+            hub.get_leaf(target_uuid).send_outputs([action.message() for action in target_actions])
+            continue
+        datastores = {datastore.name: datastore for datastore in
+                      hub.datastores.filter(name__in={action.target_device for action in target_actions})
+                      .select_related('_value')}
+        changed = {}
+        for action in target_actions:
+            datastore = datastores.get(action.target_device)
+            if datastore is None:
+                logger.error(f"{hub.id} -- action targets missing datastore {action.target_device}")
+            elif datastore.stage_value(action.apply(datastore.value)):
+                changed[datastore.pk] = datastore
+        bulk_update_values([datastore._value for datastore in changed.values()])
+        bulk_update(Datastore, list(changed.values()), 'last_updated')
+        for datastore in changed.values():
+            datastore.record_history()
+            datastore.send_subscriber_update()
+
+
+class ActionWorker(AsyncConsumer):
+    """
+    Runs condition actions sent to ACTION_CHANNEL, so the leaf whose reading satisfied the
+    condition does not wait for them.
+
+    Actions on up to SENTINEL_ACTION_CONCURRENCY targets (a leaf, or a hub's datastores) run at
+    once; while that many are busy no more events are taken off the channel. Actions on a busy
+    target are queued behind it and run one at a time, in the order this worker received them.
+
+    The worker runs in its own process, so it starts the process listener like the leaf
+    consumers do, and resolves each run's hub from the database rather than the registry,
+    which only hears about writes made in this process.
+    """
+    def __init__(self, scope):
+        super().__init__(scope)
+        self.slots = None
+        self.targets = {}  # busy target -> actions queued behind the running one
+
+    async def action_run(self, event):
+        await listener.start()  # keeps the condition and routing caches in step with the leaf processes
+        queued = self.targets.get(event['target'])
+        if queued is not None:
+            queued.append(event)
+            return
+        if self.slots is None:  # created on the worker's event loop
+            self.slots = asyncio.Semaphore(settings.SENTINEL_ACTION_CONCURRENCY)
+        await self.slots.acquire()
+        self.targets[event['target']] = deque()
+        asyncio.ensure_future(self.run(event))
+
+    async def run(self, event):
+        target = event['target']
+        queued = self.targets[target]
+        try:
+            while event is not None:
+                try:
+                    with metrics.timed('actions.run'):
+                        execute = database_sync_to_async(self.execute)
+                        actions_outbox = await execute(event['hub'], event['actions'], event.get('depth', 0),
+                                                       event.get('executed', 0))
+                    await actions_outbox.flush()
+                except Exception:
+                    logger.exception(f"Actions {event['actions']} failed")
+                event = queued.popleft() if queued else None
+        finally:
+            del self.targets[target]
+            self.slots.release()
+
+    def execute(self, hub_id, pks, depth=0, executed=0):
+        from .models import Action, Hub
+        with Outbox(self) as actions_outbox:
+            actions = list(Action.objects.filter(pk__in=pks).select_related('_value').order_by('pk'))
+            if len(actions) < len(pks):
+                logger.info(f"{len(pks) - len(actions)} actions were deleted before they ran")
+            registry.discard(('hub', hub_id))  # no broadcast covers the registry, so resolve the hub afresh
+            cascade.run(lambda: apply_actions(Hub.resolve(hub_id), actions), depth, executed)
+        return actions_outbox
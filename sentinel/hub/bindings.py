@@ -1,4 +1,4 @@
-from .models import Hub, Leaf, Datastore, Condition
+from .models import Hub, Leaf, Datastore, Condition, condition_changed
 from .serializers import DatastoreSerializer, ConditionSerializer, LeafSerializer
 
 from django.db.models.query import EmptyQuerySet
@@ -132,6 +132,21 @@ class ConditionBinding(HubBinding):
     model = Condition
     serializer_class = ConditionSerializer
 
+    def _connect_to_model(self):
+        super()._connect_to_model()
+        condition_changed.connect(self.condition_changed_receiver, dispatch_uid=id(self))
+
+    def _disconnect_from_model(self):
+        super()._disconnect_from_model()
+        condition_changed.disconnect(None, dispatch_uid=id(self))
+
+    def condition_changed_receiver(self, condition, **kwargs):
+        if self.subscribe_update and condition.hub_id == self.scope["session"].get("hub"):
+            self.send_json({
+                'action': 'state',
+                'data': {'name': condition.name, 'previously_satisfied': condition.previously_satisfied}
+            })
+
     def get_queryset(self):
         hub_id = self.scope["session"]["hub"]
         return Hub.objects.get(id=hub_id).conditions.all()
@@ -0,0 +1,91 @@
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CascadeScheduler:
+    """
+    Runs the conditions triggered by one event breadth first from a work queue.
+
+    The first call on a thread runs the event's own work. Conditions whose actions write
+    datastores queue the datastores' readings one level deeper instead of recursing, and the
+    queue is drained level by level. An event cascades at most SENTINEL_CASCADE_MAX_DEPTH levels
+    and executes at most SENTINEL_CASCADE_MAX_CONDITIONS conditions; work over either budget is
+    dropped and counted in metrics under cascade.*. Work handed to another process resumes from the
+    depth and execution count it was handed over at.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    @property
+    def executed(self):
+        return getattr(self._local, 'executed', 0)
+
+    def run(self, work, depth=0, executed=0):
+        """Runs work now if no cascade is running on this thread, otherwise queues it one level down."""
+        queue = getattr(self._local, 'queue', None)
+        if queue is not None:
+            if self.depth >= settings.SENTINEL_CASCADE_MAX_DEPTH:
+                metrics.incr('cascade.depth_exceeded')
+                logger.warning(f"Cascade deeper than {settings.SENTINEL_CASCADE_MAX_DEPTH} levels was cut short")
+                return
+            queue.append((self.depth + 1, work))
+            return
+
+        self._local.queue = deque([(depth, work)])
+        self._local.executed = executed
+        try:
+            while self._local.queue:
+                self._local.depth, work = self._local.queue.popleft()
+                work()
+        finally:
+            self._local.queue = None
+            self._local.depth = 0
+
+    def admit(self) -> bool:
+        """Counts a condition execution against the event's budget, returning whether it may run."""
+        executed = self.executed
+        if executed >= settings.SENTINEL_CASCADE_MAX_CONDITIONS:
+            metrics.incr('cascade.budget_exceeded')
+            logger.warning(f"Cascade over {settings.SENTINEL_CASCADE_MAX_CONDITIONS} conditions was cut short")
+            return False
+        self._local.executed = executed + 1
+        return True
+
+
+cascade = CascadeScheduler()
+
+
+def find_cycle(name, reads, writes, conditions):
+    """
+    Returns the names of conditions around a cycle the condition name would close, or None.
+
+    reads and writes are the (uuid, device) pairs the new condition reads and the datastores it
+    writes; conditions maps every other condition's name to its own (reads, writes). Only
+    datastore writes are followed, as those are the ones that cascade within the hub.
+    """
+    graph = dict(conditions, **{name: (set(reads), set(writes))})
+    paths = deque([[name]])
+    seen = set()
+    while paths:
+        path = paths.popleft()
+        writes = graph[path[-1]][1]
+        for other, (other_reads, other_writes) in graph.items():
+            if writes.isdisjoint(other_reads):
+                continue
+            if other == name:
+                return path + [name]
+            if other not in seen:
+                seen.add(other)
+                paths.append(path + [other])
+    return None
@@ -0,0 +1,371 @@
+import operator
+import threading
+import uuid
+from bisect import bisect_left, bisect_right
+
+from . import outbox
+from .fanout import ROUTING_GROUP
+from .writebehind import write_behind
+
+# tags values.changed broadcasts so a process ignores its own, which may be older than its cache
+ORIGIN = str(uuid.uuid4())
+
+
+class ValueCache(dict):
+    """
+    Per-process map of value primary key to the current value, read by compiled conditions.
+
+    Entries are written as readings are staged and values are saved, and loaded from the
+    database (or the write-behind buffer) on a miss.
+    """
+    def __missing__(self, pk):
+        from .models import Value
+        value = write_behind.current(Value.objects.get(pk=pk))
+        self[pk] = value.value
+        return self[pk]
+
+    def set(self, value):
+        self[value.pk] = value.value
+
+
+value_cache = ValueCache()
+
+
+class Node:
+    """
+    A compiled predicate. Each node keeps its last result so a reading only recomputes its own
+    branch, and once shared through a Network may have several parents.
+    """
+    children = ()
+
+    def __init__(self):
+        self.parents = []
+        self.result = False
+
+    def compute(self, values):
+        raise NotImplementedError
+
+    def evaluate(self, values):
+        for child in self.children:
+            child.evaluate(values)
+        self.result = self.compute(values)
+        return self.result
+
+    def refresh(self, values) -> bool:
+        """Recomputes this node from its children's results, returning whether its result changed."""
+        result = self.compute(values)
+        changed = result != self.result
+        self.result = result
+        return changed
+
+    def propagate(self, values):
+        """Recomputes this node and, while results keep changing, the nodes above it."""
+        changed = [self] if self.refresh(values) else []
+        while changed:
+            for parent in changed.pop().parents:
+                if parent.refresh(values):
+                    changed.append(parent)
+
+
+class Constant(Node):
+    def __init__(self, result):
+        super().__init__()
+        self.result = result
+
+    def compute(self, values):
+        return self.result
+
+
+class Comparison(Node):
+    def __init__(self, first, second, comparison):
+        super().__init__()
+        self.conditions = []  # every condition this comparison is part of
+        self.first = first
+        self.second = second
+        self.comparison = comparison
+
+    def compute(self, values):
+        return self.comparison(values[self.first], values[self.second])
+
+
+class Not(Node):
+    def __init__(self, child):
+        super().__init__()
+        self.children = (child,)
+        child.parents.append(self)
+
+    def compute(self, values):
+        return not self.children[0].result
+
+
+class Combine(Node):
+    def __init__(self, combine, children):
+        super().__init__()
+        self.combine = combine
+        self.children = tuple(children)
+        for child in self.children:
+            child.parents.append(self)
+
+    def compute(self, values):
+        return self.combine(child.result for child in self.children)
+
+
+class Network:
+    """
+    The nodes of a hub's compiled conditions, with identical nodes shared between conditions.
+
+    Comparisons are identified by their comparator and operands, literals by their value (each
+    condition stores its own literal rows), and NOT and AND/OR/XOR nodes by their kind and
+    shared children, so a sub-predicate repeated across rules is evaluated once per reading.
+    """
+    def __init__(self, literals):
+        self.literals = literals
+        self.nodes = {}
+
+    def operand(self, pk):
+        return ('literal', value_cache[pk]) if pk in self.literals else ('value', pk)
+
+    def share(self, node) -> Node:
+        if isinstance(node, Comparison):
+            key = ('compare', node.comparison, self.operand(node.first), self.operand(node.second))
+            return self.nodes.setdefault(key, node)
+        if isinstance(node, Constant):
+            return self.nodes.setdefault(('constant', node.result), node)
+        children = [self.share(child) for child in node.children]
+        if isinstance(node, Not):
+            key = ('not', id(children[0]))
+        else:
+            key = ('combine', node.combine, tuple(sorted(id(child) for child in children)))
+        if key not in self.nodes:
+            self.nodes[key] = Not(children[0]) if isinstance(node, Not) else Combine(node.combine, children)
+        return self.nodes[key]
+
+
+class ThresholdIndex:
+    """
+    The comparisons of one value against literal thresholds, sorted by threshold.
+
+    All of the comparisons reflect the same reading, so the ones a new reading flips lie
+    between the old and new reading's positions and are found by bisection.
+    """
+    COMPARISONS = (operator.gt, operator.lt, operator.eq)
+
+    def __init__(self, hub_id, value):
+        self.hub_id = hub_id
+        self.value = value  # the reading the comparisons' results reflect
+        self.above, self.above_nodes = [], []  # value > threshold
+        self.below, self.below_nodes = [], []  # value < threshold
+        self.equal = {}
+
+    def add(self, node, threshold):
+        if node.comparison is operator.eq:
+            self.equal.setdefault(threshold, []).append(node)
+            return
+        thresholds, nodes = ((self.above, self.above_nodes) if node.comparison is operator.gt
+                             else (self.below, self.below_nodes))
+        position = bisect_right(thresholds, threshold)
+        thresholds.insert(position, threshold)
+        nodes.insert(position, node)
+
+    def flipped(self, value) -> list:
+        old, self.value = self.value, value
+        if old == value:
+            return []
+        low, high = sorted((bisect_left(self.above, old), bisect_left(self.above, value)))
+        flipped = self.above_nodes[low:high]
+        low, high = sorted((bisect_right(self.below, old), bisect_right(self.below, value)))
+        flipped += self.below_nodes[low:high]
+        return flipped + self.equal.get(old, []) + self.equal.get(value, [])
+
+
+class CompiledCondition:
+    """A condition's predicate tree, loaded once and compiled into nodes that read from the value cache."""
+    def __init__(self, condition):
+        self.id = condition.pk
+        self.hub_id = condition.hub_id
+        self.predicate_id = condition.predicate_id
+        self.previously_satisfied = condition.previously_satisfied  # as last loaded or executed here
+        self.comparisons = []
+        self.root = condition.predicate.compile(self)
+        self.values = {pk for node in self.comparisons for pk in (node.first, node.second)}
+
+    def comparison(self, first, second, comparison) -> Comparison:
+        node = Comparison(first, second, comparison)
+        self.comparisons.append(node)
+        return node
+
+    def share(self, network):
+        """Replaces this condition's nodes with the network's shared ones."""
+        self.root = network.share(self.root)
+        comparisons, nodes = {}, [self.root]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, Comparison):
+                comparisons[id(node)] = node
+            nodes.extend(node.children)
+        self.comparisons = list(comparisons.values())
+        for node in self.comparisons:
+            node.conditions.append(self)
+
+    @property
+    def result(self):
+        return self.root.result
+
+    def evaluate(self):
+        return self.root.evaluate(value_cache)
+
+
+class ConditionIndex:
+    """
+    Per-process compiled conditions of each hub, and a reverse index from value to the comparisons reading it.
+
+    A hub's conditions are compiled together the first time one of its values is updated, into
+    one Network of shared nodes.
+    Comparisons of a device or datastore against a literal are kept in that value's
+    ThresholdIndex, other comparisons in a plain list per value. An update recomputes only the
+    comparisons whose result may have changed and, while results keep changing, their
+    ancestors. The conditions it returns are those with a recomputed comparison plus those
+    whose result differs from their previously_satisfied, so edge-triggered actions run
+    exactly as if every condition reading the value had been executed.
+
+    Each compiled condition also holds its previously_satisfied, so conditions whose state did
+    not change are settled in memory and only transitions reach the database. Transitions are
+    announced to the other processes, whose compiled copies would otherwise keep the old state
+    and miss the next edge.
+
+    Creating or deleting a condition, saving a predicate or editing a literal drops the compiled
+    conditions here; the routing.invalidate broadcast sent when a condition's subscriptions
+    change drops the hub's compiled conditions in the other processes.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._hubs = {}
+        self._dependents = {}  # value pk -> comparisons without a literal side
+        self._thresholds = {}  # value pk -> ThresholdIndex
+        self._literals = {}  # literal value pk -> hub id
+        self._unsettled = set()  # compiled conditions whose result differs from previously_satisfied
+        self._generation = 0
+
+    def conditions(self, hub_id) -> dict:
+        conditions = self._hubs.get(hub_id)
+        if conditions is None:
+            from .models import Condition, Value
+            generation = self._generation
+            conditions = {condition.pk: CompiledCondition(condition)
+                          for condition in Condition.objects.filter(hub_id=hub_id)}
+            literals = set(Value.objects.filter(pk__in={node.second for compiled in conditions.values()
+                                                        for node in compiled.comparisons},
+                                                device__isnull=True, datastore__isnull=True)
+                           .values_list('pk', flat=True))
+            network = Network(literals)
+            for compiled in conditions.values():
+                compiled.share(network)
+            comparisons = {id(node): node for compiled in conditions.values()
+                           for node in compiled.comparisons}.values()
+            with self._lock:
+                if self._generation == generation:  # nothing was evicted while compiling
+                    self._hubs[hub_id] = conditions
+                    for compiled in conditions.values():  # readings may have arrived while compiling
+                        compiled.evaluate()
+                    for node in comparisons:
+                        if node.second in literals and node.comparison in ThresholdIndex.COMPARISONS:
+                            if node.first not in self._thresholds:
+                                self._thresholds[node.first] = ThresholdIndex(hub_id, value_cache[node.first])
+                            self._thresholds[node.first].add(node, value_cache[node.second])
+                            self._literals[node.second] = hub_id
+                        else:
+                            self._dependents.setdefault(node.first, []).append(node)
+                            self._dependents.setdefault(node.second, []).append(node)
+                    self._unsettled.update(compiled for compiled in conditions.values()
+                                           if compiled.result != compiled.previously_satisfied)
+        return conditions
+
+    def get(self, condition) -> CompiledCondition:
+        compiled = self.conditions(condition.hub_id).get(condition.pk)
+        if compiled is None or compiled.predicate_id != condition.predicate_id:
+            compiled = CompiledCondition(condition)
+            compiled.evaluate()
+        return compiled
+
+    def evaluate(self, condition):
+        return self.get(condition).evaluate()
+
+    def update(self, hub_id, readings) -> dict:
+        """Applies readings ({value pk: value}) and returns the conditions to execute, by primary key."""
+        self.conditions(hub_id)
+        return self.apply(readings)
+
+    def apply(self, readings) -> dict:
+        touched = {}
+        with self._lock:
+            if any(pk in self._literals for pk in readings):
+                self.clear()  # thresholds are sorted by the literal's old value
+            value_cache.update(readings)
+            seen = set()
+            for pk, value in readings.items():
+                index = self._thresholds.get(pk)
+                nodes = index.flipped(value) if index else []
+                for node in nodes + self._dependents.get(pk, []):
+                    if node in seen:  # compared against another updated value
+                        continue
+                    seen.add(node)
+                    touched.update((compiled.id, compiled) for compiled in node.conditions)
+                    node.propagate(value_cache)
+            for compiled in touched.values():
+                self.settle(compiled, compiled.previously_satisfied)
+            touched.update((compiled.id, compiled) for compiled in self._unsettled
+                           if not compiled.values.isdisjoint(readings))
+        return touched
+
+    def settle(self, compiled, previously_satisfied):
+        """Records previously_satisfied as stored for the condition, after it was loaded or executed."""
+        with self._lock:
+            compiled.previously_satisfied = previously_satisfied
+            if compiled.result != previously_satisfied:
+                self._unsettled.add(compiled)
+            else:
+                self._unsettled.discard(compiled)
+
+    def publish(self, readings):
+        """Sends readings that feed conditions to the other processes, whose caches only see their own writes."""
+        outbox.group_send(ROUTING_GROUP, {"type": "values.changed", "origin": ORIGIN,
+                                          "values": [[pk, value] for pk, value in readings.items()]})
+
+    def receive(self, event):
+        if event['origin'] != ORIGIN:
+            self.apply(dict(event['values']))
+
+    def announce(self, condition):
+        """Sends a condition's stored previously_satisfied to the other processes, which settle it on receipt."""
+        outbox.group_send(ROUTING_GROUP, {"type": "conditions.settled", "origin": ORIGIN, "hub": condition.hub_id,
+                                          "conditions": [[condition.pk, condition.previously_satisfied]]})
+
+    def receive_settled(self, event):
+        if event['origin'] == ORIGIN:
+            return
+        conditions = self._hubs.get(event['hub'], {})
+        for pk, previously_satisfied in event['conditions']:
+            if pk in conditions:
+                self.settle(conditions[pk], previously_satisfied)
+
+    def evict_hub(self, hub_id):
+        with self._lock:
+            self._hubs.pop(hub_id, None)
+            self._dependents = {pk: [node for node in nodes if node.conditions[0].hub_id != hub_id]
+                                for pk, nodes in self._dependents.items()}
+            self._thresholds = {pk: index for pk, index in self._thresholds.items() if index.hub_id != hub_id}
+            self._literals = {pk: literal_hub for pk, literal_hub in self._literals.items() if literal_hub != hub_id}
+            self._unsettled = {compiled for compiled in self._unsettled if compiled.hub_id != hub_id}
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._hubs.clear()
+            self._dependents.clear()
+            self._thresholds.clear()
+            self._literals.clear()
+            self._unsettled.clear()
+            self._generation += 1
+
+
+compiled_conditions = ConditionIndex()
@@ -1,89 +1,199 @@
+import asyncio
 import json
 import logging
 
-from channels.generic.websocket import JsonWebsocketConsumer
-from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.generic.websocket import JsonWebsocketConsumer, AsyncJsonWebsocketConsumer
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
 from django.utils import timezone
 from guardian.shortcuts import assign_perm, remove_perm
 from guardian.models import Group as PermGroup
 
-from .messages import MessageType, MessageV2, Message
+from .encoding import decode_frame, encode_frame, negotiate, raw_frame
+from .messages import API_VERSION, MessageType, MessageV2, Message, message_types, each
+from .cascade import find_cycle
+from .groupcommit import group_committer
+from .listener import listener
+from .outbox import Outbox
+from .ratelimit import LeafThrottle
+from .registry import registry
+from .writebehind import write_behind
 from .models import Leaf, Subscription, Device, Datastore, Hub
-from .models import NOT, AND, OR, XOR, SetAction, Condition, ConditionalSubscription, ChangeAction
+from .models import NOT, AND, OR, XOR, Action, SetAction, Condition, ConditionalSubscription, ChangeAction
 from .models import GreaterThanPredicate, LessThanPredicate, EqualPredicate
-from .utils import create_value, get_user, InvalidDevice, InvalidPredicate
-from .utils import InvalidLeaf, PermissionDenied, InvalidMessage
+from .utils import create_value, get_user, bulk_update_values, InvalidDevice, InvalidPredicate
+from .utils import InvalidLeaf, PermissionDenied, InvalidMessage, ConditionCycle, validate_uuid
 
 logger = logging.getLogger(__name__)
 
+def wake_later(consumer, loop):
+    """Returns a LeafThrottle wake callable sending consumer a throttle.flush after a delay, from any thread."""
+    def wake():
+        asyncio.ensure_future(consumer.channel_layer.send(consumer.channel_name, {"type": "throttle.flush"}))
+    return lambda delay: loop.call_soon_threadsafe(loop.call_later, delay, wake)
+
+
 class LeafConsumer(JsonWebsocketConsumer):
+    async def __call__(self, receive, send):
+        self.loop = asyncio.get_event_loop()
+        await listener.start()  # on the event loop, which the handlers below run off
+        await super().__call__(receive, send)
+
     def connect(self):
         id = int(self.scope["url_route"]["kwargs"]["id"])
 
         if Hub.objects.filter(id=id).exists():
             self.scope["session"]["hub"] = id
+            self.throttle = LeafThrottle(Hub.resolve(id), self.scope["session"], wake_later(self, self.loop))
             self.accept()
         else:
             self.close()
 
     def disconnect(self, close_code):
         if 'user' in self.scope["session"]:
-            hub = Hub.objects.get(pk=self.scope["session"]["hub"])
+            hub = Hub.resolve(self.scope["session"]["hub"])
             leaf = hub.get_leaf(self.scope["session"]["uuid"])
             leaf.is_connected = leaf.last_connected.timestamp() != self.scope["session"]["connect_time"]
             leaf.save()
             self.consumer = self # TODO: make unregister static
             MessageV2.unregister_leaf(self, leaf)
 
+    def receive(self, text_data=None, bytes_data=None):
+        self.receive_json(decode_frame(self.scope, text_data, bytes_data))
+
+    def send_json(self, content, close=False):
+        self.send(**encode_frame(self.scope, content), close=close)
+
     def receive_json(self, content):
-        try:
-            handle(MessageV2(self, content))
-        except InvalidMessage:
-            logger.error("Failed to handle message, aborting.")
+        self.handle_frames(self.throttle.admit(content))
+
+    def throttle_flush(self, event):
+        self.handle_frames(self.throttle.flush())
+
+    def handle_frames(self, frames):
+        for frame in frames:
+            try:
+                handle(MessageV2(self, frame))
+            except InvalidMessage:
+                logger.error("Failed to handle message, aborting.")
 
     def leaf_send(self, event):
         self.send_json(event['message'])
 
+    def leaf_send_raw(self, event):
+        self.send(**raw_frame(self.scope, event['frames']))
+
+
+class AsyncLeafConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Leaf protocol on the event loop. Each frame is handled as a single database unit on the
+    sync thread pool; the replies and channel layer sends it produces are then awaited here.
+    """
+    async def connect(self):
+        await listener.start()
+        if await self.join_hub(wake_later(self, asyncio.get_event_loop())):
+            await self.accept()
+        else:
+            await self.close()
+
+    async def disconnect(self, close_code):
+        outbox = await self.leave_hub()
+        await outbox.flush()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        await self.receive_json(decode_frame(self.scope, text_data, bytes_data))
+
+    async def send_json(self, content, close=False):
+        await self.send(**encode_frame(self.scope, content), close=close)
+
+    async def receive_json(self, content):
+        await self.handle_frames(self.throttle.admit(content))
+
+    async def throttle_flush(self, event):
+        await self.handle_frames(self.throttle.flush())
+
+    async def handle_frames(self, frames):
+        for frame in frames:
+            outbox = await database_sync_to_async(self.handle_frame)(frame)
+            await outbox.flush()
+
+    async def leaf_send(self, event):
+        await self.send_json(event['message'])
+
+    async def leaf_send_raw(self, event):
+        await self.send(**raw_frame(self.scope, event['frames']))
+
+    @database_sync_to_async
+    def join_hub(self, wake):
+        id = int(self.scope["url_route"]["kwargs"]["id"])
+        if Hub.objects.filter(id=id).exists():
+            self.scope["session"]["hub"] = id
+            self.throttle = LeafThrottle(Hub.resolve(id), self.scope["session"], wake)
+            return True
+        return False
+
+    @database_sync_to_async
+    def leave_hub(self):
+        with Outbox(self) as outbox:
+            if 'user' in self.scope["session"]:
+                hub = Hub.resolve(self.scope["session"]["hub"])
+                leaf = hub.get_leaf(self.scope["session"]["uuid"])
+                leaf.is_connected = leaf.last_connected.timestamp() != self.scope["session"]["connect_time"]
+                leaf.save()
+                outbox.group_discard(f"{hub.id}-{leaf.uuid}", self.channel_name)
+            return outbox
+
+    def handle_frame(self, content):
+        with Outbox(self) as outbox:
+            try:
+                handle(MessageV2(self, content))
+            except InvalidMessage:
+                logger.error("Failed to handle message, aborting.")
+        return outbox
+
+
+class GroupCommitLeafConsumer(AsyncLeafConsumer):
+    """
+    Async leaf consumer whose frames are committed in groups with those of other leaves by the
+    process-wide GroupCommitter. Frames are released back to the leaf in the order they arrived.
+    """
+    released = None
+
+    async def disconnect(self, close_code):
+        if self.released:
+            await self.released
+        await super().disconnect(close_code)
+
+    async def handle_frames(self, frames):
+        for frame in frames:
+            committed = group_committer.submit(self, frame)
+            self.released = asyncio.ensure_future(self.release(committed, self.released))
+
+    @staticmethod
+    async def release(committed, previous):
+        outbox = await committed
+        if previous:
+            await previous
+        await outbox.flush()
+
 
 def handle(message: Message):
     try:
         if not message.validate():
-            raise InvalidMessage(message)
-        if message.type == MessageType.Config:
-            return hub_handle_config(message)
-        elif message.type == MessageType.DeviceStatus:
-            return hub_handle_status(message)
-        elif message.type == MessageType.Subscribe:
-            return hub_handle_subscribe(message)
-        elif message.type == MessageType.Unsubscribe:
-            return hub_handle_unsubscribe(message)
-        elif message.type == MessageType.DatastoreCreate:
-            return hub_handle_datastore_create(message)
-        elif message.type == MessageType.DatastoreDelete:
-            return hub_handle_datastore_delete(message)
-        elif message.type == MessageType.DatastoreGet:
-            return hub_handle_datastore_get(message)
-        elif message.type == MessageType.DatastoreSet:
-            return hub_handle_datastore_set(message)
-        elif message.type == MessageType.ConditionCreate:
-            return hub_handle_condition_create(message)
-        elif message.type == MessageType.ConditionDelete:
-            return hub_handle_condition_delete(message)
-        elif message.type == MessageType.GetDevice:
-            return hub_handle_get_device(message)
-        else:
-            logger.error(f"{message.hub_id} -- Invalid Message: Unknown type in message")
-    except (InvalidDevice, InvalidLeaf, PermissionDenied, InvalidMessage) as e:
+            raise InvalidMessage(message.data)
+        return message_types.dispatch(message)
+    except (InvalidDevice, InvalidLeaf, PermissionDenied, InvalidMessage, ConditionCycle) as e:
         logger.error(f"{message.hub_id} -- {e} in handling {message.type} for {message.data['uuid']}")
         reply = e.get_error_message()
         reply['hub'] = message.hub.id
         message.reply(reply)
 
 
+@message_types.register(MessageType.Config, 'name', 'model', 'token', 'api_version')
 def hub_handle_config(message: Message):
     uuid = message.data['uuid']
     username = f"{message.hub.id}-{uuid}"
@@ -105,7 +215,10 @@ def hub_handle_config(message: Message):
         message.register_leaf(leaf)
         message.save_session_info('user', user.username)
         message.save_session_info('uuid', uuid)
-        response = {"type": "CONFIG_COMPLETE", "hub": message.hub.id, "uuid": uuid}
+        encoding = negotiate(message.data.get('encodings'))
+        message.save_session_info('encoding', encoding)
+        response = {"type": "CONFIG_COMPLETE", "hub": message.hub.id, "uuid": uuid, "encoding": encoding,
+                    "api_version": API_VERSION}
         message.reply(response)
         leaf.refresh_devices()
         logger.info(f'{message.hub.id} -- Config received for {leaf.name}')
@@ -115,6 +228,7 @@ def hub_handle_config(message: Message):
         message.reply(response)
 
 
+@message_types.register(MessageType.DeviceStatus, 'device', 'mode', 'format', 'value')
 def hub_handle_status(message):
     hub = message.hub
     leaf = message.leaf
@@ -131,6 +245,42 @@ def hub_handle_status(message):
     logger.info(f'{hub.id} -- Status updated: {device}')
 
 
+@message_types.register(MessageType.DeviceStatusBatch, devices=each('device', 'mode', 'format', 'value'))
+def hub_handle_status_batch(message):
+    hub = message.hub
+    leaf = message.leaf
+    changed = []
+
+    try:
+        with transaction.atomic():
+            for status in message.data['devices']:
+                try:
+                    device = leaf.get_device(status['device'], False)
+                except Device.DoesNotExist:
+                    device = Device.create_from_message(dict(status, uuid=leaf.uuid), hub)
+                    device.save()
+                    continue
+                if device.stage_value(status['value']):
+                    changed.append(device)
+            if write_behind.enabled:
+                leaf.last_updated = timezone.now()
+                for device in changed:
+                    write_behind.stage(device)
+            else:
+                bulk_update_values([device._value for device in changed])
+                leaf.update_time()
+            for device in changed:
+                device.record_history()
+    except Exception:
+        for device in changed:  # cached devices already hold the staged values
+            registry.evict(device)
+        raise
+
+    leaf.send_subscriber_updates(changed)
+    logger.info(f'{hub.id} -- Status batch updated {len(changed)} devices for {leaf.name}')
+
+
+@message_types.register(MessageType.Subscribe, 'sub_device', sub_uuid=validate_uuid)
 def hub_handle_subscribe(message):
     target_uuid = message.data['sub_uuid'].lower()
     subscriber_uuid = message.leaf.uuid.lower()
@@ -150,6 +300,7 @@ def hub_handle_subscribe(message):
         subscription.save()
 
 
+@message_types.register(MessageType.Unsubscribe, 'sub_device', sub_uuid=validate_uuid)
 def hub_handle_unsubscribe(message):
     target_uuid = message.data['sub_uuid'].lower()
     subscriber_uuid = message.leaf.uuid.lower()
@@ -173,6 +324,7 @@ def hub_handle_get_device(message):
     pass
 
 
+@message_types.register(MessageType.DatastoreCreate, 'name', 'value', 'format')
 def hub_handle_datastore_create(message):
     uuid = message.leaf.uuid.lower()
 
@@ -226,6 +378,7 @@ def hub_handle_datastore_create(message):
         logger.info(f"{message.hub.id} -- Datastore created: {message.data['name']}")
 
 
+@message_types.register(MessageType.DatastoreGet, 'name')
 def hub_handle_datastore_get(message):
     try:
         datastore = message.hub.datastores.get(name=message.data['name'])
@@ -235,7 +388,7 @@ def hub_handle_datastore_get(message):
                 'type': 'DATASTORE_VALUE',
                 'hub': message.hub.id,
                 'name': datastore.name,
-                'value': datastore.value,
+                'value': datastore._value.to_json(),
                 'format': datastore.format
             }
             message.reply(reply)
@@ -251,6 +404,7 @@ def hub_handle_datastore_get(message):
         message.reply(reply)
 
 
+@message_types.register(MessageType.DatastoreSet, 'name', 'value')
 def hub_handle_datastore_set(message):
     try:
         datastore = message.hub.datastores.get(name=message.data['name'])
@@ -261,7 +415,7 @@ def hub_handle_datastore_set(message):
                 'type': 'DATASTORE_VALUE',
                 'hub': message.hub.id,
                 'name': datastore.name,
-                'value': datastore.value,
+                'value': datastore._value.to_json(),
                 'format': datastore.format
             }
             message.reply(reply)
@@ -278,6 +432,7 @@ def hub_handle_datastore_set(message):
         message.reply(reply)
 
 
+@message_types.register(MessageType.DatastoreDelete, 'name')
 def hub_handle_datastore_delete(message):
     try:
         datastore = message.hub.datastores.get(name=message.data['name'])
@@ -300,6 +455,7 @@ def hub_handle_datastore_delete(message):
         message.reply(reply)
 
 
+@message_types.register(MessageType.ConditionCreate, 'name', 'predicate', actions=each('target', 'device', 'value'))
 def hub_handle_condition_create(message):
     create_condition(message.data['name'], message.data['predicate'], message.data['actions'], message.hub)
 
@@ -308,11 +464,13 @@ def create_condition(name, pred, actions, hub):
     operators = {'AND': AND, 'OR': OR, 'XOR': XOR}
     seen_devices = set()
 
+    check_cycles(name, pred, actions, hub)
+
     def eval_predicates(predicates):
         first = predicates[0]
         if first == 'NOT':
             predicate = eval_predicates(predicates[1])
-            not_predicate = NOT(predicate)
+            not_predicate = NOT(predicate=predicate)
             not_predicate.save()
             return not_predicate
         elif type(first) == str and first in operators:
@@ -406,6 +564,41 @@ def create_condition(name, pred, actions, hub):
     logger.info(f"{hub.id} -- {condition.name} condition set up")
 
 
+def check_cycles(name, pred, actions, hub):
+    """
+    Raises ConditionCycle if the condition's datastore actions would, through other conditions,
+    write a datastore it subscribes to. Checked before anything is saved.
+    """
+    def reads(predicates):
+        if predicates[0] == 'NOT':
+            return reads(predicates[1])
+        if type(predicates[0]) == str and predicates[0] in ('AND', 'OR', 'XOR'):
+            return {device for operand in predicates[1] for device in reads(operand)}
+        devices = {tuple(predicates[1])}
+        if type(predicates[2]) == list:
+            devices.add(tuple(predicates[2]))
+        return devices
+
+    writes = {('datastore', action['device']) for action in actions if action['target'] == 'datastore'}
+    if not writes:
+        return
+    conditions = {}
+    for condition, target_uuid, target_device in (ConditionalSubscription.objects.filter(hub=hub)
+                                                  .exclude(condition__name=name)
+                                                  .values_list('condition__name', 'target_uuid', 'target_device')):
+        conditions.setdefault(condition, (set(), set()))[0].add((str(target_uuid), target_device))
+    for condition, target_device in (Action.objects.filter(condition__hub=hub, target_uuid='datastore')
+                                     .exclude(condition__name=name)
+                                     .values_list('condition__name', 'target_device')):
+        conditions.setdefault(condition, (set(), set()))[1].add(('datastore', target_device))
+    sources = {tuple(action['value']) for action in actions if type(action['value']) == list}
+    cycle = find_cycle(name, {(str(uuid), device) for uuid, device in reads(pred) | sources}, writes, conditions)
+    if cycle:
+        logger.error(f"{hub.id} -- {name} condition would trigger itself through {cycle}")
+        raise ConditionCycle(name, cycle)
+
+
+@message_types.register(MessageType.ConditionDelete, 'name')
 def hub_handle_condition_delete(message):
     try:
         condition = message.hub.conditions.get(name=message.data['name'])
@@ -0,0 +1,113 @@
+import json
+from decimal import Decimal
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+def encode_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+class JSONCodec:
+    name = 'json'
+    binary = False
+
+    @staticmethod
+    def encode(content):
+        return json.dumps(content, default=encode_default)
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data)
+
+
+class MessagePackCodec:
+    name = 'msgpack'
+    binary = True
+
+    @staticmethod
+    def encode(content):
+        return msgpack.packb(content, default=encode_default, use_bin_type=True)
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class CBORCodec:
+    name = 'cbor'
+    binary = True
+
+    @staticmethod
+    def encode(content):
+        return cbor2.dumps(content, default=lambda encoder, obj: encoder.encode(encode_default(obj)))
+
+    @staticmethod
+    def decode(data):
+        return cbor2.loads(data)
+
+
+codecs = {codec.name: codec for codec, available in ((JSONCodec, True),
+                                                       (MessagePackCodec, msgpack is not None),
+                                                       (CBORCodec, cbor2 is not None)) if available}
+
+# hub messages that always go out as JSON text, so the leaf can read which encoding was chosen
+HANDSHAKE_REPLIES = ('CONFIG_COMPLETE', 'CONFIG_FAILED')
+
+
+def negotiate(offered):
+    """Returns the first encoding in the leaf's preference list that the hub supports, or json."""
+    if isinstance(offered, list):
+        for name in offered:
+            if name in codecs:
+                return name
+    return JSONCodec.name
+
+
+def session_codec(scope):
+    return codecs[scope["session"].get("encoding", JSONCodec.name)]
+
+
+def decode_frame(scope, text_data=None, bytes_data=None):
+    """Text frames are always JSON; binary frames use the encoding negotiated in the CONFIG handshake."""
+    if text_data is not None:
+        return JSONCodec.decode(text_data)
+    codec = session_codec(scope)
+    if not codec.binary:
+        raise ValueError("Binary frame received before a binary encoding was negotiated")
+    return codec.decode(bytes_data)
+
+
+def encode_frame(scope, content):
+    """Returns the send() keyword arguments for content in the session's encoding."""
+    codec = session_codec(scope)
+    if not codec.binary or content.get('type') in HANDSHAKE_REPLIES:
+        return {'text_data': JSONCodec.encode(content)}
+    return {'bytes_data': codec.encode(content)}
+
+
+def encode_frames(content):
+    """Encodes content once for each encoding a leaf is likely to use, for leaf.send_raw events."""
+    frames = {JSONCodec.name: JSONCodec.encode(content)}
+    if MessagePackCodec.name in codecs:
+        frames[MessagePackCodec.name] = MessagePackCodec.encode(content)
+    return frames
+
+
+def raw_frame(scope, frames):
+    """Returns the send() keyword arguments for the pre-encoded frame matching the session's encoding."""
+    codec = session_codec(scope)
+    frame = frames.get(codec.name)
+    if frame is None:
+        frame = codec.encode(JSONCodec.decode(frames[JSONCodec.name]))
+    return {'bytes_data': frame} if codec.binary else {'text_data': frame}
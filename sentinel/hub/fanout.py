@@ -0,0 +1,73 @@
+import threading
+
+from django.db import transaction
+
+from . import outbox
+from .encoding import encode_frames
+
+# each process joins this group once (see listener.py) to hear about subscription and value changes
+ROUTING_GROUP = "sentinel-routing"
+
+
+class RoutingIndex:
+    """
+    Per-process map of each hub's subscriptions, keyed by (target_uuid, target_device).
+
+    A hub's routes are loaded with one query the first time one of its values fans out and
+    then served from memory. Saving or deleting a subscription drops the hub's routes in this
+    process and broadcasts routing.invalidate on ROUTING_GROUP so the other processes drop theirs.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._generations = {}
+
+    def routes(self, hub) -> dict:
+        routes = self._routes.get(hub.id)
+        if routes is None:
+            generation = self._generations.get(hub.id, 0)
+            routes = {}
+            for subscription in hub.subscriptions.all():
+                routes.setdefault((subscription.target_uuid, subscription.target_device), []).append(subscription)
+            with self._lock:
+                if self._generations.get(hub.id, 0) == generation:  # not invalidated while loading
+                    self._routes[hub.id] = routes
+        return routes
+
+    def subscriptions(self, hub, target_uuid, target_device):
+        return self.routes(hub).get((target_uuid, target_device), [])
+
+    def evict(self, hub_id):
+        with self._lock:
+            self._routes.pop(hub_id, None)
+            self._generations[hub_id] = self._generations.get(hub_id, 0) + 1
+
+    def invalidate(self, hub_id):
+        """Evicts the hub here now and, once the transaction commits, here again and in every other process."""
+        self.evict(hub_id)
+        transaction.on_commit(lambda: self.broadcast(hub_id))
+
+    def broadcast(self, hub_id):
+        self.evict(hub_id)
+        outbox.group_send(ROUTING_GROUP, {"type": "routing.invalidate", "hub": hub_id})
+
+    def clear(self):
+        with self._lock:
+            for hub_id in self._routes:
+                self._generations[hub_id] = self._generations.get(hub_id, 0) + 1
+            self._routes.clear()
+
+
+routing = RoutingIndex()
+
+
+def send_update(hub_id, subscriber_uuids, uuid, device, message):
+    """Sends one SUBSCRIPTION_UPDATE to every subscriber leaf, encoding it once for all of them."""
+    if not subscriber_uuids:
+        return
+    sub_message = {'type': 'SUBSCRIPTION_UPDATE',
+                   'sub_uuid': uuid,
+                   'sub_device': device,
+                   'message': message}
+    event = {"type": "leaf.send_raw", "frames": encode_frames(sub_message)}
+    outbox.group_send_many([f"{hub_id}-{subscriber_uuid}" for subscriber_uuid in subscriber_uuids], event)
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from .conditions import compiled_conditions, value_cache
+from .fanout import routing
+from .outbox import Outbox
+from .registry import registry
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCommitter:
+    """
+    Collects frames from every group commit consumer on the event loop and handles them
+    together inside one transaction.
+
+    A group is closed after `window` seconds or `max_messages` frames, whichever comes first.
+    Each frame is handled with its own Outbox, and the outboxes are handed back only after the
+    transaction commits, so replies and fanout never describe uncommitted state. If the group
+    fails as a whole, its frames are retried one transaction each, so a single bad frame
+    cannot lose the other readings.
+    """
+    def __init__(self, window, max_messages):
+        self.window = window
+        self.max_messages = max_messages
+        self.loop = None
+        self.queue = None
+
+    def submit(self, consumer, content) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            loop.create_task(self.run(self.queue))
+        future = loop.create_future()
+        self.queue.put_nowait((consumer, content, future))
+        return future
+
+    async def run(self, queue):
+        while True:
+            group = [await queue.get()]
+            deadline = self.loop.time() + self.window
+            while len(group) < self.max_messages:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    group.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            outboxes = await database_sync_to_async(self.commit)(group)
+            for (consumer, content, future), outbox in zip(group, outboxes):
+                future.set_result(outbox)
+
+    @staticmethod
+    def commit(group):
+        try:
+            with transaction.atomic():
+                return [consumer.handle_frame(content) for consumer, content, future in group]
+        except Exception:
+            logger.exception(f"Group of {len(group)} frames failed, retrying each frame")
+            registry.clear()  # cached instances may hold rolled back state
+            routing.clear()
+            value_cache.clear()
+            compiled_conditions.clear()
+
+        outboxes = []
+        for consumer, content, future in group:
+            try:
+                with transaction.atomic():
+                    outboxes.append(consumer.handle_frame(content))
+            except Exception:
+                logger.exception(f"Failed to handle frame {content}")
+                registry.clear()
+                routing.clear()
+                value_cache.clear()
+                compiled_conditions.clear()
+                outboxes.append(Outbox(consumer))
+        return outboxes
+
+
+group_committer = GroupCommitter(settings.SENTINEL_GROUP_COMMIT_WINDOW, settings.SENTINEL_GROUP_COMMIT_MAX_MESSAGES)
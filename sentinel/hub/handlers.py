@@ -1,10 +1,17 @@
 from django.dispatch import receiver
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.contrib.auth.models import User
 from django.contrib.auth.models import AnonymousUser
 from guardian.models import Group as PermGroup
 from guardian.shortcuts import assign_perm, remove_perm, get_objects_for_user
-from .models import Hub, Leaf, Condition, Datastore
+from .models import Hub, Leaf, Condition, Datastore, Device, Value, NumberValue, UnitValue, BooleanValue, StringValue
+from .models import condition_changed
+from .models import Subscription, ConditionalSubscription, Predicate, NOT, AND, OR, XOR
+from .models import EqualPredicate, LessThanPredicate, GreaterThanPredicate
+from .conditions import compiled_conditions, value_cache
+from .fanout import routing
+from .history import drop_hub
+from .registry import registry
 import re
 
 
@@ -89,3 +96,70 @@ def delete_leaf_user(sender, **kwargs):
 
 
 pre_delete.connect(delete_leaf_user, sender=Leaf)
+
+
+def refresh_registry(sender, instance, **kwargs):
+    registry.refresh(instance)
+
+
+def evict_registry(sender, instance, **kwargs):
+    registry.evict(instance)
+
+
+for model in (Hub, Leaf, Device, User, Value, NumberValue, UnitValue, BooleanValue, StringValue):
+    post_save.connect(refresh_registry, sender=model)
+    post_delete.connect(evict_registry, sender=model)
+
+
+def invalidate_routing(sender, instance, **kwargs):
+    routing.invalidate(instance.hub_id)
+
+
+for model in (Subscription, ConditionalSubscription):
+    post_save.connect(invalidate_routing, sender=model)
+    post_delete.connect(invalidate_routing, sender=model)
+
+
+def refresh_value_cache(sender, instance, **kwargs):
+    compiled_conditions.apply({instance.pk: instance.value})
+
+
+def evict_value_cache(sender, instance, **kwargs):
+    value_cache.pop(instance.pk, None)
+
+
+for model in (Value, NumberValue, UnitValue, BooleanValue, StringValue):
+    post_save.connect(refresh_value_cache, sender=model)
+    post_delete.connect(evict_value_cache, sender=model)
+
+
+def clear_compiled_conditions(sender, instance, **kwargs):
+    compiled_conditions.clear()
+
+
+for model in (Predicate, NOT, AND, OR, XOR, EqualPredicate, LessThanPredicate, GreaterThanPredicate):
+    post_save.connect(clear_compiled_conditions, sender=model)
+    post_delete.connect(clear_compiled_conditions, sender=model)
+
+
+def evict_compiled_conditions(sender, instance, **kwargs):
+    if kwargs.get('created', True):  # executing a condition saves it too
+        compiled_conditions.evict_hub(instance.hub_id)
+
+
+post_save.connect(evict_compiled_conditions, sender=Condition)
+post_delete.connect(evict_compiled_conditions, sender=Condition)
+
+
+def announce_condition(sender, condition, **kwargs):
+    compiled_conditions.announce(condition)
+
+
+condition_changed.connect(announce_condition, sender=Condition)
+
+
+def drop_history(sender, instance, **kwargs):
+    drop_hub(instance.id)
+
+
+post_delete.connect(drop_history, sender=Hub)
@@ -0,0 +1,337 @@
+import atexit
+import io
+import logging
+import re
+import threading
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+
+import numpy
+from django.conf import settings
+from django.db import DataError, IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+TABLE = 'hub_devicereading'
+COLUMNS = ('hub_id', 'uuid', 'device', 'time', 'number', 'boolean', 'text')
+MONTH_PARTITION = re.compile(rf'^{TABLE}_(\d+)_(\d{{4}})(\d{{2}})$')
+AGGREGATES = ('count', 'min', 'max', 'sum', 'avg', 'last')
+MAX_BUCKETS = 10000
+CHUNK_SIZE = 10000  # raw readings reduced at a time
+BACKLOG = 10  # batches of readings kept while the database is unavailable
+
+
+def month_start(time) -> datetime:
+    return time.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(start) -> datetime:
+    return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+
+
+def hub_partition(hub_id) -> str:
+    return f"{TABLE}_{int(hub_id)}"
+
+
+def month_partition(hub_id, start) -> str:
+    return f"{hub_partition(hub_id)}_{start:%Y%m}"
+
+
+@lru_cache(maxsize=None)
+def partitioned() -> bool:
+    """Returns whether DeviceReading is partitioned, which migration 0006 only does on PostgreSQL 11 or later."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", [TABLE])
+        return cursor.fetchone()[0] == 'p'
+
+
+def create_partitions(cursor, hub_id, start):
+    """Creates the hub's partition of DeviceReading and its partition for the month from start."""
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {hub_partition(hub_id)} PARTITION OF {TABLE} "
+                   f"FOR VALUES IN ({int(hub_id)}) PARTITION BY RANGE (time)")
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {month_partition(hub_id, start)} PARTITION OF {hub_partition(hub_id)} "
+                   f"FOR VALUES FROM ('{start.isoformat()}') TO ('{next_month(start).isoformat()}')")
+
+
+def drop_hub(hub_id):
+    """Drops every reading of a deleted hub."""
+    history.discard(hub_id)
+    with connection.cursor() as cursor:
+        if partitioned():
+            cursor.execute(f"DROP TABLE IF EXISTS {hub_partition(hub_id)}")
+        else:
+            cursor.execute(f"DELETE FROM {TABLE} WHERE hub_id = %s", [hub_id])
+
+
+def drop_months(before, hub_id=None) -> list:
+    """
+    Drops the month partitions (of one hub, or every hub) that end by before, returning their names.
+
+    On an unpartitioned table the months' readings are deleted instead, and the names of the
+    partitions they would have been in are returned.
+    """
+    if not partitioned():
+        return delete_months(before, hub_id)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT tablename FROM pg_tables WHERE tablename LIKE %s", [f"{TABLE}\\_%"])
+        dropped = []
+        for table, in cursor.fetchall():
+            match = MONTH_PARTITION.match(table)
+            if not match or (hub_id is not None and int(match.group(1)) != hub_id):
+                continue
+            start = datetime(int(match.group(2)), int(match.group(3)), 1, tzinfo=timezone.utc)
+            if next_month(start) <= before:
+                cursor.execute(f"DROP TABLE {table}")
+                dropped.append(table)
+    history.forget()
+    return dropped
+
+
+def delete_months(before, hub_id=None) -> list:
+    before = month_start(before)
+    condition, params = ("time < %s", [before]) if hub_id is None else ("time < %s AND hub_id = %s", [before, hub_id])
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT DISTINCT hub_id, date_trunc('month', time AT TIME ZONE 'UTC') FROM {TABLE} "
+                       f"WHERE {condition} ORDER BY 1, 2", params)
+        months = [month_partition(hub, start) for hub, start in cursor.fetchall()]
+        cursor.execute(f"DELETE FROM {TABLE} WHERE {condition}", params)
+    return months
+
+
+def copy_field(field) -> str:
+    """Formats a field for COPY's text format."""
+    if field is None:
+        return '\\N'
+    if isinstance(field, bool):
+        return 't' if field else 'f'
+    if isinstance(field, datetime):
+        return field.isoformat()
+    return str(field).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def combine(first, second):
+    """
+    Combines two partial aggregates of the same bucket, second holding the later readings.
+
+    A partial aggregate is (bucket, count, min, max, sum, last), where bucket is the bucket's
+    start in seconds since the epoch divided by its width; min, max and sum are None for strings.
+    """
+    if first[2] is None:
+        return first[0], first[1] + second[1], None, None, None, second[5]
+    return (first[0], first[1] + second[1], min(first[2], second[2]), max(first[3], second[3]),
+            first[4] + second[4], second[5])
+
+
+def merge(partials):
+    """Combines consecutive partial aggregates of the same bucket."""
+    current = None
+    for partial in partials:
+        if current is not None and current[0] == partial[0]:
+            current = combine(current, partial)
+            continue
+        if current is not None:
+            yield current
+        current = partial
+    if current is not None:
+        yield current
+
+
+def reduce_rows(rows, width, numeric):
+    """Partially aggregates (seconds since the epoch, value) rows sorted by time, one reading at a time."""
+    for seconds, value in rows:
+        number = float(value) if numeric else None
+        yield int(seconds // width), 1, number, number, number, value
+
+
+def reduce_chunk(rows, width):
+    """Partially aggregates numeric rows sorted by time, with one vectorized reduction per aggregate."""
+    times = numpy.fromiter((seconds for seconds, value in rows), numpy.float64, len(rows))
+    values = numpy.fromiter((value for seconds, value in rows), numpy.float64, len(rows))
+    buckets = (times // width).astype(numpy.int64)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+    ends = numpy.append(starts[1:], len(rows))
+    return zip(buckets[starts].tolist(), (ends - starts).tolist(), numpy.minimum.reduceat(values, starts).tolist(),
+               numpy.maximum.reduceat(values, starts).tolist(), numpy.add.reduceat(values, starts).tolist(),
+               [rows[end - 1][1] for end in ends.tolist()])
+
+
+def raw_buckets(hub_id, uuid, device, column, start, end, width):
+    """
+    Aggregates the device's readings from start until end into buckets width seconds wide,
+    aligned to the epoch, yielding partial aggregates in time order.
+
+    Readings are streamed from the database CHUNK_SIZE at a time and each chunk of numbers or
+    booleans is reduced with NumPy.
+    """
+    from .models import DeviceReading
+    numeric = column != 'text'
+    readings = (DeviceReading.objects.filter(hub_id=hub_id, uuid=uuid, device=device, time__gte=start, time__lt=end)
+                .exclude(**{f'{column}__isnull': True}).order_by('time').values_list('time', column)
+                .iterator(chunk_size=CHUNK_SIZE))
+    rows = ((time.timestamp(), value) for time, value in readings)
+
+    def partials():
+        while True:
+            chunk = list(islice(rows, CHUNK_SIZE))
+            if not chunk:
+                return
+            if numeric:
+                yield from reduce_chunk(chunk, width)
+            else:
+                yield from reduce_rows(chunk, width, numeric)
+    return merge(partials())
+
+
+def summarize(partial, width, aggregates) -> dict:
+    bucket, count, minimum, maximum, total, last = partial
+    values = {'count': count, 'min': minimum, 'max': maximum, 'sum': total,
+              'avg': total / count if total is not None else None, 'last': last}
+    summary = {'time': datetime.fromtimestamp(bucket * width, timezone.utc).isoformat()}
+    summary.update((aggregate, values[aggregate]) for aggregate in aggregates)
+    return summary
+
+
+class HistoryBuffer:
+    """
+    Collects changed device and datastore values in memory and appends them to DeviceReading in batches.
+
+    A value is recorded once it has been written, and joins the buffer once the transaction that
+    wrote it commits, so rolled back, rejected or retried frames are not recorded. The buffer is
+    copied into the table every `interval` seconds, or as soon as `max_readings` are waiting,
+    after creating the hub and month partitions the readings fall in. An interval of 0 writes
+    each reading as it commits.
+
+    A batch the database rejects for its data is copied again one reading at a time, dropping
+    the readings it still rejects. While the database is unavailable the readings are kept for
+    the next interval, up to BACKLOG batches; the oldest are dropped beyond that. Dropped
+    readings are counted in metrics under history.dropped.
+
+    With SENTINEL_ROLLUPS set, each flush also marks the devices it wrote for the rollup
+    worker (see rollups.py).
+    """
+    def __init__(self, enabled, interval, max_readings):
+        self.enabled = enabled
+        self.interval = interval
+        self.max_readings = max_readings
+        self._lock = threading.Lock()
+        self._readings = []
+        self._partitions = set()  # (hub id, month start) partitions known to exist
+        self._timer = None
+        self._failing = False  # the last flush failed, so wait for the timer to retry
+        atexit.register(self.flush)
+
+    def record(self, hub_id, uuid, device, value, time=None):
+        if not self.enabled:
+            return
+        reading = (hub_id, uuid, device, time or timezone.now(), value.number, value.boolean, value.text)
+        transaction.on_commit(lambda: self.append(reading))
+
+    def append(self, reading):
+        with self._lock:
+            self._readings.append(reading)
+            self._trim()
+            full = not self._failing and (self.interval <= 0 or len(self._readings) >= self.max_readings)
+            if not full:
+                self._schedule()
+        if full:
+            self.flush()
+
+    def _schedule(self):
+        if self._timer is None:
+            self._timer = threading.Timer(self.interval if self.interval > 0 else 1, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _trim(self):
+        overflow = len(self._readings) - self.max_readings * BACKLOG
+        if overflow > 0:
+            del self._readings[:overflow]
+            metrics.incr('history.dropped', overflow)
+            logger.error(f"History backlog is full, dropped the {overflow} oldest readings")
+
+    def flush(self):
+        with self._lock:
+            readings, self._readings = self._readings, []
+            timer, self._timer = self._timer, None
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+        if not readings:
+            return
+        pending = deque(readings)
+        try:
+            with metrics.timed('history.flush'):
+                written = self.write(pending)
+            self._failing = False
+            metrics.incr('history.readings', written)
+            if written and settings.SENTINEL_ROLLUPS:
+                from .rollups import wake
+                wake()
+            logger.debug(f"Appended {written} readings to history")
+        except Exception:
+            logger.exception("History flush failed, keeping readings for the next interval")
+            self.forget()  # a partition may have been dropped under us
+            with self._lock:
+                self._failing = True
+                self._readings[:0] = pending
+                self._trim()
+                self._schedule()
+        finally:
+            if threading.current_thread() is timer:
+                connection.close()  # timer threads do not go through Django's connection cleanup
+
+    def write(self, pending) -> int:
+        """Copies the pending readings into the table, removing each from pending once written or dropped."""
+        try:
+            with transaction.atomic():
+                self.copy(pending)
+            written = len(pending)
+            pending.clear()
+            return written
+        except (DataError, IntegrityError):
+            logger.exception(f"History rejected a batch of {len(pending)} readings, copying them one at a time")
+            self.forget()
+        written = 0
+        while pending:
+            try:
+                with transaction.atomic():
+                    self.copy([pending[0]])
+                written += 1
+            except (DataError, IntegrityError):
+                logger.exception(f"History rejected reading {pending[0]}, dropping it")
+                metrics.incr('history.dropped')
+            pending.popleft()
+        return written
+
+    def copy(self, readings):
+        partitions = {(reading[0], month_start(reading[3])) for reading in readings}
+        rows = io.StringIO(''.join('\t'.join(map(copy_field, reading)) + '\n' for reading in readings))
+        with connection.cursor() as cursor:
+            if partitioned():
+                for hub_id, start in partitions - self._partitions:
+                    create_partitions(cursor, hub_id, start)
+            with connection.wrap_database_errors:  # Django only translates errors from execute and fetch*
+                cursor.copy_expert(f"COPY {TABLE} ({', '.join(COLUMNS)}) FROM STDIN", rows)
+            if settings.SENTINEL_ROLLUPS:
+                from .rollups import add_deltas, mark_dirty
+                mark_dirty(cursor, readings)
+                add_deltas(readings)
+        self._partitions |= partitions
+
+    def discard(self, hub_id):
+        """Drops the hub's buffered readings, so a flush does not recreate its partitions."""
+        with self._lock:
+            self._readings = [reading for reading in self._readings if reading[0] != hub_id]
+        self.forget()
+
+    def forget(self):
+        """Forgets which partitions exist, after some were dropped."""
+        self._partitions = set()
+
+
+history = HistoryBuffer(settings.SENTINEL_HISTORY, settings.SENTINEL_HISTORY_INTERVAL,
+                        settings.SENTINEL_HISTORY_MAX_READINGS)
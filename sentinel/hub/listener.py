@@ -0,0 +1,85 @@
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+
+from .conditions import compiled_conditions
+from .fanout import ROUTING_GROUP, routing
+
+logger = logging.getLogger(__name__)
+
+RENEW_INTERVAL = 3600  # seconds between renewals of the group membership, which the channel layer expires
+
+
+class ProcessListener:
+    """
+    Joins ROUTING_GROUP once per process and applies the broadcasts of the other processes to
+    this process's caches.
+
+    Every consumer that relies on the caches starts the listener on its event loop; only the
+    first start in a loop joins the group. Each broadcast is therefore received once per process
+    however many leaves are connected, and applied on the sync thread pool, as a cache miss may
+    query the database. Broadcasts are applied one at a time, in the order they arrive.
+    """
+    def __init__(self):
+        self.channel = None
+        self._loop = None
+        self._tasks = []
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        layer = get_channel_layer()
+        self.channel = await layer.new_channel()
+        await layer.group_add(ROUTING_GROUP, self.channel)
+        self._tasks = [asyncio.ensure_future(self.listen(layer, self.channel)),
+                       asyncio.ensure_future(self.renew(layer, self.channel))]
+
+    async def stop(self):
+        """Leaves the group and stops listening, before the event loop closes."""
+        if self._loop is None:
+            return
+        layer = get_channel_layer()
+        await layer.group_discard(ROUTING_GROUP, self.channel)
+        await layer.send(self.channel, {"type": "listener.stop"})  # receive() does not survive cancellation
+        listening, renewing = self._tasks
+        await listening
+        renewing.cancel()
+        self._loop = self.channel = None
+
+    async def listen(self, layer, channel):
+        apply = database_sync_to_async(self.apply)
+        while True:
+            try:
+                event = await layer.receive(channel)
+                if event['type'] == 'listener.stop':
+                    return
+                await apply(event)
+            except Exception:
+                logger.exception("Failed to apply a broadcast")
+                await asyncio.sleep(1)
+
+    @staticmethod
+    async def renew(layer, channel):
+        while True:
+            await asyncio.sleep(RENEW_INTERVAL)
+            try:
+                await layer.group_add(ROUTING_GROUP, channel)
+            except Exception:
+                logger.exception(f"Failed to renew {channel} in {ROUTING_GROUP}")
+
+    @staticmethod
+    def apply(event):
+        if event['type'] == 'routing.invalidate':
+            routing.evict(event['hub'])
+            compiled_conditions.evict_hub(event['hub'])
+        elif event['type'] == 'values.changed':
+            compiled_conditions.receive(event)
+        elif event['type'] == 'conditions.settled':
+            compiled_conditions.receive_settled(event)
+
+
+listener = ProcessListener()
@@ -0,0 +1,79 @@
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from hub.consumers import AsyncLeafConsumer
+from hub.groupcommit import GroupCommitter
+from hub.metrics import metrics
+from hub.models import Hub, Leaf
+
+
+class BenchmarkConsumer:
+    """Stands in for a connected leaf consumer; replies and sends are collected but never flushed."""
+    handle_frame = AsyncLeafConsumer.handle_frame
+
+    def __init__(self, hub, leaf_uuid):
+        self.scope = {'session': {'hub': hub.id, 'uuid': leaf_uuid}}
+        self.channel_name = f"benchmark-{leaf_uuid}"
+
+
+class Command(BaseCommand):
+    help = "Compares DEVICE_STATUS ingest throughput of per-frame commits against group commits"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--frames', type=int, default=2000)
+        parser.add_argument('--leaves', type=int, default=20)
+        parser.add_argument('--group-size', type=int, default=settings.SENTINEL_GROUP_COMMIT_MAX_MESSAGES)
+
+    def handle(self, *args, **options):
+        logging.disable(logging.INFO)  # per-frame log lines would dominate the timings
+        hub = Hub.objects.create(name="ingest-benchmark")
+        metrics.reset()
+        try:
+            consumers = [self.create_leaf(hub) for _ in range(options['leaves'])]
+            for consumer in consumers:  # create the devices
+                consumer.handle_frame(self.status(consumer, 0))
+
+            frames = self.frames(consumers, options['frames'], offset=1)
+            per_frame = self.measure(lambda: [consumer.handle_frame(content) for consumer, content in frames])
+
+            size = options['group_size']
+            frames = self.frames(consumers, options['frames'], offset=options['frames'] + 1)
+            grouped = self.measure(lambda: [GroupCommitter.commit([(consumer, content, None)
+                                                                   for consumer, content in frames[i:i + size]])
+                                            for i in range(0, len(frames), size)])
+        finally:
+            hub.delete()
+
+        self.stdout.write(f"per-frame commit: {len(frames) / per_frame:8.0f} frames/s")
+        self.stdout.write(f"group commit ({size}): {len(frames) / grouped:8.0f} frames/s")
+        self.stdout.write(f"speedup: {per_frame / grouped:.2f}x")
+        for name, timer in sorted(metrics.snapshot()['timers'].items()):
+            self.stdout.write(f"{name}: {timer['count']} handled, {timer['mean'] * 1e6:.0f} us mean")
+
+    @staticmethod
+    def create_leaf(hub):
+        leaf_uuid = str(uuid.uuid4())
+        User.objects.create_user(username=f"{hub.id}-{leaf_uuid}")
+        Leaf.objects.create(name="benchmark", model="0", uuid=leaf_uuid, last_connected=timezone.now(), hub=hub)
+        return BenchmarkConsumer(hub, leaf_uuid)
+
+    @staticmethod
+    def status(consumer, value):
+        return {'type': 'DEVICE_STATUS', 'uuid': consumer.scope['session']['uuid'], 'device': 'sensor',
+                'mode': 'IN', 'format': 'number', 'value': value}
+
+    def frames(self, consumers, count, offset):
+        return [(consumers[i % len(consumers)], self.status(consumers[i % len(consumers)], offset + i))
+                for i in range(count)]
+
+    @staticmethod
+    def measure(run):
+        start = time.perf_counter()
+        run()
+        return time.perf_counter() - start
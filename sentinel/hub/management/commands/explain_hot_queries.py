@@ -0,0 +1,104 @@
+import random
+import re
+import uuid
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from hub.models import Hub, Leaf, Device, Datastore, Subscription, ConditionalSubscription, Condition, Predicate
+from hub.models import NumberValue
+
+
+class Command(BaseCommand):
+    help = ("Runs EXPLAIN ANALYZE on the hot leaf, device and subscription lookups against a synthetic hub "
+            "and reports queries that scan large tables sequentially or exceed the time budget")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscriptions', type=int, default=100000)
+        parser.add_argument('--leaves', type=int, default=1000)
+        parser.add_argument('--devices', type=int, default=5, help="devices per leaf")
+        parser.add_argument('--conditions', type=int, default=100)
+        parser.add_argument('--budget', type=float, default=1.0, help="milliseconds allowed per query")
+        parser.add_argument('--scan-rows', type=int, default=1000,
+                            help="rows a sequential scan may filter out before it is reported")
+        parser.add_argument('--keep', action='store_true', help="keep the synthetic hub instead of rolling it back")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("EXPLAIN ANALYZE auditing needs PostgreSQL")
+
+        regressions = []
+        with transaction.atomic():
+            hub, leaves, datastore, condition = self.create_hub(options)
+            with connection.cursor() as cursor:  # planner statistics for the new rows
+                for model in (Leaf, Device, Subscription, ConditionalSubscription):
+                    cursor.execute(f'ANALYZE {model._meta.db_table}')
+
+            for name, queryset in self.hot_queries(hub, leaves, datastore, condition):
+                plan = queryset.explain(analyze=True)
+                time = float(re.search(r'Execution time: ([\d.]+) ms', plan, re.I).group(1))
+                problems = []
+                filtered = [int(rows) for rows in re.findall(r'Rows Removed by Filter: (\d+)', plan)]
+                if 'Seq Scan' in plan and max(filtered, default=0) > options['scan_rows']:
+                    problems.append("sequential scan")
+                if time > options['budget']:
+                    problems.append(f"over {options['budget']} ms budget")
+                self.stdout.write(f"{name:28} {time:8.3f} ms  {', '.join(problems) or 'ok'}")
+                if problems:
+                    regressions.append(name)
+                    self.stdout.write(plan)
+
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+        if regressions:
+            raise CommandError(f"{len(regressions)} hot queries regressed: {', '.join(regressions)}")
+
+    def create_hub(self, options):
+        hub = Hub.objects.create(name="explain-audit")
+        leaves = Leaf.objects.bulk_create(Leaf(name=f"leaf-{i}", model="0", uuid=str(uuid.uuid4()), hub=hub,
+                                               last_connected=timezone.now())
+                                          for i in range(options['leaves']))
+        device_names = [f"device-{i}" for i in range(options['devices'])]
+        values = NumberValue.objects.bulk_create(NumberValue(value=0) for _ in range(len(leaves) * len(device_names)))
+        Device.objects.bulk_create(Device(name=name, leaf=leaf, _value=values.pop(), mode='IN')
+                                   for leaf in leaves for name in device_names)
+        datastore = Datastore.objects.create(name="store", hub=hub, _value=NumberValue.objects.create(value=0))
+
+        content_type = ContentType.objects.get_for_model(Subscription)
+        targets = [(leaf.uuid, name) for leaf in leaves for name in device_names + ['leaf']] + [('datastore', 'store')]
+        Subscription.objects.bulk_create(
+            (Subscription(hub=hub, subscriber_uuid=random.choice(leaves).uuid, target_uuid=target_uuid,
+                          target_device=target_device, polymorphic_ctype=content_type)
+             for target_uuid, target_device in (random.choice(targets) for _ in range(options['subscriptions']))),
+            batch_size=5000)
+
+        condition = None
+        for i in range(options['conditions']):
+            predicate = Predicate.objects.create()
+            condition = Condition.objects.create(name=f"condition-{i}", predicate=predicate, hub=hub)
+            target_uuid, target_device = random.choice(targets)
+            ConditionalSubscription.objects.create(hub=hub, target_uuid=target_uuid, target_device=target_device,
+                                                   condition=condition)
+        return hub, leaves, datastore, condition
+
+    @staticmethod
+    def hot_queries(hub, leaves, datastore, condition):
+        leaf = random.choice(leaves)
+        device = leaf.devices.first()
+        subscription = hub.subscriptions.filter(target_uuid=leaf.uuid).first() or Subscription(subscriber_uuid='')
+        return [
+            ("leaf lookup", hub.leaves.filter(uuid=leaf.uuid)),
+            ("device lookup", leaf.devices.filter(name=device.name)),
+            ("datastore lookup", hub.datastores.filter(name=datastore.name)),
+            ("device fanout", hub.subscriptions.non_polymorphic().filter(
+                target_uuid=leaf.uuid, target_device__in=[device.name, 'leaf'])),
+            ("datastore fanout", hub.subscriptions.non_polymorphic().filter(
+                target_uuid='datastore', target_device=datastore.name)),
+            ("subscriber lookup", hub.subscriptions.non_polymorphic().filter(
+                subscriber_uuid=subscription.subscriber_uuid, target_uuid=leaf.uuid, target_device='leaf')),
+            ("hub conditions", Condition.objects.filter(hub=hub)),
+            ("touched conditions", Condition.objects.filter(pk__in=[condition.pk]).order_by('pk')),
+        ]
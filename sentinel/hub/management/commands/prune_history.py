@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from hub.history import drop_months, month_start
+
+
+class Command(BaseCommand):
+    help = "Drops the monthly DeviceReading partitions older than the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365, help="keep readings from at least this many days")
+        parser.add_argument('--hub', type=int, default=None, help="only prune this hub's readings")
+
+    def handle(self, *args, **options):
+        before = month_start(timezone.now() - timedelta(days=options['days']))
+        dropped = drop_months(before, options['hub'])
+        for table in dropped:
+            self.stdout.write(f"Dropped {table}")
+        self.stdout.write(f"Dropped {len(dropped)} partitions ending by {before:%Y-%m-%d}")
@@ -4,17 +4,20 @@ from enum import Enum
 
 # from channels import Group
 from django.contrib.auth import authenticate
-from asgiref.sync import async_to_sync
-
+from . import outbox
 from .models import Hub
+from .metrics import metrics
 from .utils import InvalidLeaf, validate_uuid, InvalidDevice, PermissionDenied, InvalidMessage
 
 logger = logging.getLogger(__name__)
 
+API_VERSION = '1.1.0'  # protocol version of this hub, sent to leaves in CONFIG_COMPLETE
+
 
-class MessageType(Enum):
+class MessageType(str, Enum):
     Config = 'CONFIG'
     DeviceStatus = 'DEVICE_STATUS'
+    DeviceStatusBatch = 'DEVICE_STATUS_BATCH'
     Subscribe = 'SUBSCRIBE'
     Unsubscribe = 'UNSUBSCRIBE'
     DatastoreCreate = 'DATASTORE_CREATE'
@@ -26,11 +29,70 @@ class MessageType(Enum):
     GetDevice = 'GET_DEVICE'
 
 
+def each(*fields):
+    """Field check for a list of objects that must each contain fields."""
+    def check(items):
+        return type(items) == list and all(type(item) == dict and all(field in item for field in fields)
+                                           for item in items)
+    return check
+
+
+def compile_validator(required, checks):
+    required = ('uuid',) + tuple(required) + tuple(checks)
+    checks = (('uuid', validate_uuid),) + tuple(checks.items())
+
+    def validate(data):
+        for field in required:
+            if field not in data:
+                return False
+        for field, check in checks:
+            if not check(data[field]):
+                return False
+        return True
+    return validate
+
+
+class MessageTypeRegistry:
+    """
+    Maps each message type to its handler and a validator compiled from its field spec.
+
+    Handlers register themselves with the register decorator, so plugins can add message
+    types without touching the dispatcher. Dispatch time is recorded per type in metrics
+    under dispatch.<TYPE>.
+    """
+    def __init__(self):
+        self.types = {}
+
+    def register(self, type, *required, **checks):
+        """Registers the decorated handler for type; required fields must be present and checks must pass."""
+        type = getattr(type, 'value', type)
+        validator = compile_validator(required, checks)
+        timer = f"dispatch.{type}"
+
+        def decorator(handler):
+            self.types[type] = (handler, validator, timer)
+            return handler
+        return decorator
+
+    def validate(self, data):
+        entry = self.types.get(data.get('type'))
+        return entry is not None and entry[1](data)
+
+    def dispatch(self, message):
+        handler, validator, timer = self.types[message.type]
+        with metrics.timed(timer):
+            return handler(message)
+
+
+message_types = MessageTypeRegistry()
+
+
 class Message:
     def __init__(self, data):
         self.data = data
+        self.type = data.get('type')
 
-        self.hub = Hub.objects.get(id=data['hub'])
+        self.hub = Hub.resolve(data['hub'])
         try:
             self.leaf = self.hub.get_leaf(data['uuid'])
             self.user = self.leaf.get_user()
@@ -38,56 +100,12 @@ class Message:
             if self.type != MessageType.Config:
                 raise e
 
-    @property
-    def type(self):
-        return MessageType(self.data['type'])
-
     @property
     def hub_id(self):
         return self.data['hub']
 
     def validate(self):
-        valid = self.type in MessageType
-        if not valid:
-            return False
-        elif self.type == MessageType.Config:
-            valid = valid and 'name' in self.data
-            valid = valid and 'model' in self.data
-            valid = valid and 'token' in self.data
-            valid = valid and 'api_version' in self.data
-        elif self.type == MessageType.DeviceStatus:
-            valid = valid and 'device' in self.data
-            valid = valid and 'mode' in self.data
-            valid = valid and 'format' in self.data
-            valid = valid and 'value' in self.data
-        elif self.type == MessageType.Subscribe or self.type == MessageType.Unsubscribe:
-            valid = valid and 'sub_uuid' in self.data and validate_uuid(self.data['sub_uuid'])
-            valid = valid and 'sub_device' in self.data
-        elif self.type == MessageType.DatastoreCreate:
-            valid = valid and 'name' in self.data
-            valid = valid and 'value' in self.data
-            valid = valid and 'format' in self.data
-        elif self.type == MessageType.DatastoreGet:
-            return valid and 'name' in self.data
-        elif self.type == MessageType.DatastoreSet:
-            valid = valid and 'name' in self.data
-            valid = valid and 'value' in self.data
-        elif self.type == MessageType.DatastoreDelete:
-            valid = valid and 'name' in self.data
-        elif self.type == MessageType.ConditionCreate:
-            valid = valid and 'name' in self.data
-            valid = valid and 'predicate' in self.data
-            valid = valid and 'actions' in self.data
-            if valid and type(self.data['actions']) == list:
-                for action in self.data['actions']:
-                    valid = valid and 'target' in action
-                    valid = valid and 'device' in action
-                    valid = valid and 'value' in action
-        elif self.type == MessageType.ConditionDelete:
-            valid = valid and 'name' in self.data
-        else:
-            return False
-        return valid and 'uuid' in self.data and validate_uuid(self.data['uuid'])
+        return message_types.validate(self.data)
 
     def reply(self, response):
         pass
@@ -162,10 +180,10 @@ class MessageV2(Message):
         return self.session[name]
 
     def reply(self, response):
-        self.consumer.send_json(response)
+        outbox.reply(self.consumer, response)
 
     def register_leaf(self, leaf):
-        async_to_sync(self.consumer.channel_layer.group_add)(f"{leaf.hub.id}-{leaf.uuid}", self.consumer.channel_name)
+        outbox.group_add(f"{leaf.hub.id}-{leaf.uuid}", self.consumer.channel_name)
 
     def unregister_leaf(self, leaf):
-        async_to_sync(self.consumer.channel_layer.group_discard)(f"{leaf.hub.id}-{leaf.uuid}", self.consumer.channel_name)
+        outbox.group_discard(f"{leaf.hub.id}-{leaf.uuid}", self.consumer.channel_name)
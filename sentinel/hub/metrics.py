@@ -0,0 +1,44 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Process-wide counters and timers, keyed by dotted names such as dispatch.DEVICE_STATUS."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(lambda: [0, 0.0])
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self.timers[name]
+            timer[0] += 1
+            timer[1] += seconds
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            timers = {name: {'count': count, 'total': total, 'mean': total / count}
+                      for name, (count, total) in self.timers.items()}
+            return {'counters': dict(self.counters), 'timers': timers}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timers.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,33 @@
+# Generated by Django 2.1.3 on 2026-10-17 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0002_auto_20180819_1800'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hub',
+            name='hub_burst',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='hub',
+            name='hub_rate_limit',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='hub',
+            name='leaf_burst',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='hub',
+            name='leaf_rate_limit',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
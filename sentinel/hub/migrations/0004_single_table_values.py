@@ -0,0 +1,120 @@
+# Generated by Django 2.1.3 on 2026-10-17 18:51
+
+from django.db import migrations, models
+
+
+CHILD_TABLES = (('NumberValue', 'number', 'number'),
+                ('UnitValue', 'number+units', 'number'),
+                ('BooleanValue', 'bool', 'boolean'),
+                ('StringValue', 'string', 'text'))
+
+
+def copy_values(apps, schema_editor):
+    Value = apps.get_model('hub', 'Value')
+    for model_name, format, column in CHILD_TABLES:
+        for child in apps.get_model('hub', model_name).objects.all():
+            fields = {'format': format, column: float(child.value) if column == 'number' else child.value}
+            if format == 'number+units':
+                fields['units'] = child.old_units
+            Value.objects.filter(pk=child.value_ptr_id).update(**fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0003_hub_rate_limits'),
+    ]
+
+    operations = [
+        migrations.RenameField(  # frees the name for the units column on value
+            model_name='unitvalue',
+            old_name='units',
+            new_name='old_units',
+        ),
+        migrations.AddField(
+            model_name='value',
+            name='boolean',
+            field=models.NullBooleanField(),
+        ),
+        migrations.AddField(
+            model_name='value',
+            name='format',
+            field=models.CharField(choices=[('number', 'Number'), ('number+units', 'Number with units'), ('bool', 'Boolean'), ('string', 'String')], default='string', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='value',
+            name='number',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='value',
+            name='text',
+            field=models.CharField(blank=True, max_length=250, null=True),
+        ),
+        migrations.AddField(
+            model_name='value',
+            name='units',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+        migrations.RunPython(copy_values),
+        migrations.DeleteModel(
+            name='BooleanValue',
+        ),
+        migrations.DeleteModel(
+            name='NumberValue',
+        ),
+        migrations.DeleteModel(
+            name='StringValue',
+        ),
+        migrations.DeleteModel(
+            name='UnitValue',
+        ),
+        migrations.AlterModelOptions(
+            name='value',
+            options={},
+        ),
+        migrations.RemoveField(
+            model_name='value',
+            name='polymorphic_ctype',
+        ),
+        migrations.CreateModel(
+            name='BooleanValue',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+            },
+            bases=('hub.value',),
+        ),
+        migrations.CreateModel(
+            name='NumberValue',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+            },
+            bases=('hub.value',),
+        ),
+        migrations.CreateModel(
+            name='StringValue',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+            },
+            bases=('hub.value',),
+        ),
+        migrations.CreateModel(
+            name='UnitValue',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+            },
+            bases=('hub.value',),
+        ),
+    ]
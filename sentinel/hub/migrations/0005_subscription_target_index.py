@@ -0,0 +1,17 @@
+# Generated by Django 2.1.3 on 2026-10-17 19:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0004_single_table_values'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['hub', 'target_uuid', 'target_device', 'subscriber_uuid'], name='hub_subscri_hub_id_bf9007_idx'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 2.1.3 on 2026-10-17 20:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# partitioned by hub, and each hub's partition by month; history.create_partitions adds them.
+# Declarative partitioning needs PostgreSQL 11, older servers get a plain table.
+CREATE_TABLE = """
+CREATE TABLE hub_devicereading (
+    id bigserial NOT NULL,
+    hub_id integer NOT NULL,
+    uuid varchar(36) NOT NULL,
+    device varchar(100) NOT NULL,
+    time timestamp with time zone NOT NULL,
+    number double precision NULL,
+    boolean boolean NULL,
+    text varchar(250) NULL,
+    {primary_key}
+){partitioning};
+CREATE INDEX hub_reading_device_time_idx ON hub_devicereading (hub_id, uuid, device, time);
+"""
+
+
+def create_table(apps, schema_editor):
+    if schema_editor.connection.pg_version >= 110000:
+        sql = CREATE_TABLE.format(primary_key="PRIMARY KEY (id, hub_id, time)", partitioning=" PARTITION BY LIST (hub_id)")
+    else:
+        sql = CREATE_TABLE.format(primary_key="PRIMARY KEY (id)", partitioning="")
+    schema_editor.execute(sql)
+
+
+def drop_table(apps, schema_editor):
+    schema_editor.execute("DROP TABLE hub_devicereading")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0005_subscription_target_index'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_table, drop_table),
+            ],
+            state_operations=[
+                migrations.CreateModel(
+                    name='DeviceReading',
+                    fields=[
+                        ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                        ('uuid', models.CharField(max_length=36)),
+                        ('device', models.CharField(max_length=100)),
+                        ('time', models.DateTimeField()),
+                        ('number', models.FloatField(null=True)),
+                        ('boolean', models.NullBooleanField()),
+                        ('text', models.CharField(max_length=250, null=True)),
+                        ('hub', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='hub.Hub')),
+                    ],
+                ),
+                migrations.AddIndex(
+                    model_name='devicereading',
+                    index=models.Index(fields=['hub', 'uuid', 'device', 'time'], name='hub_reading_device_time_idx'),
+                ),
+            ],
+        ),
+    ]
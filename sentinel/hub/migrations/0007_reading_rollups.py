@@ -0,0 +1,50 @@
+# Generated by Django 2.1.3 on 2026-10-17 20:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0006_device_reading'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadingRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.CharField(max_length=36)),
+                ('device', models.CharField(max_length=100)),
+                ('width', models.IntegerField()),
+                ('bucket', models.DateTimeField()),
+                ('count', models.IntegerField()),
+                ('min', models.FloatField()),
+                ('max', models.FloatField()),
+                ('sum', models.FloatField()),
+                ('last', models.FloatField()),
+                ('hub', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='hub.Hub')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.CharField(max_length=36)),
+                ('device', models.CharField(max_length=100)),
+                ('rolled_until', models.DateTimeField(null=True)),
+                ('dirty_from', models.DateTimeField(null=True)),
+                ('dirty_until', models.DateTimeField(null=True)),
+                ('hub', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='hub.Hub')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='rollupwatermark',
+            unique_together={('hub', 'uuid', 'device')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='readingrollup',
+            unique_together={('hub', 'uuid', 'device', 'width', 'bucket')},
+        ),
+    ]
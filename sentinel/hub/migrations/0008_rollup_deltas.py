@@ -0,0 +1,51 @@
+# Generated by Django 2.1.3 on 2026-10-17 23:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+# rollups written before last_time was kept are rebuilt from raw history on the worker's next pass
+REBUILD_ROLLUPS = """
+DELETE FROM hub_readingrollup;
+UPDATE hub_rollupwatermark SET dirty_from = COALESCE(dirty_from, rolled_until),
+                               dirty_until = COALESCE(dirty_until, rolled_until),
+                               rolled_until = NULL;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0007_reading_rollups'),
+    ]
+
+    operations = [
+        migrations.RunSQL(REBUILD_ROLLUPS, migrations.RunSQL.noop),
+        migrations.AddField(
+            model_name='readingrollup',
+            name='last_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='RollupDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.CharField(max_length=36)),
+                ('device', models.CharField(max_length=100)),
+                ('bucket', models.DateTimeField()),
+                ('count', models.IntegerField()),
+                ('min', models.FloatField()),
+                ('max', models.FloatField()),
+                ('sum', models.FloatField()),
+                ('last', models.FloatField()),
+                ('last_time', models.DateTimeField()),
+                ('hub', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='hub.Hub')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='rollupdelta',
+            index=models.Index(fields=['hub', 'uuid', 'device'], name='hub_rollup_delta_device_idx'),
+        ),
+    ]
@@ -1,21 +1,68 @@
-from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.db import models
+from django.dispatch import Signal
 from django.contrib.auth.models import User
 from django.utils import timezone
 from polymorphic.models import PolymorphicModel
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from types import SimpleNamespace
+from . import outbox
+from .actions import apply_actions, run_actions
+from .cascade import cascade
+from .conditions import compiled_conditions, value_cache, Constant, Not, Combine
+from .fanout import routing, send_update
+from .history import history
+from .metrics import metrics
+from .registry import registry
+from .writebehind import write_behind
 import logging
+import functools
 import json
+import operator
 
 logger = logging.getLogger(__name__)
 
-class Value(PolymorphicModel):
-    value = None
-    format = None
+class Value(models.Model):
+    """
+    A device, datastore or literal value, stored in a single row.
+
+    The format picks which typed column holds the value: numbers (with or without units) use
+    number, booleans use boolean and strings use text. NumberValue, UnitValue, BooleanValue and
+    StringValue are proxies that only preset the format.
+    """
+    FORMATS = (('number', 'Number'), ('number+units', 'Number with units'), ('bool', 'Boolean'),
+               ('string', 'String'))
+    COLUMNS = {'number': 'number', 'number+units': 'number', 'bool': 'boolean', 'string': 'text'}
+    DECIMAL_PLACES = 4  # precision readings are compared at
+
+    format = models.CharField(choices=FORMATS, max_length=12, default='string')
+    number = models.FloatField(null=True, blank=True)
+    boolean = models.NullBooleanField()
+    text = models.CharField(max_length=250, null=True, blank=True)
+    units = models.CharField(max_length=10, null=True, blank=True)
+
+    proxy_format = None
+
+    def __init__(self, *args, **kwargs):
+        if not args and self.proxy_format:
+            kwargs.setdefault('format', self.proxy_format)
+        super().__init__(*args, **kwargs)
+
+    @property
+    def column(self):
+        return self.COLUMNS.get(self.format, 'text')
+
+    @property
+    def value(self):
+        return getattr(self, self.column)
+
+    @value.setter
+    def value(self, value):
+        setattr(self, self.column, value)
 
     def __repr__(self):
+        if self.format == 'number+units':
+            return "{}{}".format(self.value, self.units)
         return str(self.value)
 
     def __str__(self):
@@ -27,45 +74,54 @@ class Value(PolymorphicModel):
         else:
             return self.value
 
+    def normalize(self, raw):
+        """Coerces a reading to the type this value stores, so an unchanged reading compares equal."""
+        if self.column == 'boolean' and isinstance(raw, str) and raw.lower() in ('true', 'false'):
+            raw = raw.lower() == 'true'
+        try:
+            value = self._meta.get_field(self.column).to_python(raw)
+        except ValidationError:
+            return raw  # left for the database to reject, as before
+        if self.column == 'number' and value is not None:
+            value = round(value, self.DECIMAL_PLACES)
+        return value
+
 
 class StringValue(Value):
-    value = models.CharField(max_length=250)
+    proxy_format = 'string'
 
-    @property
-    def format(self):
-        return "string"
+    class Meta:
+        proxy = True
 
 
 class NumberValue(Value):
-    value = models.DecimalField(max_digits=15, decimal_places=4)
+    proxy_format = 'number'
 
-    @property
-    def format(self):
-        return "number"
+    class Meta:
+        proxy = True
 
 
 class UnitValue(Value):
-    value = models.DecimalField(max_digits=15, decimal_places=4)
-    units = models.CharField(max_length=10)
-
-    @property
-    def format(self):
-        return "number+units"
+    proxy_format = 'number+units'
 
-    def __repr__(self):
-        return "{}{}".format(self.value, self.units)
+    class Meta:
+        proxy = True
 
 
 class BooleanValue(Value):
-    value = models.BooleanField()
+    proxy_format = 'bool'
 
-    @property
-    def format(self):
-        return "bool"
+    class Meta:
+        proxy = True
 
 
 class Hub(models.Model):
     name = models.CharField(max_length=100)
+    # telemetry rate limits in messages per second; None falls back to the SENTINEL_* settings
+    leaf_rate_limit = models.FloatField(null=True, blank=True)
+    leaf_burst = models.PositiveIntegerField(null=True, blank=True)
+    hub_rate_limit = models.FloatField(null=True, blank=True)
+    hub_burst = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return repr(self)
@@ -73,27 +129,34 @@ class Hub(models.Model):
     def __repr__(self):
         return f"{self.name} - {self.id}"
 
+    @classmethod
+    def resolve(cls, id) -> 'Hub':
+        hub = registry.get(('hub', id))
+        if hub is None:
+            hub = registry.add(('hub', id), cls.objects.get(id=id))
+        return hub
+
     def get_device(self, uuid, device):
-        from .utils import InvalidLeaf, InvalidDevice
+        from .utils import InvalidDevice
         try:
             if uuid == 'datastore':
                 return self.datastores.get(name=device)
             else:
-                return self.leaves.get(uuid=uuid).get_device(device, False)
-        except Leaf.DoesNotExist:
-            raise InvalidLeaf(uuid)
+                return self.get_leaf(uuid).get_device(device, False)
         except Datastore.DoesNotExist:
             raise InvalidDevice(SimpleNamespace(uuid='datastore'), SimpleNamespace(name=device), InvalidDevice.UNKNOWN)
         except Device.DoesNotExist:
-            raise InvalidDevice(self.leaves.get(uuid=uuid), SimpleNamespace(name=device), InvalidDevice.UNKNOWN)
+            raise InvalidDevice(self.get_leaf(uuid), SimpleNamespace(name=device), InvalidDevice.UNKNOWN)
 
     def get_leaf(self, uuid: str) -> 'Leaf':
         from .utils import InvalidLeaf
-        leaf = self.leaves.filter(uuid=uuid)
-        if leaf.exists():
-            return leaf.first()
-        else:
-            raise InvalidLeaf(uuid)
+        leaf = registry.get(('leaf', self.id, uuid))
+        if leaf is None:
+            leaf = self.leaves.filter(uuid=uuid).first()
+            if leaf is None:
+                raise InvalidLeaf(uuid)
+            registry.add(('leaf', self.id, uuid), leaf)
+        return leaf
 
 
 class Leaf(models.Model):
@@ -101,6 +164,7 @@ class Leaf(models.Model):
     model = models.CharField(max_length=100)
     uuid = models.CharField(max_length=36)
     api_version = models.CharField(max_length=10, default="0.1.0")
+    SET_OUTPUTS_VERSION = (1, 1, 0)  # first api_version that understands SET_OUTPUTS
     is_connected = models.BooleanField(default=True)
     last_connected = models.DateTimeField()
     last_updated = models.DateTimeField(default=timezone.now)
@@ -110,8 +174,18 @@ class Leaf(models.Model):
         unique_together = (('uuid', 'hub'),)
 
     def update_time(self):
-        self.last_updated = timezone.now()
-        self.save()
+        """
+        Records a reading from this leaf. last_updated is always current in memory but written at
+        most once per SENTINEL_LAST_UPDATED_INTERVAL, as a single column UPDATE that skips the save
+        signals (and with them the dashboard bindings).
+        """
+        now = timezone.now()
+        self.last_updated = now
+        persisted = getattr(self, '_last_updated_persisted', None)
+        if persisted is not None and (now - persisted).total_seconds() < settings.SENTINEL_LAST_UPDATED_INTERVAL:
+            return
+        Leaf.objects.filter(pk=self.pk).update(last_updated=now)
+        self._last_updated_persisted = now
 
     def set_name(self, name: str):
         message = self.message_template
@@ -134,6 +208,28 @@ class Leaf(models.Model):
         message["value"] = value
         self.send_message(message)
 
+    def send_outputs(self, messages):
+        """
+        Sends SET_OUTPUT and CHANGE_OUTPUT messages for this leaf, with the SET_OUTPUTs combined into
+        one SET_OUTPUTS message for leaves whose api_version supports it.
+        """
+        outputs = [message for message in messages if message['type'] == 'SET_OUTPUT']
+        if len(outputs) > 1 and self.api_tuple >= self.SET_OUTPUTS_VERSION:
+            self.send_message({'type': 'SET_OUTPUTS',
+                               'uuid': self.uuid,
+                               'outputs': [{field: message[field] for field in ('device', 'value', 'format')}
+                                           for message in outputs]})
+            messages = [message for message in messages if message['type'] != 'SET_OUTPUT']
+        for message in messages:
+            self.send_message(message)
+
+    @property
+    def api_tuple(self):
+        try:
+            return tuple(int(part) for part in self.api_version.split('.'))
+        except ValueError:
+            return ()
+
     def get_option(self, device: str, option: str, update=True):
         if update:
             self.refresh_option(device, option)
@@ -148,7 +244,12 @@ class Leaf(models.Model):
     def get_device(self, device: str, update=True) -> 'Device':
         if update:
             self.refresh_device(device)
-        return self.devices.get(name=device)
+        key = ('device', self.hub_id, self.uuid, device)
+        cached = registry.get(key)
+        if cached is None:
+            cached = self.devices.get(name=device)
+            registry.add(key, cached, cached._value)
+        return cached
 
     def get_name(self) -> str:
         return self.name
@@ -182,29 +283,39 @@ class Leaf(models.Model):
         self.send_message(message)
 
     def send_message(self, message: dict) -> None:
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"{self.hub.id}-{self.uuid}",
-            { "type": "leaf.send", "message": message}
-        )
+        outbox.group_send(f"{self.hub.id}-{self.uuid}", {"type": "leaf.send", "message": message})
         logger.info(f"{self.hub.id} -- <{self.uuid}> sent: {message}")
         
 
     def send_subscriber_update(self, device):
-        seen_devices = set()
-        message = device.status_update_dict
-
-        subscriptions = self.hub.subscriptions.filter(target_uuid=self.uuid)
-        for subscription in subscriptions.filter(target_device=device.name):
-            seen_devices.add(subscription.subscriber_uuid)
-            subscription.handle_update(self.uuid, device.name, message)
-        # send messages to whole leaf subscribers
-        for subscription in subscriptions.filter(target_device="leaf"):
-            if subscription.subscriber_uuid not in seen_devices:
-                subscription.handle_update(self.uuid, 'leaf', message)
+        self.send_subscriber_updates([device])
+
+    def send_subscriber_updates(self, devices):
+        if not devices:
+            return
+        leaf_subscriptions = routing.subscriptions(self.hub, self.uuid, 'leaf')
+        for device in devices:
+            subscribers = []
+            message = device.status_update_dict
+            for subscription in routing.subscriptions(self.hub, self.uuid, device.name):
+                if isinstance(subscription, ConditionalSubscription):
+                    continue  # conditions are found through their values below
+                subscribers.append(subscription.subscriber_uuid)
+            send_update(self.hub_id, subscribers, self.uuid, device.name, message)
+            # send messages to whole leaf subscribers
+            seen_devices = set(subscribers)
+            send_update(self.hub_id, [subscription.subscriber_uuid for subscription in leaf_subscriptions
+                                      if subscription.subscriber_uuid not in seen_devices],
+                        self.uuid, 'leaf', message)
+
+        # conditions are evaluated once, after every device in the update has its new value
+        execute_conditions(self.hub_id, [device._value for device in devices])
 
     def get_user(self):
-        return User.objects.get(username=self.username)
+        user = registry.get(('user', self.username))
+        if user is None:
+            user = registry.add(('user', self.username), User.objects.get(username=self.username))
+        return user
 
     @property
     def username(self):
@@ -247,11 +358,31 @@ class Device(models.Model):
 
     @value.setter
     def value(self, new_value):
+        if self.stage_value(new_value):
+            if write_behind.enabled:
+                self.leaf.last_updated = timezone.now()
+                write_behind.stage(self)
+                self.record_history()
+                self.leaf.send_subscriber_update(self)
+            else:
+                self._value.save()
+                self.record_history()
+                self.leaf.send_subscriber_update(self)
+                self.leaf.update_time()
+
+    def stage_value(self, new_value) -> bool:
+        """Sets the value in memory only, returning whether it changed."""
+        new_value = self._value.normalize(new_value)
         if new_value != self.value:
             self._value.value = new_value
-            self._value.save()
-            self.leaf.send_subscriber_update(self)
-            self.leaf.update_time()
+            value_cache.set(self._value)
+            return True
+        metrics.incr('values.suppressed')
+        return False
+
+    def record_history(self):
+        """Records the written value in the device's history once the transaction commits."""
+        history.record(self.leaf.hub_id, self.leaf.uuid, self.name, self._value)
 
     @property
     def status_update_dict(self):
@@ -259,7 +390,7 @@ class Device(models.Model):
             'type': 'DEVICE_STATUS',
             'uuid': self.leaf.uuid,
             'device': self.name,
-            'value': self.value,
+            'value': self._value.to_json(),
             'format': self.format,
         }
         if self.format == 'units':
@@ -272,10 +403,11 @@ class Device(models.Model):
 
     @staticmethod
     def create_from_message(message, hub):
+        from .utils import InvalidLeaf
         try:
             uuid = message['uuid']
-            leaf = hub.leaves.get(uuid=uuid)
-        except ObjectDoesNotExist:
+            leaf = hub.get_leaf(uuid)
+        except InvalidLeaf:
             return
         except KeyError:
             return
@@ -313,12 +445,12 @@ class Subscription(PolymorphicModel):
     target_device = models.CharField(max_length=100)
     hub = models.ForeignKey(Hub, related_name="subscriptions", on_delete=models.CASCADE)
 
+    class Meta(PolymorphicModel.Meta):
+        # fanout looks subscriptions up by target; subscribe/unsubscribe add the subscriber
+        indexes = [models.Index(fields=['hub', 'target_uuid', 'target_device', 'subscriber_uuid'])]
+
     def handle_update(self, uuid, device, message):
-        sub_message = {'type': 'SUBSCRIPTION_UPDATE',
-                       'sub_uuid': uuid,
-                       'sub_device': device,
-                       'message': message}
-        self.hub.get_leaf(self.subscriber_uuid).send_message(sub_message)
+        send_update(self.hub_id, [self.subscriber_uuid], uuid, device, message)
 
 
 class Datastore(models.Model):
@@ -340,33 +472,133 @@ class Datastore(models.Model):
 
     @value.setter
     def value(self, new_value):
-        if new_value != self.value:
-            self._value.value = new_value
+        if self.stage_value(new_value):
             self._value.save()
-            message = {
-                'type': 'DEVICE_STATUS',
-                'value': self.value,
-                'format': self.format,
-                'uuid': 'datastore',
-                'device': self.name
-            }
-            subscriptions = self.hub.subscriptions.filter(target_uuid="datastore", target_device=self.name)
-            for subscription in subscriptions:
-                subscription.handle_update("datastore", self.name, message)
-            self.last_updated = timezone.now()
+            self.record_history()
+            self.send_subscriber_update()
             self.save()
 
+    def stage_value(self, new_value) -> bool:
+        """Sets the value and last_updated in memory only, returning whether the value changed."""
+        new_value = self._value.normalize(new_value)
+        if new_value == self.value:
+            metrics.incr('values.suppressed')
+            return False
+        self._value.value = new_value
+        value_cache.set(self._value)
+        self.last_updated = timezone.now()
+        return True
+
+    def record_history(self):
+        """Records the written value in the datastore's history once the transaction commits."""
+        history.record(self.hub_id, 'datastore', self.name, self._value, self.last_updated)
+
+    def send_subscriber_update(self):
+        message = {
+            'type': 'DEVICE_STATUS',
+            'value': self._value.to_json(),
+            'format': self.format,
+            'uuid': 'datastore',
+            'device': self.name
+        }
+        subscriptions = routing.subscriptions(self.hub, "datastore", self.name)
+        send_update(self.hub_id, [subscription.subscriber_uuid for subscription in subscriptions
+                                  if not isinstance(subscription, ConditionalSubscription)],
+                    "datastore", self.name, message)
+        execute_conditions(self.hub_id, [self._value])
+
     def refresh_from_db(self, using=None, fields=None):
         self._value.refresh_from_db()
         return super().refresh_from_db(using=using, fields=fields)
 
 
+class DeviceReading(models.Model):
+    """
+    A past value of a device (or, with uuid 'datastore', a datastore), appended by history.HistoryBuffer.
+
+    Rows are never updated. The table is partitioned by hub and then by month (see history.py),
+    so it has no foreign keys and old months are dropped a partition at a time.
+    """
+    id = models.BigAutoField(primary_key=True)
+    hub = models.ForeignKey(Hub, related_name='+', on_delete=models.DO_NOTHING, db_constraint=False, db_index=False)
+    uuid = models.CharField(max_length=36)
+    device = models.CharField(max_length=100)
+    time = models.DateTimeField()
+    number = models.FloatField(null=True)
+    boolean = models.NullBooleanField()
+    text = models.CharField(max_length=250, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['hub', 'uuid', 'device', 'time'], name='hub_reading_device_time_idx')]
+
+
+class ReadingRollup(models.Model):
+    """The count, min, max, sum and last of a device's numeric readings in one bucket `width` seconds wide."""
+    hub = models.ForeignKey(Hub, related_name='+', on_delete=models.CASCADE)
+    uuid = models.CharField(max_length=36)
+    device = models.CharField(max_length=100)
+    width = models.IntegerField()
+    bucket = models.DateTimeField()
+    count = models.IntegerField()
+    min = models.FloatField()
+    max = models.FloatField()
+    sum = models.FloatField()
+    last = models.FloatField()
+    last_time = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('hub', 'uuid', 'device', 'width', 'bucket'),)
+
+
+class RollupDelta(models.Model):
+    """
+    The aggregates of the readings one history flush wrote to a minute bucket, waiting for the
+    rollup worker to merge them into the device's ReadingRollups (see rollups.py).
+    """
+    hub = models.ForeignKey(Hub, related_name='+', on_delete=models.CASCADE)
+    uuid = models.CharField(max_length=36)
+    device = models.CharField(max_length=100)
+    bucket = models.DateTimeField()
+    count = models.IntegerField()
+    min = models.FloatField()
+    max = models.FloatField()
+    sum = models.FloatField()
+    last = models.FloatField()
+    last_time = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['hub', 'uuid', 'device'], name='hub_rollup_delta_device_idx')]
+
+
+class RollupWatermark(models.Model):
+    """
+    How far a device's rollups are complete (see rollups.py).
+
+    Once rolled_until is set the device's rollups cover all of its readings, except those from
+    dirty_from until dirty_until, which were flushed to history since and whose RollupDeltas
+    wait to be merged.
+    """
+    hub = models.ForeignKey(Hub, related_name='+', on_delete=models.CASCADE)
+    uuid = models.CharField(max_length=36)
+    device = models.CharField(max_length=100)
+    rolled_until = models.DateTimeField(null=True)
+    dirty_from = models.DateTimeField(null=True)
+    dirty_until = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = (('hub', 'uuid', 'device'),)
+
+
 class Predicate(PolymorphicModel):
     operator = models.ForeignKey('Multivariate', on_delete=models.CASCADE, related_name="operands", null=True)
 
     def evaluate(self):
         return True
 
+    def compile(self, compiled):
+        """Returns this predicate as a tree of conditions.Node, evaluated without touching the database."""
+        return Constant(True)
+
     def to_representation(self):
         return True
 
@@ -377,6 +609,9 @@ class NOT(Predicate):
     def evaluate(self):
         return not self.predicate.evaluate()
 
+    def compile(self, compiled):
+        return Not(self.predicate.compile(compiled))
+
     def delete(self, *args, **kwargs):
         self.predicate.delete()
         super().delete(*args, **kwargs)
@@ -394,6 +629,13 @@ class Multivariate(Predicate):
     def evaluate(self):
         return self.operation(*self.operands.all())
 
+    def compile(self, compiled):
+        return Combine(self.combine, [operand.compile(compiled) for operand in self.operands.all()])
+
+    @staticmethod
+    def combine(results):
+        return False
+
     def delete(self, *args, **kwargs):
         for operand in self.operands:
             operand.delete()
@@ -414,6 +656,10 @@ class AND(Multivariate):
                 break
         return result
 
+    @staticmethod
+    def combine(results):
+        return all(results)
+
 
 class OR(Multivariate):
     op = "OR"
@@ -426,6 +672,10 @@ class OR(Multivariate):
                 break
         return result
 
+    @staticmethod
+    def combine(results):
+        return any(results)
+
 
 class XOR(Multivariate):
     op = "XOR"
@@ -436,11 +686,16 @@ class XOR(Multivariate):
             result = result ^ operand.evaluate()
         return result
 
+    @staticmethod
+    def combine(results):
+        return functools.reduce(operator.xor, results, False)
+
 
 class ComparatorPredicate(Predicate):
     first_value = models.ForeignKey(Value, on_delete=models.CASCADE, related_name="first")
     second_value = models.ForeignKey(Value, on_delete=models.CASCADE, related_name="second")
     op = "NONE"
+    comparison = None
 
     def save(self, *args, **kwargs):
         if self.first_value.format != self.second_value.format:
@@ -458,10 +713,23 @@ class ComparatorPredicate(Predicate):
             self.second_value.delete()  # delete the value if it's a literal
         super().delete(*args, **kwargs)
 
+    def compile(self, compiled):
+        if self.comparison is None:
+            return super().compile(compiled)
+        return compiled.comparison(self.first_value_id, self.second_value_id, self.comparison)
+
     def to_representation(self):
         return [self.op, self.get_value_representation(self.first_value),
                 self.get_value_representation(self.second_value)]
 
+    @property
+    def first(self):
+        return write_behind.current(self.first_value).value
+
+    @property
+    def second(self):
+        return write_behind.current(self.second_value).value
+
     @staticmethod
     def get_value_representation(value):
         try:
@@ -477,23 +745,26 @@ class ComparatorPredicate(Predicate):
 
 class EqualPredicate(ComparatorPredicate):
     op = "="
+    comparison = operator.eq
 
     def evaluate(self):
-        return self.first_value.value == self.second_value.value
+        return self.first == self.second
 
 
 class LessThanPredicate(ComparatorPredicate):
     op = "<"
+    comparison = operator.lt
 
     def evaluate(self):
-        return self.first_value.value < self.second_value.value
+        return self.first < self.second
 
 
 class GreaterThanPredicate(ComparatorPredicate):
     op = ">"
+    comparison = operator.gt
 
     def evaluate(self):
-        return self.first_value.value > self.second_value.value
+        return self.first > self.second
 
 
 class Action(PolymorphicModel):
@@ -503,7 +774,15 @@ class Action(PolymorphicModel):
     condition = models.ForeignKey('Condition', on_delete=models.CASCADE, related_name='actions', null=True)
 
     def run(self):
-        pass
+        apply_actions(Hub.resolve(self.condition.hub_id), [self])
+
+    def message(self):
+        """The message that carries out this action on a leaf device."""
+        return None
+
+    def apply(self, value):
+        """Returns the value a datastore holding value should be given by this action."""
+        return value
 
     @property
     def action_type(self):
@@ -515,18 +794,15 @@ class Action(PolymorphicModel):
 
 
 class SetAction(Action):
-    def run(self):
-        # TODO: consider approaches to avoiding bypassing write guards on changing datastore value here
-        if self.target_uuid != 'datastore':
-            message = {'type': 'SET_OUTPUT',
-                       'uuid': self.target_uuid,
-                       'device': self.target_device,
-                       'value': self._value.value,
-                       'format': self._value.format}
-            self.condition.hub.get_leaf(self.target_uuid).send_message(message)
-        else:
-            datastore = self.condition.hub.datastores.get(name=self.target_device)
-            datastore.value = self._value.value
+    def message(self):
+        return {'type': 'SET_OUTPUT',
+                'uuid': self.target_uuid,
+                'device': self.target_device,
+                'value': self._value.value,
+                'format': self._value.format}
+
+    def apply(self, value):
+        return self._value.value
 
     @property
     def action_type(self):
@@ -534,18 +810,15 @@ class SetAction(Action):
 
 
 class ChangeAction(Action):
-    def run(self):
-        if self.target_uuid != 'datastore':
-            message = {'type': 'CHANGE_OUTPUT',
-                       'uuid': self.target_uuid,
-                       'device': self.target_device,
-                       'value': self.value.value,
-                       'format': self.value.format}
-            self.condition.hub.get_leaf(self.target_uuid).send_message(message)
-        else:
-            datastore = self.condition.hub.datastores.get(name=self.target_device)
-            datastore.value = datastore.value + self._value.value
-            print("here")
+    def message(self):
+        return {'type': 'CHANGE_OUTPUT',
+                'uuid': self.target_uuid,
+                'device': self.target_device,
+                'value': self._value.value,
+                'format': self._value.format}
+
+    def apply(self, value):
+        return value + self._value.value
 
     @property
     def action_type(self):
@@ -561,13 +834,51 @@ class Condition(models.Model):
     class Meta:
         unique_together = (('name', 'hub'),)
 
-    def execute(self):
-        pred = self.predicate.evaluate()
-        if pred and not self.previously_satisfied:
-            for action in self.actions.all():
-                action.run()
+    def execute(self, satisfied=None):
+        """Runs the actions if the predicate has become satisfied; satisfied skips re-evaluating it."""
+        pred = compiled_conditions.evaluate(self) if satisfied is None else satisfied
+        if pred == self.previously_satisfied:
+            return
+        # only the process that flips the stored state runs the actions
+        flipped = Condition.objects.filter(pk=self.pk, previously_satisfied=self.previously_satisfied) \
+            .update(previously_satisfied=pred)
         self.previously_satisfied = pred
-        self.save()
+        if flipped:
+            condition_changed.send(sender=Condition, condition=self)
+            if pred:
+                run_actions(self, self.actions.select_related('_value'))
+
+
+# sent when a condition's previously_satisfied changes, which is not saved through post_save
+condition_changed = Signal(providing_args=['condition'])
+
+
+def execute_conditions(hub_id, values):
+    """
+    Re-evaluates the parts of the hub's conditions that read values, and executes the conditions
+    whose result differs from their previously_satisfied as held by compiled_conditions.
+
+    Called while another reading's conditions are executing (a datastore written by an action),
+    the readings are queued on the cascade scheduler and run after the current level.
+    """
+    readings = {value.pk: value.value for value in values}
+    cascade.run(functools.partial(_execute_conditions, hub_id, readings))
+
+
+def _execute_conditions(hub_id, readings):
+    touched = compiled_conditions.update(hub_id, readings)
+    if not touched:
+        return
+    compiled_conditions.publish(readings)
+    transitions = [pk for pk, compiled in touched.items() if compiled.result != compiled.previously_satisfied]
+    if not transitions:
+        return
+    for condition in Condition.objects.filter(pk__in=transitions).order_by('pk'):
+        if not cascade.admit():
+            return  # left unsettled, so executed on the values' next reading
+        compiled = touched[condition.pk]
+        condition.execute(compiled.result)
+        compiled_conditions.settle(compiled, condition.previously_satisfied)
 
 
 class ConditionalSubscription(Subscription):
@@ -575,4 +886,5 @@ class ConditionalSubscription(Subscription):
 
     def handle_update(self, uuid, device, message):
         if message['type'] == 'DEVICE_STATUS':
-            self.condition.execute()
+            # loaded fresh each time; this subscription may be held by the routing index
+            Condition.objects.get(pk=self.condition_id).execute()
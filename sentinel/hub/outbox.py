@@ -0,0 +1,116 @@
+import asyncio
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+_local = threading.local()
+
+
+class Outbox:
+    """
+    Collects the replies and channel layer operations made while handling a message.
+
+    While an outbox is active on the current thread, sends are recorded instead of being
+    pushed through async_to_sync, so an async consumer can await them natively once the
+    database work is done.
+    """
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.operations = []
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.stack.pop()
+
+    def reply(self, content):
+        self.operations.append(('reply', content))
+
+    def send(self, channel, event):
+        self.operations.append(('send', channel, event))
+
+    def group_send(self, group, event):
+        self.operations.append(('group_send', group, event))
+
+    def group_send_many(self, groups, event):
+        self.operations.append(('group_send_many', groups, event))
+
+    def group_add(self, group, channel):
+        self.operations.append(('group_add', group, channel))
+
+    def group_discard(self, group, channel):
+        self.operations.append(('group_discard', group, channel))
+
+    async def flush(self):
+        operations, self.operations = self.operations, []
+        channel_layer = self.consumer.channel_layer
+        for operation in operations:
+            if operation[0] == 'reply':
+                await self.consumer.send_json(operation[1])
+            elif operation[0] == 'group_send_many':
+                await send_many(channel_layer, *operation[1:])
+            else:
+                await getattr(channel_layer, operation[0])(*operation[1:])
+
+
+def active():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def reply(consumer, content):
+    outbox = active()
+    if outbox:
+        outbox.reply(content)
+    else:
+        consumer.send_json(content)
+
+
+def send(channel, event):
+    outbox = active()
+    if outbox:
+        outbox.send(channel, event)
+    else:
+        async_to_sync(get_channel_layer().send)(channel, event)
+
+
+def group_send(group, event):
+    outbox = active()
+    if outbox:
+        outbox.group_send(group, event)
+    else:
+        async_to_sync(get_channel_layer().group_send)(group, event)
+
+
+def group_send_many(groups, event):
+    """Sends the same event to every group, issuing the sends together rather than one after another."""
+    outbox = active()
+    if outbox:
+        outbox.group_send_many(groups, event)
+    else:
+        async_to_sync(send_many)(get_channel_layer(), groups, event)
+
+
+async def send_many(channel_layer, groups, event):
+    await asyncio.gather(*(channel_layer.group_send(group, event) for group in groups))
+
+
+def group_add(group, channel):
+    outbox = active()
+    if outbox:
+        outbox.group_add(group, channel)
+    else:
+        async_to_sync(get_channel_layer().group_add)(group, channel)
+
+
+def group_discard(group, channel):
+    outbox = active()
+    if outbox:
+        outbox.group_discard(group, channel)
+    else:
+        async_to_sync(get_channel_layer().group_discard)(group, channel)
@@ -0,0 +1,166 @@
+import threading
+import time
+
+from django.conf import settings
+
+from .messages import MessageType, message_types
+from .metrics import metrics
+from .registry import registry
+
+# only telemetry is limited; CONFIG, SUBSCRIBE, DATASTORE_SET and other control messages always pass
+TELEMETRY = (MessageType.DeviceStatus, MessageType.DeviceStatusBatch)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def give(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class RateLimiter:
+    """
+    Process-wide token buckets for telemetry, one per leaf and one per hub.
+
+    A frame is admitted only when both its leaf's and its hub's bucket have a token. Rates
+    come from the hub's own limits, falling back to the SENTINEL_*_RATE_LIMIT settings; a
+    rate of 0 disables that limit.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def bucket(self, key, rate, burst):
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.rate != rate or bucket.burst != burst:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    @staticmethod
+    def limits(hub):
+        def setting(value, default):
+            return default if value is None else value
+        return ((setting(hub.leaf_rate_limit, settings.SENTINEL_LEAF_RATE_LIMIT),
+                 setting(hub.leaf_burst, settings.SENTINEL_LEAF_BURST)),
+                (setting(hub.hub_rate_limit, settings.SENTINEL_HUB_RATE_LIMIT),
+                 setting(hub.hub_burst, settings.SENTINEL_HUB_BURST)))
+
+    def admit(self, hub, uuid):
+        (leaf_rate, leaf_burst), (hub_rate, hub_burst) = self.limits(hub)
+        with self._lock:
+            leaf_bucket = None
+            if leaf_rate > 0:
+                leaf_bucket = self.bucket((hub.id, uuid), leaf_rate, leaf_burst)
+                if not leaf_bucket.take():
+                    return False
+            if hub_rate > 0 and not self.bucket(hub.id, hub_rate, hub_burst).take():
+                if leaf_bucket:
+                    leaf_bucket.give()  # the leaf was not the one over its limit
+                return False
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+rate_limiter = RateLimiter()
+
+
+class LeafThrottle:
+    """
+    Applies the rate limiter to the frames of one leaf connection before they are handled.
+
+    Frames are counted against the bucket of the leaf the connection authenticated as, whatever
+    uuid they carry; telemetry sent before CONFIG shares one bucket per hub and is never kept.
+    Telemetry over the limit is shed: the latest reading of each device is kept and replayed in
+    a DEVICE_STATUS_BATCH ahead of the next admitted telemetry frame, or once the bucket has
+    refilled, when wake(delay) asks the consumer to call flush. A burst therefore collapses into
+    the newest values. Readings replaced by a newer shed reading are dropped. Shed frames, kept
+    readings and dropped readings are counted in metrics under ratelimit.*.
+    """
+    def __init__(self, hub, session, wake):
+        self.hub = hub
+        self.session = session
+        self.wake = wake
+        self.pending = {}
+        self.waking = False
+
+    @property
+    def uuid(self):
+        return self.session.get('uuid')
+
+    def admit(self, content):
+        """Returns the frames to handle for content, in order."""
+        if content.get('type') not in TELEMETRY or not message_types.validate(content):
+            return [content]
+        hub = self.resolve()
+        readings = self.readings(content)
+
+        if not rate_limiter.admit(hub, self.uuid):
+            metrics.incr('ratelimit.shed')
+            metrics.incr(f'ratelimit.shed.{hub.id}')
+            if self.uuid is None:
+                return []
+            for reading in readings:
+                if reading['device'] in self.pending:
+                    metrics.incr('ratelimit.dropped')
+                else:
+                    metrics.incr('ratelimit.coalesced')
+                self.pending[reading['device']] = reading
+            self.wake_later(hub)
+            return []
+
+        frames = []
+        if self.pending:
+            current = {reading['device'] for reading in readings}
+            replay = [reading for device, reading in self.pending.items() if device not in current]
+            metrics.incr('ratelimit.dropped', len(self.pending) - len(replay))
+            self.pending = {}
+            if replay:
+                frames.append(self.batch(replay))
+        frames.append(content)
+        return frames
+
+    def flush(self):
+        """Returns the kept readings as one frame if the limiter admits it, otherwise waits for another refill."""
+        self.waking = False
+        if not self.pending:
+            return []
+        hub = self.resolve()
+        if not rate_limiter.admit(hub, self.uuid):
+            self.wake_later(hub)
+            return []
+        replay, self.pending = list(self.pending.values()), {}
+        return [self.batch(replay)]
+
+    def wake_later(self, hub):
+        if not self.waking:
+            self.waking = True
+            rates = [rate for rate, burst in rate_limiter.limits(hub) if rate > 0]
+            self.wake(1 / min(rates))  # the slower bucket refills a token by then
+
+    def resolve(self):
+        return registry.get(('hub', self.hub.id)) or self.hub  # picks up edited limits once re-resolved
+
+    def batch(self, readings):
+        return {'type': MessageType.DeviceStatusBatch.value, 'uuid': self.uuid, 'devices': readings}
+
+    @staticmethod
+    def readings(content):
+        if content['type'] == MessageType.DeviceStatusBatch:
+            return content['devices']
+        return [{field: value for field, value in content.items() if field not in ('type', 'uuid')}]
@@ -0,0 +1,72 @@
+import threading
+
+
+class IdentityRegistry:
+    """
+    Process-wide cache of resolved hubs, leaves, leaf users and devices.
+
+    Entries are keyed by ('hub', hub_id), ('leaf', hub_id, uuid), ('user', username) and
+    ('device', hub_id, uuid, name) and hold the model instances (with their primary keys and
+    device values already loaded). The post_save/post_delete receivers in handlers.py drop every
+    entry holding a row whenever the row is written through a different instance or deleted, so
+    the cached instance is always the one the write path itself is updating.
+
+    The cached instances are shared by every thread of the process, including the sync consumers'
+    handler threads, and are updated in place without a lock. This is safe because a leaf and its
+    devices are only written by that leaf's own connection, which handles one frame at a time;
+    other code must treat cached instances as read-only and write through a fresh instance.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._keys = {}  # (model, pk) -> {key: cached instance of that row}
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def add(self, key, instance, *related):
+        """Caches instance under key. Related instances (e.g. a device's value) evict the key when written."""
+        with self._lock:
+            self._entries[key] = instance
+            for obj in (instance,) + related:
+                self._keys.setdefault(self.identity(obj), {})[key] = obj
+        return instance
+
+    def refresh(self, instance):
+        """Evicts the entries holding instance's row, except those where instance is the cached object itself."""
+        with self._lock:
+            cached = self._keys.get(self.identity(instance), {})
+            for key in [key for key, obj in cached.items() if obj is not instance]:
+                self.discard(key)
+
+    def evict(self, instance):
+        with self._lock:
+            for key in list(self._keys.get(self.identity(instance), {})):
+                self.discard(key)
+
+    def discard(self, key):
+        """Drops the entry under key, and those of the leaves and devices below a hub or leaf."""
+        with self._lock:
+            stale = [key]
+            if key[0] in ('hub', 'leaf'):  # leaves and devices hold references to their hub and leaf
+                stale += [other for other in self._entries
+                          if other[0] in ('leaf', 'device') and other[1:len(key)] == key[1:]]
+            for stale_key in stale:
+                self._entries.pop(stale_key, None)
+            keys = {identity: {key: obj for key, obj in cached.items() if key not in stale}
+                    for identity, cached in self._keys.items()}
+            self._keys = {identity: cached for identity, cached in keys.items() if cached}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    @staticmethod
+    def identity(instance):
+        from .models import Value
+        model = 'value' if isinstance(instance, Value) else instance._meta.model_name
+        return model, instance.pk
+
+
+registry = IdentityRegistry()
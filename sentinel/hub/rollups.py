@@ -0,0 +1,198 @@
+import logging
+from datetime import datetime
+from itertools import islice
+
+from asgiref.sync import async_to_sync
+from channels.consumer import AsyncConsumer
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .history import CHUNK_SIZE, merge
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# the channel `manage.py runworker default rollups` consumes
+ROLLUP_CHANNEL = "rollups"
+WIDTHS = (60, 3600, 86400)
+FIELDS = ('count', 'min', 'max', 'sum', 'last', 'last_time')  # of a partial aggregate
+BATCH = 100  # devices rolled up per pass
+LOCK = 0x726f6c6c  # advisory lock held while rolling up, so two workers never write the same buckets
+
+
+def floor(time, width) -> datetime:
+    return datetime.fromtimestamp(time.timestamp() // width * width, timezone.utc)
+
+
+def mark_dirty(cursor, readings):
+    """Widens each device's dirty range to cover readings, in the transaction that copied them to history."""
+    ranges = {}
+    for hub_id, uuid, device, time, *values in readings:
+        low, high = ranges.get((hub_id, uuid, device), (time, time))
+        ranges[(hub_id, uuid, device)] = min(low, time), max(high, time)
+    rows = [key + times for key, times in sorted(ranges.items())]  # locks watermarks in a consistent order
+    cursor.execute("INSERT INTO hub_rollupwatermark (hub_id, uuid, device, dirty_from, dirty_until) VALUES "
+                   + ", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))
+                   + " ON CONFLICT (hub_id, uuid, device) DO UPDATE SET "
+                     "dirty_from = LEAST(hub_rollupwatermark.dirty_from, EXCLUDED.dirty_from), "
+                     "dirty_until = GREATEST(hub_rollupwatermark.dirty_until, EXCLUDED.dirty_until)",
+                   [field for row in rows for field in row])
+
+
+def wake():
+    """Asks the rollup worker to roll up the dirty ranges."""
+    try:
+        async_to_sync(get_channel_layer().send)(ROLLUP_CHANNEL, {"type": "rollup.update"})
+    except Exception:
+        logger.exception("Could not wake the rollup worker")
+
+
+def rollup_partials(series, source, width, start, end):
+    """Partial aggregates (see history.combine) of buckets width seconds wide, from the rollups source seconds wide."""
+    from .models import ReadingRollup
+    rows = (ReadingRollup.objects.filter(width=source, bucket__gte=start, bucket__lt=end, **series)
+            .order_by('bucket').values_list('bucket', 'count', 'min', 'max', 'sum', 'last').iterator())
+    return merge((int(bucket.timestamp() // width), count, minimum, maximum, total, last)
+                 for bucket, count, minimum, maximum, total, last in rows)
+
+
+def rollup_buckets(hub_id, uuid, device, start, end, width):
+    """
+    Returns partial aggregates of the device's buckets from start until end, computed from the
+    widest rollups that width is a multiple of and start and end align to, or None if there are
+    none or they are not complete over the range.
+    """
+    from .models import RollupWatermark
+    if not settings.SENTINEL_ROLLUPS:
+        return None
+    source = next((source for source in reversed(WIDTHS) if width % source == 0
+                   and start.timestamp() % source == 0 and end.timestamp() % source == 0), None)
+    watermark = RollupWatermark.objects.filter(hub_id=hub_id, uuid=uuid, device=device).first()
+    if source is None or watermark is None or watermark.rolled_until is None:
+        return None
+    if watermark.dirty_from is not None and watermark.dirty_from < end:
+        return None
+    return rollup_partials({'hub_id': hub_id, 'uuid': uuid, 'device': device}, source, width, start, end)
+
+
+def value_column(hub_id, uuid, device):
+    from .models import Datastore, Device
+    values = (Datastore.objects.filter(hub_id=hub_id, name=device) if uuid == 'datastore'
+              else Device.objects.filter(leaf__hub_id=hub_id, leaf__uuid=uuid, name=device))
+    value = values.select_related('_value').first()
+    return value._value.column if value else None
+
+
+def absorb(partial, other):
+    """
+    Combines two partial aggregates (count, min, max, sum, last, last time) of one bucket, in
+    either order: the last reading is the later of the two.
+    """
+    if partial is None:
+        return other
+    later = other if other[5] >= partial[5] else partial
+    return (partial[0] + other[0], min(partial[1], other[1]), max(partial[2], other[2]), partial[3] + other[3],
+            later[4], later[5])
+
+
+def single(time, value):
+    """The partial aggregate of one reading."""
+    value = float(value)
+    return 1, value, value, value, value, time
+
+
+def add_deltas(readings):
+    """Records the minute aggregates of flushed number and boolean readings, in the transaction that copied them."""
+    from .models import RollupDelta
+    partials = {}
+    for hub_id, uuid, device, time, number, boolean, text in readings:
+        if number is None and boolean is None:
+            continue
+        key = (hub_id, uuid, device, floor(time, WIDTHS[0]))
+        partials[key] = absorb(partials.get(key), single(time, number if number is not None else boolean))
+    RollupDelta.objects.bulk_create(
+        RollupDelta(hub_id=hub_id, uuid=uuid, device=device, bucket=bucket, **dict(zip(FIELDS, partial)))
+        for (hub_id, uuid, device, bucket), partial in partials.items())
+
+
+def fold(series, partials):
+    """Merges (minute, partial aggregate) pairs into the buckets of every width they fall in."""
+    from .models import ReadingRollup
+    for width in WIDTHS:
+        buckets = {}
+        for minute, partial in partials:
+            bucket = floor(minute, width)
+            buckets[bucket] = absorb(buckets.get(bucket), partial)
+        existing = {rollup.bucket: rollup for rollup in
+                    ReadingRollup.objects.filter(width=width, bucket__in=list(buckets), **series)}
+        for bucket, rollup in existing.items():
+            buckets[bucket] = absorb(tuple(getattr(rollup, field) for field in FIELDS), buckets[bucket])
+        ReadingRollup.objects.filter(pk__in=[rollup.pk for rollup in existing.values()]).delete()
+        ReadingRollup.objects.bulk_create(
+            ReadingRollup(width=width, bucket=bucket, **dict(zip(FIELDS, partial)), **series)
+            for bucket, partial in buckets.items())
+
+
+def roll_up_device(watermark):
+    """
+    Merges the device's deltas into its rollups. The first time, the rollups are built from all
+    of the device's readings in history instead, which already include the deltas'.
+    """
+    from .models import DeviceReading, RollupDelta
+    series = {'hub_id': watermark.hub_id, 'uuid': watermark.uuid, 'device': watermark.device}
+    column = value_column(**series)
+    deltas = RollupDelta.objects.filter(**series)
+    if column in ('number', 'boolean'):  # strings have no rollups; deleted devices keep theirs
+        if watermark.rolled_until is None:
+            readings = (DeviceReading.objects.filter(**series).exclude(**{f'{column}__isnull': True})
+                        .values_list('time', column).iterator(chunk_size=CHUNK_SIZE))
+            partials = ((floor(time, WIDTHS[0]), single(time, value)) for time, value in readings)
+        else:
+            partials = ((bucket, tuple(partial)) for bucket, *partial in deltas.values_list('bucket', *FIELDS))
+        while True:
+            chunk = list(islice(partials, CHUNK_SIZE))
+            if not chunk:
+                break
+            fold(series, chunk)
+        watermark.rolled_until = max(watermark.rolled_until or watermark.dirty_until, watermark.dirty_until)
+    deltas.delete()
+    watermark.dirty_from = watermark.dirty_until = None
+    watermark.save()
+
+
+def roll_up() -> bool:
+    """Rolls up the dirty ranges of up to BATCH devices, returning whether more are waiting."""
+    from .models import RollupWatermark
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [LOCK])
+        watermarks = list(RollupWatermark.objects.select_for_update().filter(dirty_until__isnull=False)
+                          .order_by('pk')[:BATCH + 1])
+        for watermark in watermarks[:BATCH]:
+            roll_up_device(watermark)
+    metrics.incr('rollups.devices', len(watermarks[:BATCH]))
+    return len(watermarks) > BATCH
+
+
+class RollupWorker(AsyncConsumer):
+    """
+    Keeps the 1 minute, 1 hour and 1 day rollups of device history up to date.
+
+    Every history flush records the minute aggregates of the readings it wrote as RollupDeltas
+    and widens the dirty range of their devices, in the same transaction, then sends
+    ROLLUP_CHANNEL a rollup.update. The worker merges each device's deltas into the buckets they
+    fall in and clears its dirty range, so readings that arrive late are added to their buckets
+    without reading history again, even after the raw month was pruned.
+    """
+    async def rollup_update(self, event):
+        try:
+            with metrics.timed('rollups.run'):
+                more = await database_sync_to_async(roll_up)()
+        except Exception:
+            logger.exception("Rolling up history failed")
+            return
+        if more:
+            await self.channel_layer.send(ROLLUP_CHANNEL, {"type": "rollup.update"})
@@ -2,7 +2,7 @@ from django.urls import re_path
 from channels.db import database_sync_to_async
 from channelsmultiplexer import AsyncJsonWebsocketDemultiplexer
 
-from .consumers import LeafConsumer
+from .consumers import LeafConsumer, AsyncLeafConsumer, GroupCommitLeafConsumer
 from .bindings import LeafBinding, ConditionBinding, DatastoreBinding
 from .models import Hub
 
@@ -26,5 +26,7 @@ class APIDemultiplexer(AsyncJsonWebsocketDemultiplexer):
 # top level routing for websockets
 websocket_routing = [
     re_path(r"^hub/(?P<id>[^/]+)$", LeafConsumer),
+    re_path(r"^hub/(?P<id>[^/]+)/async$", AsyncLeafConsumer),
+    re_path(r"^hub/(?P<id>[^/]+)/group$", GroupCommitLeafConsumer),
     re_path(r"^client/(?P<id>[^/]+)$", APIDemultiplexer)
 ]
\ No newline at end of file
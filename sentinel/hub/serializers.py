@@ -89,7 +89,8 @@ class HubSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Hub
-        fields = ('id', 'name', 'num_leaves', 'num_datastores', 'num_conditions', 'num_subscriptions')
+        fields = ('id', 'name', 'num_leaves', 'num_datastores', 'num_conditions', 'num_subscriptions',
+                  'leaf_rate_limit', 'leaf_burst', 'hub_rate_limit', 'hub_burst')
 
     def get_num_leaves(self, obj):
         return obj.leaves.count()
@@ -1,16 +1,53 @@
+import asyncio
+import time
+from datetime import datetime
 import pytest
-from channels.testing import WebsocketCommunicator
+from channels.layers import get_channel_layer
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
 from django.test import Client
 from guardian.models import Group as PermGroup
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import User
-from .models import Leaf, Hub, Datastore
+from django.db import OperationalError, connection, transaction
+from django.db.models.signals import post_save
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from .models import Leaf, Hub, Datastore, Device, Value, NumberValue, UnitValue, BooleanValue, Subscription
+from .models import Condition, Predicate, DeviceReading, ReadingRollup, RollupDelta, RollupWatermark, condition_changed
+from .registry import registry
+from .actions import ACTION_CHANNEL, ActionWorker
+from .conditions import ORIGIN, compiled_conditions, value_cache
+from .consumers import create_condition
+from .fanout import ROUTING_GROUP, routing
+from .listener import listener
+from . import history as history_module
+from .history import history, drop_months, merge, reduce_rows
+from .rollups import ROLLUP_CHANNEL, RollupWorker, roll_up
+from .outbox import Outbox
+from .messages import API_VERSION, message_types
+from .metrics import metrics
+from .ratelimit import LeafThrottle, rate_limiter
+from .writebehind import write_behind
+from .utils import InvalidLeaf, ConditionCycle
 import logging
 import json
+from types import SimpleNamespace
+import msgpack
 from sentinel.routing import application
 
 logging.disable(logging.ERROR)
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Empties the process-wide caches, as the database is flushed between tests."""
+    registry.clear()
+    rate_limiter.clear()
+    routing.clear()
+    value_cache.clear()
+    compiled_conditions.clear()
+    write_behind.clear()
+
+
 class ConsumerTests:
     @pytest.yield_fixture(autouse=True)
     async def disconnect(self):
@@ -18,6 +55,7 @@ class ConsumerTests:
         yield to_disconnect
         for client in to_disconnect:
             await client.disconnect()
+        await listener.stop()
 
     def create_hub(self, name):
         hub = Hub(name=name)
@@ -31,10 +69,11 @@ class ConsumerTests:
         self.user = User.objects.create_superuser(username="admin", password="password", email="admin@admin.om")
         self.client.login(username="admin", password="password")
 
-    async def send_create_leaf(self, name, model, uuid, hub, api_version="0.1.0", receive=True):
+    async def send_create_leaf(self, name, model, uuid, hub, api_version="0.1.0", receive=True, route="",
+                               encodings=None):
         token_response = self.client.post(f"/hub/{hub.id}/register", {'uuid': uuid})
         token = json.loads(token_response.content)['token']
-        client = WebsocketCommunicator(application, f"hub/{hub.id}")
+        client = WebsocketCommunicator(application, f"hub/{hub.id}{route}")
 
         accepted, timeout = await client.connect()
         assert accepted, "Client connection was not accepted"
@@ -45,16 +84,21 @@ class ConsumerTests:
                           'uuid': uuid,
                           'token': token,
                           'api_version': api_version}
+        if encodings:
+            config_message['encodings'] = encodings
         await client.send_json_to(config_message)
         if receive:
             response = await client.receive_json_from()
             assert response is not None, "Expected a response"
             assert response['type'] == 'CONFIG_COMPLETE'
+            assert response['api_version'] == API_VERSION, "Leaves should learn which messages the hub accepts"
             response = await client.receive_json_from()
             assert response is not None, "Expected a response"
             assert response['type'] == 'LIST_DEVICES'
             assert await client.receive_nothing()
-            
+        else:
+            return client, None  # the caller reads the responses, after which the leaf exists
+
         try:
             db_leaf = Leaf.objects.get(uuid=uuid, hub=hub)
         except ObjectDoesNotExist:
@@ -79,6 +123,15 @@ class ConsumerTests:
         await client.send_json_to(device_message)
         await client.receive_nothing()
 
+    @staticmethod
+    async def send_device_batch(client, sender, devices):
+        batch_message = {'type': 'DEVICE_STATUS_BATCH',
+                         'uuid': sender,
+                         'devices': [{'device': device, 'value': value, 'format': format, 'mode': mode}
+                                     for device, value, format, mode in devices]}
+        await client.send_json_to(batch_message)
+        await client.receive_nothing()
+
     @staticmethod
     async def send_subscribe(observer_client, observer_uuid, other_uuid, other_device):
         sub_message = {'type': 'SUBSCRIBE',
@@ -400,6 +453,83 @@ class TestLeaves(ConsumerTests):
         assert thermometer_device.value == 90, "Wrong value"
 
 
+    async def test_status_batch(self, disconnect):
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+        rfid_client, rfid_leaf = await self.send_create_leaf('rfid_leaf', '0', 'a581b491-da64-4895-9bb6-5f8d76ebd44e', hub)
+        disconnect.append(rfid_client)
+
+        observer_client, observer_leaf = await self.send_create_leaf('rfid_leaf', '0', 'cd1b7879-d17a-47e5-bc14-26b3fc554e49', hub)
+        disconnect.append(observer_client)
+
+        # batch creates devices
+        await self.send_device_batch(rfid_client, rfid_leaf.uuid, [('rfid_reader', 125, 'number', 'IN'),
+                                                                   ('door', False, 'bool', 'OUT'),
+                                                                   ('led_display', 'BLUE', 'string', 'OUT')])
+        assert rfid_leaf.devices.count() == 3, "Expected three devices"
+        await self.send_subscribe(observer_client, observer_leaf.uuid, rfid_leaf.uuid, 'leaf')
+
+        # batch updates changed devices only
+        await self.send_device_batch(rfid_client, rfid_leaf.uuid, [('rfid_reader', 33790, 'number', 'IN'),
+                                                                   ('door', False, 'bool', 'OUT'),
+                                                                   ('led_display', 'RED', 'string', 'OUT')])
+        devices = {device.name: device for device in rfid_leaf.devices.all()}
+        assert devices['rfid_reader'].value == 33790, "Wrong value"
+        assert devices['door'].value == False, "Wrong value"
+        assert devices['led_display'].value == 'RED', "Wrong value"
+
+        updates = [await observer_client.receive_json_from(), await observer_client.receive_json_from()]
+        assert {update['message']['device'] for update in updates} == {'rfid_reader', 'led_display'}
+        assert await observer_client.receive_nothing(), "Unchanged devices should not be sent"
+
+    async def test_write_behind(self, disconnect, monkeypatch):
+        monkeypatch.setattr(write_behind, 'interval', 60)
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+        rfid_client, rfid_leaf = await self.send_create_leaf('rfid_leaf', '0', 'a581b491-da64-4895-9bb6-5f8d76ebd44e', hub)
+        disconnect.append(rfid_client)
+
+        observer_client, observer_leaf = await self.send_create_leaf('rfid_leaf', '0', 'cd1b7879-d17a-47e5-bc14-26b3fc554e49', hub)
+        disconnect.append(observer_client)
+
+        await self.send_device_update(rfid_client, rfid_leaf.uuid, 'rfid_reader', 33790, 'number')
+        await self.send_subscribe(observer_client, observer_leaf.uuid, rfid_leaf.uuid, 'rfid_reader')
+
+        for value in [1, 2, 3]:
+            await self.send_device_update(rfid_client, rfid_leaf.uuid, 'rfid_reader', value, 'number')
+            sub_message = await observer_client.receive_json_from()
+            assert sub_message['message']['value'] == value, "Subscribers should be served from memory"
+
+        assert rfid_leaf.devices.get(name='rfid_reader').value == 33790, "Value should not be written yet"
+        write_behind.flush()
+        assert rfid_leaf.devices.get(name='rfid_reader').value == 3, "Last value should be written on flush"
+
+    async def test_unchanged_readings_suppressed(self, disconnect):
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+        rfid_client, rfid_leaf = await self.send_create_leaf('rfid_leaf', '0', 'a581b491-da64-4895-9bb6-5f8d76ebd44e', hub)
+        disconnect.append(rfid_client)
+
+        observer_client, observer_leaf = await self.send_create_leaf('rfid_leaf', '0', 'cd1b7879-d17a-47e5-bc14-26b3fc554e49', hub)
+        disconnect.append(observer_client)
+
+        await self.send_device_update(rfid_client, rfid_leaf.uuid, 'temperature', 21.5, 'number')
+        await self.send_device_update(rfid_client, rfid_leaf.uuid, 'door', True, 'bool')
+        await self.send_subscribe(observer_client, observer_leaf.uuid, rfid_leaf.uuid, 'leaf')
+        metrics.reset()
+
+        await self.send_device_update(rfid_client, rfid_leaf.uuid, 'temperature', '21.5', 'number')
+        await self.send_device_update(rfid_client, rfid_leaf.uuid, 'temperature', 21.50001, 'number')
+        await self.send_device_update(rfid_client, rfid_leaf.uuid, 'door', 'true', 'bool')
+        assert await observer_client.receive_nothing(), "Unchanged readings should not be sent"
+
+        await self.send_device_update(rfid_client, rfid_leaf.uuid, 'temperature', '22.25', 'number')
+        sub_message = await observer_client.receive_json_from()
+        assert sub_message['message']['value'] == 22.25
+
+        response = self.client.get('/api/metrics/')
+        assert response.json()['counters']['values.suppressed'] == 3
+
     @pytest.mark.skip("Options not implemented yet")
     def test_options(self, disconnect):
         pass
@@ -634,6 +764,238 @@ class TestLeaves(ConsumerTests):
         assert await observer_client.receive_json_from() is not None, "Expected to still receive a subscription update"
 
 
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+class TestDispatch(ConsumerTests):
+    async def test_invalid_message(self, disconnect):
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+        client, leaf = await self.send_create_leaf('rfid_leaf', '0', 'a581b491-da64-4895-9bb6-5f8d76ebd44e', hub)
+        disconnect.append(client)
+
+        message = {'type': 'DEVICE_STATUS', 'uuid': leaf.uuid, 'device': 'rfid_reader'}
+        await client.send_json_to(message)
+        response = await client.receive_json_from()
+        assert response['type'] == 'INVALID_MESSAGE'
+        assert response['message'] == dict(message, hub=hub.id)
+
+        await client.send_json_to({'type': 'NOT_A_TYPE', 'uuid': leaf.uuid})
+        response = await client.receive_json_from()
+        assert response['type'] == 'INVALID_MESSAGE'
+
+    async def test_plugin_message_type(self, disconnect, monkeypatch):
+        monkeypatch.setattr(message_types, 'types', dict(message_types.types))
+
+        @message_types.register('PING', 'payload')
+        def handle_ping(message):
+            message.reply({'type': 'PONG', 'payload': message.data['payload']})
+
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+        client, leaf = await self.send_create_leaf('rfid_leaf', '0', 'a581b491-da64-4895-9bb6-5f8d76ebd44e', hub)
+        disconnect.append(client)
+        metrics.reset()
+
+        await client.send_json_to({'type': 'PING', 'uuid': leaf.uuid, 'payload': 42})
+        response = await client.receive_json_from()
+        assert response == {'type': 'PONG', 'payload': 42}
+
+        await client.send_json_to({'type': 'PING', 'uuid': leaf.uuid})
+        response = await client.receive_json_from()
+        assert response['type'] == 'INVALID_MESSAGE', "Plugin field specs should be validated"
+        assert metrics.snapshot()['timers']['dispatch.PING']['count'] == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+class TestRateLimit(ConsumerTests):
+    async def test_telemetry_shed(self, disconnect):
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+        hub.leaf_rate_limit, hub.leaf_burst = 0.001, 2
+        hub.save()
+        rfid_client, rfid_leaf = await self.send_create_leaf('rfid_leaf', '0', 'a581b491-da64-4895-9bb6-5f8d76ebd44e', hub)
+        disconnect.append(rfid_client)
+        observer_client, observer_leaf = await self.send_create_leaf('observer', '0',
+                                                                     'cd1b7879-d17a-47e5-bc14-26b3fc554e49', hub)
+        disconnect.append(observer_client)
+        metrics.reset()
+
+        for value in [1, 2, 3, 4]:
+            await self.send_device_update(rfid_client, rfid_leaf.uuid, 'rfid_reader', value, 'number')
+        assert rfid_leaf.devices.get(name='rfid_reader').value == 2, "Readings over the burst should be shed"
+        assert metrics.snapshot()['counters']['ratelimit.shed'] == 2
+
+        # control messages are not limited
+        await self.send_subscribe(observer_client, observer_leaf.uuid, rfid_leaf.uuid, 'rfid_reader')
+        await self.send_subscribe(rfid_client, rfid_leaf.uuid, observer_leaf.uuid, 'leaf')
+        assert hub.subscriptions.count() == 2
+
+    async def test_flush_on_refill(self, disconnect):
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+        hub.leaf_rate_limit, hub.leaf_burst = 10, 1
+        hub.save()
+        rfid_client, rfid_leaf = await self.send_create_leaf('rfid_leaf', '0', 'a581b491-da64-4895-9bb6-5f8d76ebd44e', hub)
+        disconnect.append(rfid_client)
+
+        for value in [1, 2, 3]:
+            await rfid_client.send_json_to({'type': 'DEVICE_STATUS', 'uuid': rfid_leaf.uuid, 'device': 'rfid_reader',
+                                            'mode': 'IN', 'format': 'number', 'value': value})
+        for _ in range(100):
+            device = rfid_leaf.devices.filter(name='rfid_reader').first()
+            if device and device.value == 3:
+                break
+            await asyncio.sleep(0.02)
+        assert rfid_leaf.devices.get(name='rfid_reader').value == 3, \
+            "Shed readings should be applied once the bucket refills, without another frame"
+
+
+class TestLeafThrottle:
+    def test_coalesce(self):
+        hub = SimpleNamespace(id=0, leaf_rate_limit=0.001, leaf_burst=1, hub_rate_limit=None, hub_burst=None)
+        wakes = []
+        uuid = 'a581b491-da64-4895-9bb6-5f8d76ebd44e'
+        throttle = LeafThrottle(hub, {'uuid': uuid}, wakes.append)
+
+        def status(device, value):
+            return {'type': 'DEVICE_STATUS', 'uuid': uuid, 'device': device, 'mode': 'IN', 'format': 'number',
+                    'value': value}
+
+        metrics.reset()
+        assert throttle.admit(status('a', 1)) == [status('a', 1)]
+        assert throttle.admit(status('a', 2)) == []
+        assert throttle.admit(status('b', 3)) == []
+        assert throttle.admit(status('a', 4)) == []
+        control = {'type': 'DATASTORE_SET', 'uuid': uuid, 'name': 'store', 'value': 1}
+        assert throttle.admit(control) == [control]
+        assert wakes == [1000], "The throttle should wake once, when the bucket has a token again"
+        other = dict(status('c', 6), uuid='cd1b7879-d17a-47e5-bc14-26b3fc554e49')
+        assert throttle.admit(other) == [], "Frames should count against the authenticated leaf"
+        del throttle.pending['c']
+
+        assert throttle.flush() == [] and wakes == [1000, 1000], "An early flush should wait for another refill"
+        rate_limiter.bucket((0, uuid), 0.001, 1).tokens = 1
+        assert throttle.flush() == [{'type': 'DEVICE_STATUS_BATCH', 'uuid': uuid,
+                                     'devices': [{'device': 'a', 'mode': 'IN', 'format': 'number', 'value': 4},
+                                                 {'device': 'b', 'mode': 'IN', 'format': 'number', 'value': 3}]}]
+        assert throttle.admit(status('a', 7)) == [] and wakes == [1000, 1000, 1000]
+
+        rate_limiter.bucket((0, uuid), 0.001, 1).tokens = 1
+        replay, frame = throttle.admit(status('b', 5))
+        assert replay['type'] == 'DEVICE_STATUS_BATCH'
+        assert replay['devices'] == [{'device': 'a', 'mode': 'IN', 'format': 'number', 'value': 7}]
+        assert frame == status('b', 5)
+        counters = metrics.snapshot()['counters']
+        assert (counters['ratelimit.shed'], counters['ratelimit.coalesced'], counters['ratelimit.dropped']) == (5, 4, 1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+class TestEncoding(ConsumerTests):
+    async def encoding_roundtrip(self, route):
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+        rfid_client, _ = await self.send_create_leaf('rfid_leaf', '0', 'a581b491-da64-4895-9bb6-5f8d76ebd44e',
+                                                     hub, receive=False, route=route,
+                                                     encodings=['cbor-unknown', 'msgpack', 'json'])
+        response = json.loads(await rfid_client.receive_from())
+        assert response['type'] == 'CONFIG_COMPLETE'
+        assert response['encoding'] == 'msgpack', "Hub should pick the first encoding it supports"
+        response = msgpack.unpackb(await rfid_client.receive_from(), raw=False)
+        assert response['type'] == 'LIST_DEVICES'
+        rfid_leaf = Leaf.objects.get(uuid='a581b491-da64-4895-9bb6-5f8d76ebd44e', hub=hub)
+
+        observer_client, observer_leaf = await self.send_create_leaf('observer', '0',
+                                                                     'cd1b7879-d17a-47e5-bc14-26b3fc554e49', hub)
+        for value in (33790, 33791):
+            status = {'type': 'DEVICE_STATUS', 'uuid': rfid_leaf.uuid, 'device': 'rfid_reader',
+                      'mode': 'IN', 'format': 'number', 'value': value}
+            await rfid_client.send_to(bytes_data=msgpack.packb(status, use_bin_type=True))
+            assert await rfid_client.receive_nothing()
+            assert rfid_leaf.devices.get(name='rfid_reader').value == value
+            if value == 33790:  # the first reading creates the device
+                await self.send_subscribe(observer_client, observer_leaf.uuid, rfid_leaf.uuid, 'rfid_reader')
+
+        sub_message = await observer_client.receive_json_from()
+        assert sub_message['message']['value'] == 33791, "JSON leaves should still receive updates"
+
+        await self.send_device_update(observer_client, observer_leaf.uuid, 'door', False, 'bool')
+        subscribe = {'type': 'SUBSCRIBE', 'uuid': rfid_leaf.uuid, 'sub_uuid': observer_leaf.uuid, 'sub_device': 'leaf'}
+        await rfid_client.send_to(bytes_data=msgpack.packb(subscribe, use_bin_type=True))
+        assert await rfid_client.receive_nothing()
+        await self.send_device_update(observer_client, observer_leaf.uuid, 'door', True, 'bool')
+        sub_message = msgpack.unpackb(await rfid_client.receive_from(), raw=False)
+        assert sub_message['type'] == 'SUBSCRIPTION_UPDATE' and sub_message['message']['value'] is True
+        return rfid_client, observer_client
+
+    async def test_msgpack(self, disconnect):
+        disconnect.extend(await self.encoding_roundtrip(""))
+
+    async def test_msgpack_async(self, disconnect):
+        disconnect.extend(await self.encoding_roundtrip("/async"))
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+class TestAsyncLeaves(ConsumerTests):
+    async def test_create(self, disconnect):
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+        uuid = "a581b491-da64-4895-9bb6-5f8d76ebd44e"
+        client, db_leaf = await self.send_create_leaf('py_async_test', '01', uuid, hub, route="/async")
+        disconnect.append(client)
+
+        await self.send_device_update(client, db_leaf.uuid, 'rfid_reader', 31231, 'number')
+        assert db_leaf.devices.count() == 1, "Expected one device"
+        assert db_leaf.devices.get(name='rfid_reader').value == 31231, "Wrong value"
+
+    async def test_subscription(self, disconnect):
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+        rfid_client, rfid_leaf = await self.send_create_leaf('rfid_leaf', '0', 'a581b491-da64-4895-9bb6-5f8d76ebd44e',
+                                                             hub, route="/async")
+        disconnect.append(rfid_client)
+
+        # observer uses the sync consumer to check both consumers interoperate
+        observer_client, observer_leaf = await self.send_create_leaf('rfid_leaf', '0', 'cd1b7879-d17a-47e5-bc14-26b3fc554e49', hub)
+        disconnect.append(observer_client)
+
+        await self.send_device_update(rfid_client, rfid_leaf.uuid, 'rfid_reader', 33790, 'number')
+        await self.send_subscribe(observer_client, observer_leaf.uuid, rfid_leaf.uuid, 'rfid_reader')
+
+        await self.send_device_update(rfid_client, rfid_leaf.uuid, 'rfid_reader', 3032042781, 'number')
+        sub_message = await observer_client.receive_json_from()
+        assert sub_message['type'] == 'SUBSCRIPTION_UPDATE', "Wrong type"
+        assert sub_message['message']['value'] == 3032042781, "Wrong value"
+        assert await rfid_client.receive_nothing(), "Didn't  expect a response"
+
+
+    async def test_group_commit(self, disconnect):
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+        rfid_client, rfid_leaf = await self.send_create_leaf('rfid_leaf', '0', 'a581b491-da64-4895-9bb6-5f8d76ebd44e',
+                                                             hub, route="/group")
+        disconnect.append(rfid_client)
+
+        observer_client, observer_leaf = await self.send_create_leaf('rfid_leaf', '0', 'cd1b7879-d17a-47e5-bc14-26b3fc554e49',
+                                                                     hub, route="/group")
+        disconnect.append(observer_client)
+
+        await self.send_device_update(rfid_client, rfid_leaf.uuid, 'rfid_reader', 0, 'number')
+        await self.send_subscribe(observer_client, observer_leaf.uuid, rfid_leaf.uuid, 'rfid_reader')
+
+        # frames sent back to back are committed together but still released in order
+        for value in range(1, 6):
+            await rfid_client.send_json_to({'type': 'DEVICE_STATUS', 'uuid': rfid_leaf.uuid, 'device': 'rfid_reader',
+                                            'mode': 'IN', 'format': 'number', 'value': value})
+        for value in range(1, 6):
+            sub_message = await observer_client.receive_json_from()
+            assert sub_message['message']['value'] == value, "Updates released out of order"
+
+        assert rfid_leaf.devices.get(name='rfid_reader').value == 5, "Wrong value"
+
+
 @pytest.mark.asyncio
 @pytest.mark.django_db(transaction=True)
 class TestDatastore(ConsumerTests):
@@ -1110,6 +1472,35 @@ class TestConditions(ConsumerTests):
         assert await door_client.receive_nothing()  # only gets one update
         await self.send_delete_condition(admin_client, admin_leaf.uuid, "binary_nested")
 
+    async def test_batch_condition(self, disconnect):
+        self.create_user_and_client()
+        hub = self.create_hub("test_hub")
+
+        admin_client, admin_leaf = await self.send_create_leaf('admin_leaf', '0', '2e11b9fc-5725-4843-8b9c-4caf2d69c499', hub)
+        disconnect.append(admin_client)
+
+        rfid_client, rfid_leaf = await self.send_create_leaf('rfid_leaf', '0', 'a581b491-da64-4895-9bb6-5f8d76ebd44e', hub)
+        disconnect.append(rfid_client)
+
+        door_client, door_leaf = await self.send_create_leaf('door_leaf', '0', 'cd1b7879-d17a-47e5-bc14-26b3fc554e49', hub)
+        disconnect.append(door_client)
+
+        await self.send_device_batch(rfid_client, rfid_leaf.uuid, [('rfid_reader', 33790, 'number', 'IN'),
+                                                                   ('other_sensor', False, 'bool', 'IN')])
+        await self.send_device_update(door_client, door_leaf.uuid, 'door_open', False, 'bool', mode='OUT')
+
+        predicates = ['AND', [['=', [rfid_leaf.uuid, 'rfid_reader'], 3032042781],
+                              ['=', [rfid_leaf.uuid, 'other_sensor'], True]]]
+        await self.send_create_condition(admin_client, admin_leaf.uuid, 'batch_AND', predicates,
+                                         actions=[self.create_action('SET', door_leaf.uuid, 'door_open', action_value=True)])
+
+        # both devices change in one frame, so the condition is satisfied on its first evaluation
+        await self.send_device_batch(rfid_client, rfid_leaf.uuid, [('rfid_reader', 3032042781, 'number', 'IN'),
+                                                                   ('other_sensor', True, 'bool', 'IN')])
+        response = await door_client.receive_json_from()
+        assert response['type'] == 'SET_OUTPUT'
+        assert await door_client.receive_nothing()  # only gets one update
+
     async def test_invalid_output_device(self, disconnect):
         self.create_user_and_client()
         hub = self.create_hub("test_hub")
@@ -1262,3 +1653,827 @@ class TestHubs(ConsumerTests):
         # ensure that only one hub receives output
         assert await out_client1.receive_json_from(), "Expected an out on hub1"
         assert await out_client2.receive_nothing(), "Did not expect second hub to receive output"
+
+
+@pytest.mark.django_db(transaction=True)
+class TestRegistry:
+    def test_cached_lookups(self, django_assert_num_queries):
+        hub = Hub.objects.create(name="registry_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        value = NumberValue(value=1)
+        value.save()
+        Device.objects.create(name="sensor", leaf=leaf, _value=value, mode="IN")
+
+        hub = Hub.resolve(hub.id)
+        device = hub.get_device(leaf.uuid, "sensor")
+        with django_assert_num_queries(0):
+            assert Hub.resolve(hub.id) is hub
+            assert hub.get_device(leaf.uuid, "sensor") is device
+            assert hub.get_leaf(leaf.uuid) is device.leaf
+
+    def test_fanout_routing(self, django_assert_num_queries):
+        hub = Hub.objects.create(name="registry_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        value = NumberValue(value=1)
+        value.save()
+        Device.objects.create(name="sensor", leaf=leaf, _value=value, mode="IN")
+        with Outbox(None):
+            Subscription.objects.create(hub=hub, subscriber_uuid="cd1b7879-d17a-47e5-bc14-26b3fc554e49",
+                                        target_uuid=leaf.uuid, target_device="sensor")
+            Subscription.objects.create(hub=hub, subscriber_uuid="cd1b7879-d17a-47e5-bc14-26b3fc554e49",
+                                        target_uuid=leaf.uuid, target_device="leaf")
+            Subscription.objects.create(hub=hub, subscriber_uuid="0c4ba7b5-6a8d-4bc5-9a97-5d32b24b9b5c",
+                                        target_uuid=leaf.uuid, target_device="leaf")
+
+        device = Hub.resolve(hub.id).get_device(leaf.uuid, "sensor")
+        with Outbox(None):
+            device.leaf.send_subscriber_update(device)  # loads the routes
+        with Outbox(None) as outbox, django_assert_num_queries(0):
+            device.leaf.send_subscriber_update(device)
+        assert [(operation[0], operation[1]) for operation in outbox.operations] == [
+            ('group_send_many', [f"{hub.id}-cd1b7879-d17a-47e5-bc14-26b3fc554e49"]),
+            ('group_send_many', [f"{hub.id}-0c4ba7b5-6a8d-4bc5-9a97-5d32b24b9b5c"])]
+        frames = outbox.operations[0][2]['frames']
+        assert json.loads(frames['json'])['sub_device'] == 'sensor', "Updates should be encoded once, up front"
+        assert msgpack.unpackb(frames['msgpack'], raw=False) == json.loads(frames['json'])
+
+        with Outbox(None) as outbox:
+            Subscription.objects.get(target_device="sensor").delete()
+        assert (hub.id, ) == tuple(operation[2]['hub'] for operation in outbox.operations), \
+            "Other processes should be told to drop the hub's routes"
+        with Outbox(None) as outbox:
+            device.leaf.send_subscriber_update(device)
+        assert [len(operation[1]) for operation in outbox.operations] == [2]
+        assert json.loads(outbox.operations[0][2]['frames']['json'])['sub_device'] == 'leaf'
+
+    def test_invalidation(self):
+        hub = Hub.objects.create(name="registry_hub")
+        Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                            last_connected=timezone.now(), hub=hub)
+        leaf = hub.get_leaf("a581b491-da64-4895-9bb6-5f8d76ebd44e")
+
+        leaf.save()  # saving the cached instance keeps it cached
+        assert hub.get_leaf(leaf.uuid) is leaf
+
+        other = Leaf.objects.get(pk=leaf.pk)
+        other.name = "renamed"
+        other.save()
+        assert hub.get_leaf(leaf.uuid).name == "renamed"
+
+        other.delete()
+        with pytest.raises(InvalidLeaf):
+            hub.get_leaf(leaf.uuid)
+
+    def test_aliases(self):
+        hub = Hub.objects.create(name="registry_hub")
+        first, second = Hub.objects.get(pk=hub.pk), Hub.objects.get(pk=hub.pk)
+        registry.add(('hub', hub.id), first)
+        registry.add(('hub', str(hub.id)), second)
+
+        registry.refresh(first)
+        assert registry.get(('hub', hub.id)) is first, "The entry holding the saved instance should stay"
+        assert registry.get(('hub', str(hub.id))) is None
+
+        registry.add(('hub', str(hub.id)), second)
+        hub.delete()
+        assert (registry.get(('hub', hub.id)), registry.get(('hub', str(hub.id)))) == (None, None), \
+            "Every entry holding a deleted row should be evicted"
+
+
+@pytest.mark.django_db(transaction=True)
+class TestLeafTime:
+    def test_throttled_update_time(self, settings, django_assert_num_queries):
+        settings.SENTINEL_LAST_UPDATED_INTERVAL = 60
+        hub = Hub.objects.create(name="time_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        saved = []
+
+        def receiver(sender, instance, **kwargs):
+            saved.append(instance)
+        post_save.connect(receiver, sender=Leaf)
+        try:
+            with django_assert_num_queries(1):
+                for _ in range(3):
+                    leaf.update_time()
+        finally:
+            post_save.disconnect(receiver, sender=Leaf)
+
+        assert not saved, "Readings should not fire the save signals"
+        persisted = Leaf.objects.get(pk=leaf.pk).last_updated
+        assert persisted < leaf.last_updated, "Only the first reading in the interval should be written"
+
+        settings.SENTINEL_LAST_UPDATED_INTERVAL = 0
+        leaf.update_time()
+        assert Leaf.objects.get(pk=leaf.pk).last_updated == leaf.last_updated
+
+
+@pytest.mark.django_db(transaction=True)
+class TestValues:
+    def test_single_table(self):
+        value = NumberValue(value=21.5)
+        value.save()
+        loaded = Value.objects.get(pk=value.pk)
+        assert (loaded.format, loaded.value, loaded.to_json()) == ('number', 21.5, 21.5)
+
+        units = UnitValue(value='3.25', units='C')
+        units.save()
+        loaded = Value.objects.get(pk=units.pk)
+        assert (loaded.format, loaded.value, loaded.units, repr(loaded)) == ('number+units', 3.25, 'C', '3.25C')
+
+        flag = BooleanValue(value=True)
+        flag.save()
+        assert Value.objects.get(pk=flag.pk).value is True
+
+    def test_leaf_list_queries(self):
+        user = User.objects.create_superuser(username="admin", password="password", email="admin@admin.om")
+        client = Client()
+        client.login(username="admin", password="password")
+        hub = Hub.objects.create(name="values_hub")
+        user.groups.add(PermGroup.objects.get(name="hub-" + str(hub.id)))
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+
+        def list_queries(devices):
+            for i in range(devices):
+                value = NumberValue(value=i)
+                value.save()
+                Device.objects.create(name=f"sensor{leaf.devices.count()}", leaf=leaf, _value=value, mode="IN")
+            with CaptureQueriesContext(connection) as context:
+                response = client.get(f"/api/hub/{hub.id}/leaves/")
+            assert response.status_code == 200
+            return len(context.captured_queries)
+
+        assert list_queries(2) == list_queries(20), "Device values should not be loaded one query at a time"
+
+
+@pytest.mark.django_db(transaction=True)
+class TestCompiledConditions:
+    def create_device(self, hub, leaf, name, value):
+        value = NumberValue(value=value)
+        value.save()
+        return Device.objects.create(name=name, leaf=leaf, _value=value, mode="IN")
+
+    def test_evaluate_from_cache(self, django_assert_num_queries):
+        hub = Hub.objects.create(name="conditions_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        self.create_device(hub, leaf, "temperature", 10)
+        self.create_device(hub, leaf, "humidity", 80)
+        hub = Hub.resolve(hub.id)
+        with Outbox(None):
+            create_condition("nested", ['AND', [['>', [leaf.uuid, 'temperature'], 20],
+                                                ['NOT', ['<', [leaf.uuid, 'humidity'], [leaf.uuid, 'temperature']]]]],
+                             [], hub)
+        condition = hub.conditions.get(name="nested")
+
+        assert compiled_conditions.evaluate(condition) is False  # compiles and loads the values
+        temperature = hub.get_device(leaf.uuid, "temperature")
+        with django_assert_num_queries(0):
+            temperature.stage_value(25)
+            assert compiled_conditions.evaluate(condition) is True
+            temperature.stage_value(90)
+            assert compiled_conditions.evaluate(condition) is False
+
+        humidity = hub.get_device(leaf.uuid, "humidity")
+        compiled_conditions.receive({'origin': "another process", 'values': [[humidity._value.pk, 95]]})
+        assert compiled_conditions.evaluate(condition) is True, "Readings from other processes should apply"
+
+        with Outbox(None):
+            create_condition("nested", ['=', [leaf.uuid, 'temperature'], 25], [], hub)
+        condition = hub.conditions.get(name="nested")
+        assert compiled_conditions.evaluate(condition) is False, "A replaced condition should be recompiled"
+
+    @pytest.mark.asyncio
+    async def test_process_listener(self):
+        hub = Hub.objects.create(name="conditions_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        humidity = self.create_device(hub, leaf, "humidity", 80)._value.pk
+        await listener.start()
+        channel = listener.channel
+        await listener.start()
+        assert listener.channel == channel, "A process should join the group once"
+
+        await get_channel_layer().group_send(ROUTING_GROUP, {'type': "values.changed", 'origin': "another process",
+                                                             'values': [[humidity, 95]]})
+        for _ in range(100):
+            if value_cache.get(humidity) == 95:
+                break
+            await asyncio.sleep(0.02)
+        assert value_cache.get(humidity) == 95, "Readings from other processes should apply"
+        await listener.stop()
+
+    def test_transitions_from_other_processes(self):
+        hub = Hub.objects.create(name="conditions_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        temperature = self.create_device(hub, leaf, "temperature", 10)._value.pk
+        hub = Hub.resolve(hub.id)
+        with Outbox(None):
+            create_condition("hot", ['>', [leaf.uuid, 'temperature'], 20], [], hub)
+        condition = hub.conditions.get(name="hot")
+        compiled = compiled_conditions.get(condition)
+
+        compiled_conditions.update(hub.id, {temperature: 25})
+        with Outbox(None) as outbox:
+            condition.execute(True)
+        compiled_conditions.settle(compiled, condition.previously_satisfied)
+        settled = {'type': "conditions.settled", 'origin': ORIGIN, 'hub': hub.id, 'conditions': [[condition.pk, True]]}
+        assert ('group_send', ROUTING_GROUP, settled) in outbox.operations, "Transitions should be announced"
+        compiled_conditions.receive_settled(dict(settled, conditions=[[condition.pk, False]]))
+        assert compiled.previously_satisfied is True, "A process should ignore its own announcements"
+
+        # another process sees the condition fall
+        compiled_conditions.receive({'origin': "another process", 'values': [[temperature, 10]]})
+        compiled_conditions.receive_settled(dict(settled, origin="another process", conditions=[[condition.pk, False]]))
+        assert compiled.previously_satisfied is False, "Transitions in other processes should settle here"
+        touched = compiled_conditions.update(hub.id, {temperature: 25})
+        assert touched[condition.pk].result != touched[condition.pk].previously_satisfied, \
+            "The next rising edge should not be lost"
+
+    def test_incremental_update(self, django_assert_num_queries):
+        hub = Hub.objects.create(name="conditions_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        temperature = self.create_device(hub, leaf, "temperature", 10)._value.pk
+        humidity = self.create_device(hub, leaf, "humidity", 80)._value.pk
+        hub = Hub.resolve(hub.id)
+        with Outbox(None):
+            create_condition("range", ['AND', [['>', [leaf.uuid, 'temperature'], 20],
+                                               ['<', [leaf.uuid, 'temperature'], 30]]], [], hub)
+            create_condition("humid", ['>', [leaf.uuid, 'humidity'], 90], [], hub)
+        range_id, humid_id = (hub.conditions.get(name=name).pk for name in ("range", "humid"))
+
+        compiled_conditions.conditions(hub.id)
+        with django_assert_num_queries(0):
+            touched = compiled_conditions.update(hub.id, {temperature: 25})
+            assert list(touched) == [range_id], "A condition reading a value twice should be touched once"
+            assert touched[range_id].result is True
+            assert compiled_conditions.update(hub.id, {humidity: 95})[humid_id].result is True
+            assert compiled_conditions.update(hub.id, {temperature: 35, humidity: 85}).keys() == {range_id, humid_id}
+            assert compiled_conditions.conditions(hub.id)[range_id].result is False
+
+    def test_threshold_index(self, django_assert_num_queries):
+        hub = Hub.objects.create(name="conditions_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        lux = self.create_device(hub, leaf, "lux", 0)._value.pk
+        hub = Hub.resolve(hub.id)
+        with Outbox(None):
+            for threshold in range(0, 100, 10):
+                for operator in ('<', '>', '=', '>='):
+                    create_condition(f"{operator}{threshold}", [operator, [leaf.uuid, 'lux'], threshold], [], hub)
+        names = {condition.pk: condition.name for condition in hub.conditions.all()}
+        comparisons = {'<': lambda a, b: a < b, '>': lambda a, b: a > b, '=': lambda a, b: a == b,
+                       '>=': lambda a, b: a >= b}
+
+        def expected(reading):
+            return {name for name in names.values()
+                    if comparisons[name.rstrip('0123456789')](reading, int(name.lstrip('<>=')))}
+
+        compiled = compiled_conditions.conditions(hub.id)
+        for pk in compiled:  # as if every condition had been executed
+            compiled_conditions.settle(compiled[pk], compiled[pk].result)
+        previous = expected(0)
+        with django_assert_num_queries(0):
+            for reading in (35, 35, 40, 5, 90, 90.5, -1):
+                touched = compiled_conditions.update(hub.id, {lux: reading})
+                satisfied = {names[pk] for pk, condition in compiled.items() if condition.result}
+                assert satisfied == expected(reading)
+                assert {names[pk] for pk in touched} == satisfied ^ previous, "Only flipped conditions run"
+                for condition in touched.values():
+                    compiled_conditions.settle(condition, condition.result)
+                previous = satisfied
+
+    def test_edge_triggered_actions(self):
+        hub = Hub.objects.create(name="conditions_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        device = self.create_device(hub, leaf, "lux", 50)
+        hub = Hub.resolve(hub.id)
+        with Outbox(None):
+            create_condition("bright", ['>', [leaf.uuid, 'lux'], 20], [], hub)
+        condition = hub.conditions.get(name="bright")
+        assert condition.previously_satisfied is False
+
+        device = hub.get_device(leaf.uuid, "lux")
+        with Outbox(None):
+            device.value = 60  # flips nothing, but the condition has never run
+        condition.refresh_from_db()
+        assert condition.previously_satisfied is True
+
+    def test_shared_network(self, django_assert_num_queries):
+        hub = Hub.objects.create(name="conditions_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        door = BooleanValue(value=False)
+        door.save()
+        Device.objects.create(name="door", leaf=leaf, _value=door, mode="IN")
+        lux = self.create_device(hub, leaf, "lux", 0)._value.pk
+        hub = Hub.resolve(hub.id)
+        with Outbox(None):
+            for i in range(10):
+                create_condition(f"rule{i}", ['AND', [['=', [leaf.uuid, 'door'], True],
+                                                      ['OR', [['>', [leaf.uuid, 'lux'], 50],
+                                                              ['>', [leaf.uuid, 'lux'], i]]]]], [], hub)
+
+        compiled = list(compiled_conditions.conditions(hub.id).values())
+        door_nodes = {id(node) for condition in compiled for node in condition.comparisons
+                      if node.first == door.pk}
+        assert len(door_nodes) == 1, "Identical comparisons should be shared between conditions"
+        assert len({id(node) for condition in compiled for node in condition.comparisons}) == 12
+        assert len({id(condition.root) for condition in compiled}) == 10
+
+        with django_assert_num_queries(0):
+            assert len(compiled_conditions.update(hub.id, {door.pk: True})) == 10
+            compiled_conditions.update(hub.id, {lux: 5})
+        assert sorted(condition.result for condition in compiled) == [False] * 5 + [True] * 5
+
+    def test_edge_state(self):
+        hub = Hub.objects.create(name="conditions_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        self.create_device(hub, leaf, "lux", 0)
+        hub = Hub.resolve(hub.id)
+        with Outbox(None):
+            create_condition("bright", ['>', [leaf.uuid, 'lux'], 20], [], hub)
+        device = hub.get_device(leaf.uuid, "lux")
+        with Outbox(None):
+            device.value = 1  # compiles the hub's conditions
+
+        saved, changed = [], []
+        post_save.connect(lambda instance, **kwargs: saved.append(instance), sender=Condition, weak=False,
+                          dispatch_uid="test_edge_state")
+        condition_changed.connect(lambda condition, **kwargs: changed.append(condition.previously_satisfied),
+                                  weak=False, dispatch_uid="test_edge_state")
+        try:
+            def condition_queries(value):
+                with Outbox(None), CaptureQueriesContext(connection) as context:
+                    device.value = value
+                return [query['sql'] for query in context.captured_queries if 'hub_condition' in query['sql']]
+
+            assert condition_queries(5) == [], "Unchanged conditions should not be written"
+            assert [sql.split()[0] for sql in condition_queries(25)] == ['SELECT', 'UPDATE']
+            assert condition_queries(30) == []
+            assert [sql.split()[0] for sql in condition_queries(10)] == ['SELECT', 'UPDATE']
+        finally:
+            post_save.disconnect(dispatch_uid="test_edge_state", sender=Condition)
+            condition_changed.disconnect(dispatch_uid="test_edge_state")
+        assert changed == [True, False], "Dashboards should hear about transitions only"
+        assert saved == []
+        assert Condition.objects.get(name="bright").previously_satisfied is False
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+class TestActionWorker:
+    async def test_dispatch_to_worker(self, settings):
+        settings.SENTINEL_ACTION_WORKER = True
+        hub = Hub.objects.create(name="actions_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        value = NumberValue(value=0)
+        value.save()
+        Device.objects.create(name="lux", leaf=leaf, _value=value, mode="IN")
+        flag = BooleanValue(value=False)
+        flag.save()
+        Datastore.objects.create(name="bright", hub=hub, _value=flag)
+        hub = Hub.resolve(hub.id)
+        with Outbox(None):
+            create_condition("bright", ['>', [leaf.uuid, 'lux'], 20],
+                             [{'action_type': 'SET', 'target': 'datastore', 'device': 'bright', 'value': True}], hub)
+
+        with Outbox(None) as outbox:
+            hub.get_device(leaf.uuid, "lux").value = 50
+        events = [operation[2] for operation in outbox.operations if operation[:2] == ('send', ACTION_CHANNEL)]
+        assert [event['target'] for event in events] == [f'{hub.id}-datastore']
+        assert Datastore.objects.get(name="bright").value is False, "Actions should wait for the worker"
+
+        worker = ApplicationCommunicator(ActionWorker, {'type': 'channel', 'channel': ACTION_CHANNEL})
+        await worker.send_input(events[0])
+        for _ in range(100):
+            if Datastore.objects.get(name="bright").value:
+                break
+            await asyncio.sleep(0.02)
+        assert Datastore.objects.get(name="bright").value is True
+        assert listener.channel is not None, "The worker should hear the other processes' broadcasts"
+        assert registry.get(('hub', hub.id)) is not hub, "The worker should not act on a cached hub"
+        await worker.wait()
+        await listener.stop()
+
+    async def test_concurrency_and_ordering(self, settings, monkeypatch):
+        settings.SENTINEL_ACTION_CONCURRENCY = 2
+        running, log = set(), []
+
+        def execute(self, hub_id, pks, depth=0, executed=0):
+            pk = pks[0]
+            log.append(('start', pk, frozenset(running)))
+            running.add(pk)
+            time.sleep(0.05)
+            running.discard(pk)
+            log.append(('end', pk))
+            return Outbox(self)
+        monkeypatch.setattr(ActionWorker, 'execute', execute)
+
+        worker = ApplicationCommunicator(ActionWorker, {'type': 'channel', 'channel': ACTION_CHANNEL})
+        for pk, target in ((1, 'door'), (2, 'door'), (3, 'light'), (4, 'fan')):
+            await worker.send_input({'type': 'action.run', 'hub': 1, 'actions': [pk], 'target': target})
+        for _ in range(100):
+            if len(log) == 8:
+                break
+            await asyncio.sleep(0.02)
+        starts = {entry[1]: entry[2] for entry in log if entry[0] == 'start'}
+        assert log.index(('end', 1)) < log.index(('start', 2, starts[2])), "A target's actions run in order"
+        assert 3 in starts[1] or 1 in starts[3], "Other targets should not wait"
+        assert all(len(others) < 2 for others in starts.values()), "At most two actions run at once"
+        await worker.wait()
+        await listener.stop()
+
+
+@pytest.mark.django_db(transaction=True)
+class TestActions:
+    def test_grouped_outputs(self, django_assert_num_queries):
+        hub = Hub.objects.create(name="actions_hub")
+        sensor = Leaf.objects.create(name="sensor", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                     last_connected=timezone.now(), hub=hub)
+        value = NumberValue(value=0)
+        value.save()
+        Device.objects.create(name="scene", leaf=sensor, _value=value, mode="IN")
+        lights = {}
+        for uuid, api_version in (("cd1b7879-d17a-47e5-bc14-26b3fc554e49", "1.1.0"),
+                                  ("0c4ba7b5-6a8d-4bc5-9a97-5d32b24b9b5c", "1.0.0")):
+            lights[api_version] = Leaf.objects.create(name="lights", model="0", uuid=uuid, api_version=api_version,
+                                                      last_connected=timezone.now(), hub=hub)
+            for name in ("kitchen", "hall", "porch"):
+                value = BooleanValue(value=False)
+                value.save()
+                Device.objects.create(name=name, leaf=lights[api_version], _value=value, mode="OUT")
+        for name in ("scene_count", "last_scene"):
+            value = NumberValue(value=0)
+            value.save()
+            Datastore.objects.create(name=name, hub=hub, _value=value)
+
+        actions = [self.action('SET', leaf.uuid, name, True) for leaf in lights.values()
+                   for name in ("kitchen", "hall", "porch")]
+        actions += [self.action('CHANGE', 'datastore', 'scene_count', 1),
+                    self.action('CHANGE', 'datastore', 'scene_count', 1),
+                    self.action('SET', 'datastore', 'last_scene', 3)]
+        hub = Hub.resolve(hub.id)
+        with Outbox(None):
+            create_condition("scene", ['=', [sensor.uuid, 'scene'], 3], actions, hub)
+
+        device = hub.get_device(sensor.uuid, "scene")
+        with Outbox(None) as outbox, CaptureQueriesContext(connection) as context:
+            device.value = 3
+        messages = [operation[2]['message'] for operation in outbox.operations
+                    if operation[0] == 'group_send' and operation[2]['type'] == 'leaf.send']
+        assert [message['type'] for message in messages] == ['SET_OUTPUTS'] + ['SET_OUTPUT'] * 3
+        assert [output['device'] for output in messages[0]['outputs']] == ["kitchen", "hall", "porch"]
+        assert messages[0]['uuid'] == lights["1.1.0"].uuid
+        updates = [query['sql'] for query in context.captured_queries
+                   if query['sql'].startswith('UPDATE "hub_value"')]
+        assert len(updates) == 2, "Both datastores should be written in the same UPDATE"
+        value_loads = [query for query in context.captured_queries
+                       if 'FROM "hub_value" WHERE "hub_value"."id" = ' in query['sql']]
+        assert not value_loads, "Action values should be loaded with the actions"
+        assert (Datastore.objects.get(name="scene_count").value, Datastore.objects.get(name="last_scene").value) \
+            == (2, 3)
+
+    @staticmethod
+    def action(action_type, target, device, value):
+        return {'action_type': action_type, 'target': target, 'device': device, 'value': value}
+
+
+@pytest.mark.django_db(transaction=True)
+class TestCascade:
+    @staticmethod
+    def hub_with_datastores(*names):
+        hub = Hub.objects.create(name="cascade_hub")
+        for name in names:
+            value = BooleanValue(value=False)
+            value.save()
+            Datastore.objects.create(name=name, hub=hub, _value=value)
+        return Hub.resolve(hub.id)
+
+    @staticmethod
+    def rule(hub, name, source, *targets):
+        create_condition(name, ['=', ['datastore', source], True],
+                         [{'action_type': 'SET', 'target': 'datastore', 'device': target, 'value': True}
+                          for target in targets], hub)
+
+    @staticmethod
+    def values(*names):
+        return [Datastore.objects.get(name=name).value for name in names]
+
+    def test_breadth_first(self):
+        hub = self.hub_with_datastores("start", "x", "y", "z", "w")
+        executed = []
+        condition_changed.connect(lambda condition, **kwargs: executed.append(condition.name),
+                                  weak=False, dispatch_uid="test_breadth_first")
+        try:
+            with Outbox(None):
+                self.rule(hub, "split", "start", "x", "y")
+                self.rule(hub, "from_x", "x", "z")
+                self.rule(hub, "from_y", "y", "w")
+                self.rule(hub, "from_z", "z")
+                hub.datastores.get(name="start").value = True
+        finally:
+            condition_changed.disconnect(dispatch_uid="test_breadth_first")
+        assert executed == ["split", "from_x", "from_y", "from_z"]
+
+    def test_budgets(self, settings):
+        names = [f"d{i}" for i in range(5)]
+        hub = self.hub_with_datastores(*names)
+        with Outbox(None):
+            for source, target in zip(names, names[1:]):
+                self.rule(hub, f"to_{target}", source, target)
+
+        settings.SENTINEL_CASCADE_MAX_DEPTH = 2
+        with Outbox(None):
+            hub.datastores.get(name="d0").value = True
+        assert self.values(*names) == [True, True, True, True, False], "Level 3 should have been cut short"
+
+        for datastore in hub.datastores.all():
+            datastore.value = False
+        settings.SENTINEL_CASCADE_MAX_DEPTH = 8
+        settings.SENTINEL_CASCADE_MAX_CONDITIONS = 2
+        with Outbox(None):
+            hub.datastores.get(name="d0").value = True
+        assert self.values(*names) == [True, True, True, False, False]
+
+    def test_budget_across_worker(self, settings):
+        names = [f"d{i}" for i in range(5)]
+        hub = self.hub_with_datastores(*names)
+        with Outbox(None):
+            for source, target in zip(names, names[1:]):
+                self.rule(hub, f"to_{target}", source, target)
+
+        settings.SENTINEL_ACTION_WORKER = True
+        settings.SENTINEL_CASCADE_MAX_CONDITIONS = 2
+        with Outbox(None) as outbox:
+            hub.datastores.get(name="d0").value = True
+        worker = ActionWorker({'type': 'channel', 'channel': ACTION_CHANNEL})
+        events = [operation[2] for operation in outbox.operations if operation[:2] == ('send', ACTION_CHANNEL)]
+        while events:
+            event = events.pop(0)
+            assert event['executed'] <= 2
+            outbox = worker.execute(event['hub'], event['actions'], event['depth'], event['executed'])
+            events += [operation[2] for operation in outbox.operations if operation[:2] == ('send', ACTION_CHANNEL)]
+        assert self.values(*names) == [True, True, True, False, False], "The worker should continue the budget"
+
+    def test_cycle_rejected(self):
+        hub = self.hub_with_datastores("a", "b", "c")
+        with Outbox(None):
+            self.rule(hub, "a_to_b", "a", "b")
+            self.rule(hub, "b_to_c", "b", "c")
+            conditions, predicates = Condition.objects.count(), Predicate.objects.count()
+            with pytest.raises(ConditionCycle) as error:
+                self.rule(hub, "c_to_a", "c", "a")
+            assert error.value.cycle == ["c_to_a", "a_to_b", "b_to_c", "c_to_a"]
+            assert (Condition.objects.count(), Predicate.objects.count()) == (conditions, predicates)
+
+            self.rule(hub, "b_to_c", "b")  # the replaced condition's action no longer counts
+            self.rule(hub, "c_to_a", "c", "a")
+
+
+@pytest.mark.django_db(transaction=True)
+class TestHistory:
+    @pytest.fixture(autouse=True)
+    def buffered(self, monkeypatch):
+        monkeypatch.setattr(history, 'enabled', True)
+        monkeypatch.setattr(history, 'interval', 60)
+        yield
+        history.flush()
+
+    @staticmethod
+    def partitions(hub_id):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT tablename FROM pg_tables WHERE tablename LIKE %s ORDER BY tablename",
+                           [f"hub_devicereading\\_{hub_id}\\_%"])
+            return [table for table, in cursor.fetchall()]
+
+    def test_readings_appended(self):
+        hub = Hub.objects.create(name="history_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        value = NumberValue(value=0)
+        value.save()
+        Device.objects.create(name="lux", leaf=leaf, _value=value, mode="IN")
+        flag = BooleanValue(value=False)
+        flag.save()
+        Datastore.objects.create(name="bright", hub=hub, _value=flag)
+        hub = Hub.resolve(hub.id)
+
+        with Outbox(None):
+            device = hub.get_device(leaf.uuid, "lux")
+            for lux in (10, 10, 30, 20):
+                device.value = lux
+            hub.datastores.get(name="bright").value = True
+        assert not DeviceReading.objects.filter(hub=hub).exists(), "Readings should wait in the buffer"
+
+        history.flush()
+        readings = DeviceReading.objects.filter(hub=hub).order_by('id')
+        assert [(reading.uuid, reading.device, reading.number if reading.number is not None else reading.boolean)
+                for reading in readings] == [(leaf.uuid, "lux", 10), (leaf.uuid, "lux", 30),
+                                             (leaf.uuid, "lux", 20), ("datastore", "bright", True)]
+        assert self.partitions(hub.id) == [f"hub_devicereading_{hub.id}_{timezone.now():%Y%m}"]
+
+    def test_rolled_back_readings_dropped(self):
+        hub = Hub.objects.create(name="history_hub")
+        flag = BooleanValue(value=False)
+        flag.save()
+        Datastore.objects.create(name="bright", hub=hub, _value=flag)
+        datastore = Datastore.objects.get(name="bright")
+        with pytest.raises(RuntimeError):
+            with transaction.atomic(), Outbox(None):
+                datastore.value = True
+                raise RuntimeError
+        history.flush()
+        assert not DeviceReading.objects.filter(hub=hub).exists()
+
+    def test_rejected_readings_dropped(self, monkeypatch):
+        hub = Hub.objects.create(name="history_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        value = NumberValue(value=0)
+        value.save()
+        device = Device.objects.create(name="lux", leaf=leaf, _value=value, mode="IN")
+        with pytest.raises(ValueError), Outbox(None):
+            device.value = "abc"  # not a number, so the save fails and nothing is recorded
+        assert history._readings == []
+
+        metrics.reset()
+        now = timezone.now()
+        for reading in (5, "abc", 7):
+            history.append((hub.id, leaf.uuid, "lux", now, reading, None, None))
+        history.flush()
+        assert [reading.number for reading in DeviceReading.objects.filter(hub=hub).order_by('id')] == [5, 7]
+        assert metrics.snapshot()['counters']['history.dropped'] == 1
+
+        def unavailable(readings):
+            raise OperationalError("database is down")
+        monkeypatch.setattr(history, 'copy', unavailable)
+        monkeypatch.setattr(history, 'max_readings', 2)
+        for number in range(25):
+            history.append((hub.id, leaf.uuid, "lux", now, number, None, None))
+        assert [reading[4] for reading in history._readings] == list(range(5, 25)), "Oldest readings are dropped"
+        monkeypatch.undo()
+        history.flush()
+        assert DeviceReading.objects.filter(hub=hub).count() == 22
+
+    def test_drop_months(self):
+        hub = Hub.objects.create(name="history_hub")
+        value = NumberValue(value=1)
+        for month in (1, 2, 3):
+            history.record(hub.id, "datastore", "count", value, datetime(2026, month, 15, tzinfo=timezone.utc))
+        history.flush()
+        assert len(self.partitions(hub.id)) == 3
+
+        dropped = drop_months(datetime(2026, 3, 1, tzinfo=timezone.utc), hub.id)
+        assert sorted(dropped) == [f"hub_devicereading_{hub.id}_202601", f"hub_devicereading_{hub.id}_202602"]
+        assert [reading.time.month for reading in DeviceReading.objects.filter(hub=hub)] == [3]
+
+        # servers before PostgreSQL 11 keep an unpartitioned table, whose months are deleted
+        history.record(hub.id, "datastore", "count", value, datetime(2026, 4, 15, tzinfo=timezone.utc))
+        history.flush()
+        assert history_module.delete_months(datetime(2026, 4, 10, tzinfo=timezone.utc), hub.id) == [
+            f"hub_devicereading_{hub.id}_202603"]
+        assert [reading.time.month for reading in DeviceReading.objects.filter(hub=hub)] == [4]
+
+        hub_id = hub.id
+        hub.delete()
+        assert self.partitions(hub_id) == []
+
+    def test_history_api(self, monkeypatch):
+        monkeypatch.setattr(history_module, 'CHUNK_SIZE', 2)  # buckets span chunks
+        user = User.objects.create_superuser(username="admin", password="password", email="admin@admin.om")
+        client = Client()
+        client.login(username="admin", password="password")
+        hub = Hub.objects.create(name="history_hub")
+        user.groups.add(PermGroup.objects.get(name="hub-" + str(hub.id)))
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        value = NumberValue(value=0)
+        value.save()
+        Device.objects.create(name="lux", leaf=leaf, _value=value, mode="IN")
+        for minute, second, lux in ((0, 5, 10), (0, 40, 30), (1, 0, 20), (1, 30, 50), (1, 59, 5), (3, 0, 7)):
+            history.record(hub.id, leaf.uuid, "lux", NumberValue(value=lux),
+                           datetime(2026, 5, 1, 12, minute, second, tzinfo=timezone.utc))
+        history.flush()
+
+        response = client.get(f"/api/hub/{hub.id}/leaves/{leaf.uuid}/devices/lux/history",
+                              {'start': "2026-05-01T12:00:00Z", 'end': "2026-05-01T12:03:00Z", 'bucket': 60,
+                               'aggregates': "count,min,max,avg,last"})
+        assert response.streaming
+        content = json.loads(b''.join(response.streaming_content))
+        assert (content['bucket'], content['source']) == (60, 'raw')
+        assert content['buckets'] == [
+            {'time': "2026-05-01T12:00:00+00:00", 'count': 2, 'min': 10, 'max': 30, 'avg': 20, 'last': 30},
+            {'time': "2026-05-01T12:01:00+00:00", 'count': 3, 'min': 5, 'max': 50, 'avg': 25, 'last': 5},
+        ]
+
+        response = client.get(f"/api/hub/{hub.id}/leaves/{leaf.uuid}/devices/lux/history", {'bucket': 0})
+        assert response.json()['accepted'] is False
+
+    def test_vectorized_reduction(self):
+        rows = [(seconds, float(seconds % 7)) for seconds in range(0, 600, 13)]
+        assert list(merge(history_module.reduce_chunk(rows, 60))) == list(merge(reduce_rows(rows, 60, True)))
+
+
+@pytest.mark.django_db(transaction=True)
+class TestRollups:
+    @pytest.fixture(autouse=True)
+    def enable_rollups(self, settings, monkeypatch):
+        settings.SENTINEL_ROLLUPS = True
+        monkeypatch.setattr(history, 'enabled', True)
+        monkeypatch.setattr(history, 'interval', 60)
+        yield
+        history.flush()
+
+    @staticmethod
+    def create_device():
+        hub = Hub.objects.create(name="rollup_hub")
+        leaf = Leaf.objects.create(name="leaf", model="0", uuid="a581b491-da64-4895-9bb6-5f8d76ebd44e",
+                                   last_connected=timezone.now(), hub=hub)
+        value = NumberValue(value=0)
+        value.save()
+        Device.objects.create(name="lux", leaf=leaf, _value=value, mode="IN")
+        return hub, leaf
+
+    @staticmethod
+    def record(hub, leaf, *readings):
+        for hour, minute, second, lux in readings:
+            history.record(hub.id, leaf.uuid, "lux", NumberValue(value=lux),
+                           datetime(2026, 5, 1, hour, minute, second, tzinfo=timezone.utc))
+        history.flush()
+
+    @staticmethod
+    def rollups(hub, width):
+        return [(rollup.bucket.strftime("%H:%M"), rollup.count, rollup.min, rollup.max, rollup.sum, rollup.last)
+                for rollup in ReadingRollup.objects.filter(hub=hub, width=width).order_by('bucket')]
+
+    def test_incremental_rollups(self):
+        hub, leaf = self.create_device()
+        self.record(hub, leaf, (12, 0, 5, 10), (12, 0, 40, 30), (12, 1, 0, 20), (13, 30, 0, 4))
+        assert not roll_up()
+        assert self.rollups(hub, 60) == [("12:00", 2, 10, 30, 40, 30), ("12:01", 1, 20, 20, 20, 20),
+                                         ("13:30", 1, 4, 4, 4, 4)]
+        assert self.rollups(hub, 3600) == [("12:00", 3, 10, 30, 60, 20), ("13:00", 1, 4, 4, 4, 4)]
+        assert self.rollups(hub, 86400) == [("00:00", 4, 4, 30, 64, 4)]
+        watermark = RollupWatermark.objects.get(hub=hub)
+        assert watermark.dirty_from is None and watermark.rolled_until.hour == 13
+
+        self.record(hub, leaf, (12, 1, 30, 2))  # late
+        assert RollupWatermark.objects.get(hub=hub).dirty_from.minute == 1
+        roll_up()
+        assert self.rollups(hub, 60)[1] == ("12:01", 2, 2, 20, 22, 2)
+        assert self.rollups(hub, 3600)[0] == ("12:00", 4, 2, 30, 62, 2)
+        assert self.rollups(hub, 86400) == [("00:00", 5, 2, 30, 66, 4)]
+        assert not RollupDelta.objects.filter(hub=hub).exists()
+
+        drop_months(datetime(2026, 6, 1, tzinfo=timezone.utc), hub.id)
+        self.record(hub, leaf, (12, 1, 10, 40))  # late, after its raw month was pruned
+        roll_up()
+        assert self.rollups(hub, 60)[1] == ("12:01", 3, 2, 40, 62, 2)
+        assert self.rollups(hub, 86400) == [("00:00", 6, 2, 40, 106, 4)]
+
+    def test_history_from_rollups(self):
+        user = User.objects.create_superuser(username="admin", password="password", email="admin@admin.om")
+        client = Client()
+        client.login(username="admin", password="password")
+        hub, leaf = self.create_device()
+        user.groups.add(PermGroup.objects.get(name="hub-" + str(hub.id)))
+        self.record(hub, leaf, (12, 0, 5, 10), (12, 30, 0, 30), (13, 0, 0, 20))
+        roll_up()
+        self.record(hub, leaf, (14, 0, 0, 50))
+
+        def history(**params):
+            response = client.get(f"/api/hub/{hub.id}/leaves/{leaf.uuid}/devices/lux/history",
+                                  dict(params, aggregates="count,max"))
+            return json.loads(b''.join(response.streaming_content))
+
+        dirty = history(start="2026-05-01T12:00:00Z", end="2026-05-01T15:00:00Z", bucket=3600)
+        assert dirty['source'] == 'raw', "Readings waiting to be rolled up should be read raw"
+        assert [bucket['count'] for bucket in dirty['buckets']] == [2, 1, 1]
+        roll_up()
+        assert history(start="2026-05-01T12:00:00Z", end="2026-05-01T15:00:00Z", bucket=3600) == \
+            dict(dirty, source='rollups')
+        assert history(start="2026-05-01T12:00:00Z", end="2026-05-01T14:00:00Z", bucket=7200)['buckets'] == \
+            [{'time': "2026-05-01T12:00:00+00:00", 'count': 3, 'max': 30}]
+        assert history(start="2026-05-01T12:00:30Z", end="2026-05-01T15:00:00Z", bucket=60)['source'] == 'raw'
+
+    @pytest.mark.asyncio
+    async def test_worker(self):
+        hub, leaf = self.create_device()
+        self.record(hub, leaf, (12, 0, 5, 10))
+        worker = ApplicationCommunicator(RollupWorker, {'type': 'channel', 'channel': ROLLUP_CHANNEL})
+        await worker.send_input({'type': 'rollup.update'})
+        for _ in range(100):
+            if ReadingRollup.objects.filter(hub=hub).exists():
+                break
+            await asyncio.sleep(0.02)
+        assert len(self.rollups(hub, 60)) == 1
+        await worker.wait()
@@ -1,53 +1,13 @@
-from .models import Datastore, Leaf, NumberValue, UnitValue, BooleanValue, StringValue, Device
+from .models import Datastore, Leaf, Value, NumberValue, UnitValue, BooleanValue, StringValue, Device
 from django.contrib.auth.models import User
+from django.db.models import Case, When, Value as Literal
 import re
 uuid_pattern = re.compile('[0-9a-f]{12}4[0-9a-f]{3}[89ab][0-9a-f]{15}\Z', re.I)
 
 
 def is_valid_message(message):
-    valid = 'type' in message
-    if not valid:
-        return False
-    elif message['type'] == 'CONFIG':
-        valid = valid and 'name' in message
-        valid = valid and 'model' in message
-        valid = valid and 'token' in message
-        valid = valid and 'api_version' in message
-    elif message['type'] == 'DEVICE_STATUS':
-        valid = valid and 'device' in message
-        valid = valid and 'mode' in message
-        valid = valid and 'format' in message
-        valid = valid and 'value' in message
-    elif message['type'] == 'SUBSCRIBE' or message['type'] == 'UNSUBSCRIBE':
-        valid = valid and 'sub_uuid' in message and validate_uuid(message['sub_uuid'])
-        valid = valid and 'sub_device' in message
-    elif message['type'] == 'DATASTORE_CREATE':
-        valid = valid and 'name' in message
-        valid = valid and 'value' in message
-        valid = valid and 'format' in message
-    elif message['type'] == 'DATASTORE_DELETE':
-        valid = valid and 'name' in message
-    elif message['type'] == 'DATASTORE_GET':
-        return valid and 'name' in message
-    elif message['type'] == 'DATASTORE_SET':
-        valid = valid and 'name' in message
-        valid = valid and 'value' in message
-    elif message['type'] == 'DATASTORE_DELETE':
-        valid = valid and 'name' in message
-    elif message['type'] == 'CONDITION_CREATE':
-        valid = valid and 'name' in message
-        valid = valid and 'predicate' in message
-        valid = valid and 'actions' in message
-        if valid and type(message['actions']) == list:
-            for action in message['actions']:
-                valid = valid and 'target' in action
-                valid = valid and 'device' in action
-                valid = valid and 'value' in action
-    elif message['type'] == 'CONDITION_DELETE':
-        valid = valid and 'name' in message
-    else:
-        return False
-    return valid and 'uuid' in message and validate_uuid(message['uuid'])
+    from .messages import message_types
+    return message_types.validate(message)
 
 
 def validate_uuid(uuid):
@@ -72,6 +32,25 @@ def create_value(format, value, units=None):
         return StringValue(value=value)
 
 
+def bulk_update(model, instances, field_name):
+    """Writes one field of many rows of model with a single CASE UPDATE, without sending signals."""
+    if not instances:
+        return
+    field = model._meta.get_field(field_name)
+    cases = [When(pk=instance.pk, then=Literal(getattr(instance, field_name))) for instance in instances]
+    model.objects.filter(pk__in=[instance.pk for instance in instances]).update(
+        **{field_name: Case(*cases, output_field=field)})
+
+
+def bulk_update_values(values):
+    """Writes the current value of many Value rows with one UPDATE per value column."""
+    by_column = {}
+    for value in values:
+        by_column.setdefault(value.column, []).append(value)
+    for column, group in by_column.items():
+        bulk_update(Value, group, column)
+
+
 def get_user(uuid, hub):
     return User.objects.get(username=f"{hub}-{uuid}")
 
@@ -114,6 +93,20 @@ class InvalidPredicate(SentinelError):
         }
 
 
+class ConditionCycle(SentinelError):
+    def __init__(self, condition, cycle):
+        super().__init__(f"Condition {condition} would trigger itself through {' -> '.join(cycle)}")
+        self.condition = condition
+        self.cycle = cycle
+
+    def get_error_message(self):
+        return {
+            'type': 'CONDITION_CYCLE',
+            'condition': self.condition,
+            'cycle': self.cycle
+        }
+
+
 class InvalidLeaf(SentinelError):
     def __init__(self, uuid):
         super().__init__(f"Unknown Leaf: {uuid}")
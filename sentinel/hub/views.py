@@ -1,15 +1,22 @@
 from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
+from django.db.models import Prefetch
 from django.shortcuts import render, get_object_or_404
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework.permissions import DjangoObjectPermissions
 from hub.models import Leaf, Device, Datastore, Condition, Hub
 from hub.serializers import LeafSerializer, ConditionSerializer, DatastoreSerializer, HubSerializer
+from .history import AGGREGATES, MAX_BUCKETS, raw_buckets, summarize
+from .metrics import metrics
+from .rollups import rollup_buckets
 from .utils import validate_uuid, create_value, SentinelError
 from .consumers import create_condition
 from rest_framework import generics
 from guardian.shortcuts import assign_perm, remove_perm, get_objects_for_user
 from guardian.models import Group as PermGroup
+from datetime import timedelta
 import secrets, json
 
 
@@ -50,6 +57,13 @@ def demo_datastores(request, id):
         raise PermissionDenied
 
 
+def metrics_snapshot(request):
+    if request.method == "GET" and request.user.is_staff:
+        return JsonResponse(metrics.snapshot())
+    else:
+        raise PermissionDenied
+
+
 def register_leaf(request, id):
     if request.method == 'POST':
         hub = get_object_or_404(Hub, id=id)
@@ -123,7 +137,7 @@ class LeafList(generics.ListAPIView):
     def get_queryset(self):
         hub = get_object_or_404(Hub, id=self.kwargs['id'])
         if self.request.user.has_perm('view_hub', hub):
-            return hub.leaves
+            return hub.leaves.prefetch_related(Prefetch('devices', Device.objects.select_related('_value')))
         else:
             raise PermissionDenied
 
@@ -136,7 +150,7 @@ class LeafDetail(generics.RetrieveDestroyAPIView):
     def get_queryset(self):
         hub = get_object_or_404(Hub, id=self.kwargs['id'])
         if self.request.user.has_perm('view_hub', hub):
-            return hub.leaves
+            return hub.leaves.prefetch_related(Prefetch('devices', Device.objects.select_related('_value')))
         else:
             raise PermissionDenied
 
@@ -162,13 +176,66 @@ class LeafDetail(generics.RetrieveDestroyAPIView):
             raise PermissionDenied
 
 
+class DeviceHistory(generics.GenericAPIView):
+    """
+    Streams a device's history from start until end (ISO 8601; the last day by default) in
+    buckets `bucket` seconds wide, with the comma separated aggregates (count, min, max, sum,
+    avg, last). Buckets without readings are left out.
+
+    The buckets are computed from the device's rollups when they are complete over the range and
+    the range and bucket width are whole minutes, hours or days, and from raw history otherwise.
+    """
+    permission_classes = [ObjectOnlyPermissions]
+
+    def get(self, request, **kwargs):
+        hub = get_object_or_404(Hub, id=kwargs['id'])
+        if not self.request.user.has_perm('view_hub', hub):
+            raise PermissionDenied
+        uuid = str(kwargs['uuid'])
+        device = get_object_or_404(Device.objects.select_related('_value'), leaf__hub=hub, leaf__uuid=uuid,
+                                   name=kwargs['name'])
+        try:
+            end = self.parse_time(request.query_params.get('end'), timezone.now())
+            start = self.parse_time(request.query_params.get('start'), end - timedelta(days=1))
+            width = int(request.query_params.get('bucket', 300))
+            aggregates = request.query_params.get('aggregates', 'min,avg,max').split(',')
+            assert start < end and width > 0 and set(aggregates) <= set(AGGREGATES)
+            assert (end - start).total_seconds() / width <= MAX_BUCKETS
+        except (ValueError, AssertionError):
+            return JsonResponse({'accepted': False, 'reason': f'Need start < end, a positive bucket width giving at '
+                                                              f'most {MAX_BUCKETS} buckets and aggregates '
+                                                              f'from {", ".join(AGGREGATES)}'})
+
+        partials, source = rollup_buckets(hub.id, uuid, device.name, start, end, width), 'rollups'
+        if partials is None:
+            partials, source = raw_buckets(hub.id, uuid, device.name, device._value.column, start, end, width), 'raw'
+        header = {'uuid': uuid, 'device': device.name, 'format': device.format, 'start': start.isoformat(),
+                  'end': end.isoformat(), 'bucket': width, 'source': source}
+
+        def content():
+            yield json.dumps(header)[:-1] + ', "buckets": ['
+            for i, partial in enumerate(partials):
+                yield (', ' if i else '') + json.dumps(summarize(partial, width, aggregates))
+            yield ']}'
+        return StreamingHttpResponse(content(), content_type='application/json')
+
+    @staticmethod
+    def parse_time(value, default):
+        if value is None:
+            return default
+        time = parse_datetime(value)
+        if time is None:
+            raise ValueError(value)
+        return time if timezone.is_aware(time) else timezone.make_aware(time, timezone.utc)
+
+
 class DatastoreList(generics.ListAPIView):
     serializer_class = DatastoreSerializer
 
     def get_queryset(self):
         hub = get_object_or_404(Hub, id=self.kwargs['id'])
         if self.request.user.has_perm('view_hub', hub):
-            return hub.datastores
+            return hub.datastores.select_related('_value')
         else:
             raise PermissionDenied
 
@@ -208,7 +275,7 @@ class DatastoreDetail(generics.RetrieveDestroyAPIView):
     def get_queryset(self):
         hub = get_object_or_404(Hub, id=self.kwargs['id'])
         if self.request.user.has_perm('view_hub', hub):
-            return hub.datastores
+            return hub.datastores.select_related('_value')
         else:
             raise PermissionDenied
 
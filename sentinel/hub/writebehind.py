@@ -0,0 +1,79 @@
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Keeps the latest value of each device in memory and writes it to the database on an interval.
+
+    Subscribers and conditions are served from the staged values straight away; only the last
+    value staged for a row within an interval is persisted, together with the last_updated time
+    of its leaf. An interval of 0 disables the buffer and values are saved as they arrive.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._values = {}
+        self._leaves = {}
+        self._timer = None
+        atexit.register(self.flush)
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def stage(self, device):
+        with self._lock:
+            self._values[device._value.pk] = device._value
+            self._leaves[device.leaf.pk] = device.leaf
+            if self._timer is None:
+                self._timer = threading.Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def current(self, value):
+        """Returns the staged instance for value's row if it has one waiting to be written."""
+        return self._values.get(value.pk, value)
+
+    def flush(self):
+        from .models import Leaf
+        from .utils import bulk_update, bulk_update_values
+
+        with self._lock:
+            values, self._values = self._values, {}
+            leaves, self._leaves = self._leaves, {}
+            timer, self._timer = self._timer, None
+        if not values:
+            return
+        try:
+            bulk_update_values(values.values())
+            bulk_update(Leaf, list(leaves.values()), 'last_updated')
+            logger.debug(f"Flushed {len(values)} values for {len(leaves)} leaves")
+        except Exception:
+            logger.exception("Write-behind flush failed, keeping values for the next interval")
+            with self._lock:
+                for pk, value in values.items():
+                    self._values.setdefault(pk, value)
+                for pk, leaf in leaves.items():
+                    self._leaves.setdefault(pk, leaf)
+        finally:
+            if threading.current_thread() is timer:
+                connection.close()  # timer threads do not go through Django's connection cleanup
+
+    def clear(self):
+        """Drops the staged values without writing them."""
+        with self._lock:
+            self._values.clear()
+            self._leaves.clear()
+            timer, self._timer = self._timer, None
+        if timer:
+            timer.cancel()
+
+
+write_behind = WriteBehindBuffer(settings.SENTINEL_WRITE_BEHIND_INTERVAL)
@@ -1,7 +1,9 @@
 from channels.auth import AuthMiddlewareStack
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ProtocolTypeRouter, URLRouter, ChannelNameRouter
 from channels.sessions import SessionMiddlewareStack
 import hub.routing
+from hub.actions import ACTION_CHANNEL, ActionWorker
+from hub.rollups import ROLLUP_CHANNEL, RollupWorker
 
 application = ProtocolTypeRouter({
     # (http->django views is added by default)
@@ -11,5 +13,9 @@ application = ProtocolTypeRouter({
                 hub.routing.websocket_routing
             )
         )
-    )
+    ),
+    'channel': ChannelNameRouter({
+        ACTION_CHANNEL: ActionWorker,
+        ROLLUP_CHANNEL: RollupWorker,
+    }),
 })
\ No newline at end of file
@@ -127,6 +127,41 @@ CHANNEL_LAYERS = {
     }
 }
 
+# seconds between write-behind flushes of device values; 0 saves every reading as it arrives
+SENTINEL_WRITE_BEHIND_INTERVAL = float(os.environ.get('SENTINEL_WRITE_BEHIND_INTERVAL', 0))
+
+# record changed device and datastore values in the DeviceReading history, copied into the table
+# every SENTINEL_HISTORY_INTERVAL seconds or once SENTINEL_HISTORY_MAX_READINGS are waiting
+SENTINEL_HISTORY = os.environ.get('SENTINEL_HISTORY', "FALSE") == "TRUE"
+SENTINEL_HISTORY_INTERVAL = float(os.environ.get('SENTINEL_HISTORY_INTERVAL', 1))
+SENTINEL_HISTORY_MAX_READINGS = int(os.environ.get('SENTINEL_HISTORY_MAX_READINGS', 5000))
+
+# keep 1 minute, 1 hour and 1 day rollups of the history, computed by `runworker rollups`
+SENTINEL_ROLLUPS = os.environ.get('SENTINEL_ROLLUPS', "FALSE") == "TRUE"
+
+# seconds between writes of a leaf's last_updated time; readings in between only update it in memory
+SENTINEL_LAST_UPDATED_INTERVAL = float(os.environ.get('SENTINEL_LAST_UPDATED_INTERVAL', 5))
+
+# frames handled by the group commit leaf consumer are committed together every window seconds or max messages
+SENTINEL_GROUP_COMMIT_WINDOW = float(os.environ.get('SENTINEL_GROUP_COMMIT_WINDOW', 0.005))
+SENTINEL_GROUP_COMMIT_MAX_MESSAGES = int(os.environ.get('SENTINEL_GROUP_COMMIT_MAX_MESSAGES', 64))
+
+# default telemetry rate limits in messages per second, per leaf and per hub; 0 disables the limit
+SENTINEL_LEAF_RATE_LIMIT = float(os.environ.get('SENTINEL_LEAF_RATE_LIMIT', 0))
+SENTINEL_LEAF_BURST = int(os.environ.get('SENTINEL_LEAF_BURST', 20))
+SENTINEL_HUB_RATE_LIMIT = float(os.environ.get('SENTINEL_HUB_RATE_LIMIT', 0))
+SENTINEL_HUB_BURST = int(os.environ.get('SENTINEL_HUB_BURST', 200))
+
+# run condition actions on the `runworker default` channel worker instead of the leaf's consumer,
+# at most SENTINEL_ACTION_CONCURRENCY at once per worker
+SENTINEL_ACTION_WORKER = os.environ.get('SENTINEL_ACTION_WORKER', "FALSE") == "TRUE"
+SENTINEL_ACTION_CONCURRENCY = int(os.environ.get('SENTINEL_ACTION_CONCURRENCY', 16))
+
+# a reading's conditions may trigger others through datastores at most this many levels deep,
+# and execute at most SENTINEL_CASCADE_MAX_CONDITIONS conditions in total
+SENTINEL_CASCADE_MAX_DEPTH = int(os.environ.get('SENTINEL_CASCADE_MAX_DEPTH', 8))
+SENTINEL_CASCADE_MAX_CONDITIONS = int(os.environ.get('SENTINEL_CASCADE_MAX_CONDITIONS', 256))
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
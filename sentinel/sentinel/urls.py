@@ -2,8 +2,8 @@ from django.conf.urls import url, include
 from django.urls import path
 from django.contrib import admin
 from frontend.views import index, login_view, logout_view, dashboard, register, demo
-from hub.views import register_leaf, HubList, HubDetail
-from hub.views import LeafList, LeafDetail, DatastoreDetail, DatastoreList, ConditionList, ConditionDetail
+from hub.views import register_leaf, metrics_snapshot, HubList, HubDetail
+from hub.views import LeafList, LeafDetail, DeviceHistory, DatastoreDetail, DatastoreList, ConditionList, ConditionDetail
 from hub.views import demo_conditions, demo_datastores, demo_leaves, demo_hub, demo_denied
 from rest_framework.urlpatterns import format_suffix_patterns
 
@@ -22,11 +22,13 @@ api_urls = [
     path(r'api/hub/', HubList.as_view()),
     path(r'api/hub/<int:id>/', HubDetail.as_view()),
     path(r'api/hub/<int:id>/leaves/<uuid:uuid>', LeafDetail.as_view()),
+    path(r'api/hub/<int:id>/leaves/<uuid:uuid>/devices/<name>/history', DeviceHistory.as_view()),
     path(r'api/hub/<int:id>/leaves/', LeafList.as_view()),
     path(r'api/hub/<int:id>/datastores/<name>', DatastoreDetail.as_view()),
     path(r'api/hub/<int:id>/datastores/', DatastoreList.as_view()),
     path(r'api/hub/<int:id>/conditions/<name>', ConditionDetail.as_view()),
     path(r'api/hub/<int:id>/conditions/', ConditionList.as_view()),
+    path(r'api/metrics/', metrics_snapshot),
 ]
 
 demo_urls = [